@@ -0,0 +1,105 @@
+from collections import OrderedDict
+import copy
+import os
+
+class AccountError(Exception):
+    """
+    Exception class for all account configuration errors
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class AccountFailuresError(Exception):
+    """
+    Exception class raised when the backup of some of the accounts failed
+    """
+    def __init__(self, failures):
+        self.failures = failures
+
+    def __str__(self):
+        return '{0} account backup(s) failed:\n{1}'.format(
+            len(self.failures),
+            '\n'.join('{0}: {1}'.format(name, error) for (name, error) in self.failures))
+
+
+class AccountConfiguration:
+    """
+    Per-account configurations of a configuration listing several accounts
+
+    Accounts are listed in credentials.accounts, each with a unique name,
+    its client_id and client_secret and an optional backup section whose
+    settings override the shared ones.  Unless overridden, each account
+    stores its files in a folder named after it beneath the shared
+    storage (and snapshot) path and keeps its index, journal and metrics
+    in files suffixed with its name, e.g. var/index.alice.sqlite.
+
+    A configuration with a single credentials.account is left as is.
+    """
+    def __init__(self, config):
+        self._config = config
+        self._accounts = OrderedDict()
+        for account in config[u'credentials'].get(u'accounts', []):
+            name = account.get(u'name')
+            if not name:
+                raise AccountError('Every account needs a name')
+            if name in self._accounts:
+                raise AccountError('Account {0} is listed more than once'.format(name))
+            self._accounts[name] = account
+
+    def is_multi_account(self):
+        """
+        Determines if the configuration lists several accounts
+        """
+        return bool(self._accounts)
+
+    def get_names(self):
+        """
+        Returns the names of the accounts, in configuration order
+        """
+        return self._accounts.keys()
+
+    def get_concurrency(self):
+        """
+        Returns the number of accounts to back up at once
+        """
+        return max(1, self._config[u'backup'].get(u'account_concurrency',
+                                                  self._DEFAULT_CONCURRENCY))
+
+    def get_config(self, name):
+        """
+        Returns the configuration of a single account
+        """
+        if name not in self._accounts:
+            raise AccountError('Unknown account {0}'.format(name))
+        account = self._accounts[name]
+        config = copy.deepcopy(self._config)
+        config[u'credentials'].pop(u'accounts')
+        config[u'credentials'][u'account'] = copy.deepcopy(account)
+
+        backup_config = config[u'backup']
+        backup_config[u'storage_path'] = os.path.join(backup_config[u'storage_path'], name)
+        for key in (u'index_path', u'journal_path'):
+            backup_config[key] = self._get_account_pathname(backup_config[key], name)
+        metrics_config = backup_config.get(u'metrics', {})
+        for key in (u'report_path', u'textfile_path'):
+            if metrics_config.get(key):
+                metrics_config[key] = self._get_account_pathname(metrics_config[key], name)
+        snapshot_config = backup_config.get(u'snapshots', {})
+        if snapshot_config.get(u'path'):
+            snapshot_config[u'path'] = os.path.join(snapshot_config[u'path'], name)
+
+        for (key, value) in account.get(u'backup', {}).iteritems():
+            backup_config[key] = copy.deepcopy(value)
+        return config
+
+    def _get_account_pathname(self, pathname, name):
+        """
+        Returns a pathname with the account name inserted before its extension
+        """
+        (root, extension) = os.path.splitext(pathname)
+        return '{0}.{1}{2}'.format(root, name, extension)
+
+    _DEFAULT_CONCURRENCY = 4
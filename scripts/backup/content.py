@@ -0,0 +1,80 @@
+import os
+
+class ContentMatcher:
+    """
+    Matches Drive files against the copies recorded in the metadata index
+
+    A stored copy is up to date when its export format matches and then its
+    checksum (when checksums are compared), otherwise its Drive version or
+    modification date.  For dedupe, downloads are identified by their
+    (md5Checksum, size) and exports by the (id, version, export format)
+    they were exported from.
+    """
+    def __init__(self, config, drive_download, index, compare_checksums):
+        self._dedupe = config[u'backup'].get(u'dedupe', False)
+        self._drive_download = drive_download
+        self._index = index
+        self._compare_checksums = compare_checksums
+
+    def is_file_current(self, file_obj, relative_path):
+        """
+        Determines if the copy stored at a relative path matches the Drive file
+        """
+        return self._index.is_file_current(file_obj.id, relative_path,
+                                           file_obj.modified_date,
+                                           self._drive_download.get_export_format(file_obj),
+                                           self.get_checksum(file_obj),
+                                           file_obj.version)
+
+    def is_entry_current(self, entry, file_obj):
+        """
+        Determines if the copy an IndexEntry records matches the Drive file
+        """
+        return self._index.is_entry_current(entry, file_obj.modified_date,
+                                            self._drive_download.get_export_format(file_obj),
+                                            self.get_checksum(file_obj),
+                                            file_obj.version)
+
+    def is_drive_file_newer(self, file_obj, local_path):
+        """
+        Determines if the Drive file is newer than an unindexed local file
+        """
+        if not os.path.exists(local_path):
+            return True
+        return self._drive_download.get_modification_time(file_obj) > os.stat(local_path).st_mtime
+
+    def get_checksum(self, file_obj):
+        """
+        Returns the Drive checksum to base change detection on (or None to
+        use the version and modification date)
+        """
+        if not self._compare_checksums:
+            return None
+        return file_obj.md5_checksum
+
+    def get_content_key(self, file_obj):
+        """
+        Returns the key identifying the content of a file for dedupe (or
+        None if it cannot be deduplicated): the (md5Checksum, size) of a
+        download, the (id, version, export format) of an export
+        """
+        if not self._dedupe:
+            return None
+        export_format = self._drive_download.get_export_format(file_obj)
+        if export_format:
+            if file_obj.version is None:
+                return None
+            return (file_obj.id, file_obj.version, export_format)
+        if file_obj.md5_checksum is None or file_obj.file_size is None:
+            return None
+        return (file_obj.md5_checksum, file_obj.file_size)
+
+    def find_content_paths(self, file_obj):
+        """
+        Returns the relative local paths of every stored file with the
+        content of a file, as identified by get_content_key
+        """
+        export_format = self._drive_download.get_export_format(file_obj)
+        if export_format:
+            return self._index.find_paths_by_export(file_obj.id, file_obj.version, export_format)
+        return self._index.find_paths_by_checksum(file_obj.md5_checksum, file_obj.file_size)
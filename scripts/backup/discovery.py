@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import time
+
+import httplib2
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
+
+class DiscoveryCache:
+    """
+    On-disk cache of the Drive v2 discovery document
+
+    The REST client is built from the cached copy while it is younger than
+    the TTL, so starting up makes no request before the first API call.
+    Otherwise the document is fetched again; should that fail, a stale
+    copy is used rather than failing the run.
+    """
+    def __init__(self, config, dry_run):
+        cache_config = config[u'backup'].get(u'discovery_cache', {})
+        self._cache_pathname = cache_config.get(u'path')
+        self._ttl = cache_config.get(u'ttl', self._DEFAULT_TTL)
+        self._discovery_url = config[u'backup'].get(u'discovery_url', self._DISCOVERY_URL).format(
+            api='drive', apiVersion='v2')
+        self._dry_run = dry_run
+        self._logger = logging.getLogger('drive_backup.backup.DiscoveryCache')
+
+    def build_service(self, http):
+        """
+        Returns the Drive v2 REST client using an authorized HTTP client
+        """
+        cached = self._load()
+        if cached and time.time() - cached[u'fetch_time'] < self._ttl:
+            document = cached[u'document']
+        else:
+            try:
+                document = self._fetch(http)
+            except (HttpError, httplib2.HttpLib2Error, IOError, ValueError) as e:
+                if not cached:
+                    raise
+                self._logger.warning('Using a stale discovery document: {0}'.format(e))
+                document = cached[u'document']
+            else:
+                self._store(document)
+        return build_from_document(document, http=http)
+
+    def _load(self):
+        """
+        Returns the cached entry for the discovery URL (or None)
+        """
+        if not self._cache_pathname or not os.path.exists(self._cache_pathname):
+            return None
+        try:
+            with open(self._cache_pathname, 'rt') as fp:
+                cached = json.load(fp)
+        except (IOError, ValueError) as e:
+            self._logger.debug('Ignoring unreadable discovery cache: {0}'.format(e))
+            return None
+        if cached.get(u'url') != self._discovery_url:
+            return None
+        return cached
+
+    def _fetch(self, http):
+        """
+        Downloads the discovery document
+
+        Returns the document as a string
+        """
+        self._logger.debug('Fetching discovery document {0}'.format(self._discovery_url))
+        (response, content) = http.request(self._discovery_url)
+        if response.status >= 400:
+            raise HttpError(response, content, uri=self._discovery_url)
+        json.loads(content)
+        return content
+
+    def _store(self, document):
+        """
+        Replaces the cached copy
+        """
+        if not self._cache_pathname or self._dry_run:
+            return
+        temp_pathname = self._cache_pathname + self._TEMP_SUFFIX
+        with open(temp_pathname, 'wt') as fp:
+            json.dump({u'url': self._discovery_url, u'fetch_time': time.time(),
+                       u'document': document}, fp)
+        os.rename(temp_pathname, self._cache_pathname)
+
+    _DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+    _DEFAULT_TTL = 24 * 60 * 60
+    _TEMP_SUFFIX = '.tmp'
@@ -0,0 +1,46 @@
+import re
+
+class ExclusionMatcher:
+    """
+    Matches relative paths against the configured exclusions
+    
+    The exclusion regular expressions are compiled into one combined
+    pattern, so a path is matched in a single pass.  Expressions that would
+    change meaning once combined (inline flags such as '(?i)', which apply to
+    the whole pattern, and references to groups by number or name) are
+    compiled on their own instead.  A folder is excluded (and its whole
+    subtree pruned) when its path followed by a separator matches, e.g.
+    'readings/*' excludes the folder 'readings'.
+    """
+    def __init__(self, config):
+        exclusions = config[u'backup'][u'exclusions']
+        self._matchers = [re.compile(exclusion) for exclusion in exclusions
+                          if self._STANDALONE_SYNTAX.search(exclusion)]
+        combined = [exclusion for exclusion in exclusions
+                    if not self._STANDALONE_SYNTAX.search(exclusion)]
+        if combined:
+            self._matchers.insert(0, re.compile(
+                '|'.join('(?:{0})'.format(exclusion) for exclusion in combined)))
+        
+    def has_exclusions(self):
+        """
+        Predicate to determine if any exclusions are configured
+        """
+        return bool(self._matchers)
+        
+    def is_excluded_file(self, pathname):
+        """
+        Predicate to determine if a file should be excluded
+        """
+        return any(matcher.search(pathname) is not None for matcher in self._matchers)
+        
+    def is_excluded_folder(self, relative_folder_path):
+        """
+        Predicate to determine if a folder and everything beneath it should be excluded
+        """
+        if not relative_folder_path:
+            return False
+        return self.is_excluded_file(relative_folder_path + '/')
+        
+    # NOTE: inline flags, backreferences, named groups and conditionals
+    _STANDALONE_SYNTAX = re.compile(r'\(\?[iLmsux]|\\[1-9]|\(\?P[<=]|\(\?\(')
@@ -0,0 +1,144 @@
+import logging
+import os
+
+class FolderTree:
+    """
+    Tree of Drive folders, built once per run
+    
+    Each folder is placed under its first parent that belongs to the tree.
+    Relative paths are resolved once, in a single pass, and memoized so 
+    every later lookup is O(1).  Folders whose ancestry leaves the drive 
+    (orphans, e.g. folders shared from elsewhere) or loops back on itself 
+    (cycles) are left out of the tree.
+    
+    Files are exposed in every parent folder, unless multiple_parents is 
+    turned off to keep them in the first one only.
+    """
+    def __init__(self, multiple_parents=True):
+        self._multiple_parents = multiple_parents
+        self._logger = logging.getLogger('drive_backup.backup.FolderTree')
+        self._names = {}
+        self._parent_ids = {}
+        self._paths = None
+        self._children = None
+        self._orphans = []
+        self._cycles = []
+        
+    def add_folder(self, folder_id, name, parent_ids):
+        """
+        Adds a folder; parent_ids lists its parents' ids, using 'root' for 
+        the root of the drive
+        """
+        self._names[folder_id] = name
+        self._parent_ids[folder_id] = parent_ids
+        self._paths = None
+        
+    def get_path(self, folder_id):
+        """
+        Returns the relative local path of a folder ('' for the root), or 
+        None if the folder is not part of the tree
+        """
+        self._resolve()
+        return self._paths.get(folder_id)
+    
+    def iterfolders(self):
+        """
+        Iterator for the ids of every folder in the tree (excluding the root), 
+        parents before children
+        """
+        self._resolve()
+        pending = list(reversed(self._children.get(u'root', [])))
+        while pending:
+            folder_id = pending.pop()
+            yield folder_id
+            pending.extend(reversed(self._children.get(folder_id, [])))
+            
+    def remove_subtree(self, folder_id):
+        """
+        Removes a folder and everything beneath it from the tree
+        """
+        self._resolve()
+        pending = [folder_id]
+        while pending:
+            curr_id = pending.pop()
+            if self._paths.pop(curr_id, None) is None:
+                continue
+            pending.extend(self._children.pop(curr_id, []))
+        parent_id = self._get_primary_parent(folder_id)
+        if parent_id in self._children:
+            self._children[parent_id].remove(folder_id)
+            
+    def get_file_parents(self, parent_ids):
+        """
+        Returns the ids of the folders in the tree a file is stored in: the 
+        first parent belonging to the tree, or every one of them when 
+        multiple parents are exposed
+        """
+        self._resolve()
+        folder_ids = [parent_id for parent_id in parent_ids if parent_id in self._paths]
+        if self._multiple_parents:
+            return folder_ids
+        return folder_ids[:1]
+    
+    def get_orphans(self):
+        """
+        Returns the ids of the folders whose ancestry leaves the drive
+        """
+        self._resolve()
+        return list(self._orphans)
+    
+    def get_cycles(self):
+        """
+        Returns the ids of the folders whose ancestry loops back on itself
+        """
+        self._resolve()
+        return list(self._cycles)
+    
+    def _get_primary_parent(self, folder_id):
+        """
+        Returns the id of the parent a folder is placed under (or None)
+        """
+        for parent_id in self._parent_ids.get(folder_id, []):
+            if parent_id == u'root' or parent_id in self._names:
+                return parent_id
+        return None
+    
+    def _resolve(self):
+        """
+        Resolves the path of every folder, visiting each folder once
+        """
+        if self._paths is not None:
+            return
+        self._paths = {u'root': u''}
+        self._children = {}
+        self._orphans = []
+        self._cycles = []
+        unresolvable = set()
+        
+        for folder_id in self._names:
+            # walk up until reaching a resolved (or unresolvable) ancestor
+            chain = []
+            in_chain = set()
+            curr_id = folder_id
+            while curr_id not in self._paths and curr_id not in unresolvable:
+                if curr_id in in_chain:
+                    self._logger.warning('Folder {0} is its own ancestor, skipping it'.format(self._names[curr_id]))
+                    self._cycles.append(curr_id)
+                    break
+                chain.append(curr_id)
+                in_chain.add(curr_id)
+                curr_id = self._get_primary_parent(curr_id)
+                if curr_id is None:
+                    break
+                
+            # then resolve the walked chain top down
+            if curr_id in self._paths:
+                for chain_id in reversed(chain):
+                    self._paths[chain_id] = os.path.join(self._paths[curr_id], self._names[chain_id])
+                    self._children.setdefault(curr_id, []).append(chain_id)
+                    curr_id = chain_id
+            else:
+                if curr_id is None:
+                    self._orphans.append(chain[-1])
+                    self._logger.debug('Folder {0} is outside of the drive hierarchy, skipping it'.format(self._names[chain[-1]]))
+                unresolvable.update(chain)
@@ -1,8 +1,21 @@
+from collections import namedtuple
 from datetime import datetime
+# NOTE: imported up front as strptime's lazy import is not thread-safe and
+# modification times are parsed by the download workers
+import _strptime
+import hashlib
 import time
 import logging
 import os
 
+from apiclient.errors import HttpError
+
+from backup.folder_tree import FolderTree
+from backup.throttle import RequestThrottle
+
+# NOTE: referenced so linters do not report the import above as unused
+_strptime
+
 class DownloadError(Exception):
     """
     Exception class for all download operations
@@ -15,158 +28,481 @@ class DownloadError(Exception):
         return 'HTTP Code: {0}\n{1}'.format(self._code, self._content)
     
 
+class ChecksumMismatchError(Exception):
+    """
+    Exception class raised when downloaded content does not match its Drive checksum
+    """
+    def __init__(self, filename, expected_md5, actual_md5):
+        self.filename = filename
+        self.expected_md5 = expected_md5
+        self.actual_md5 = actual_md5
+        
+    def __str__(self):
+        return 'Checksum mismatch for {0}: expected {1}, got {2}'.format(
+            self.filename, self.expected_md5, self.actual_md5)
+    
+
+class SizeMismatchError(Exception):
+    """
+    Exception class raised when downloaded content does not have the expected size
+    """
+    def __init__(self, filename, expected_size, actual_size):
+        self.filename = filename
+        self.expected_size = expected_size
+        self.actual_size = actual_size
+        
+    def __str__(self):
+        return 'Size mismatch for {0}: expected {1} bytes, got {2}'.format(
+            self.filename, self.expected_size, self.actual_size)
+    
+
+class _ContentWriter:
+    """
+    Writes downloaded content to a file, computing its MD5 checksum on the 
+    fly when the content is to be verified
+    """
+    def __init__(self, fp, offset, verify):
+        self._fp = fp
+        self._md5 = hashlib.md5() if verify else None
+        
+        # NOTE: the already downloaded part of a resumed file is hashed once
+        fp.seek(0)
+        remaining = offset if verify else 0
+        while remaining > 0:
+            data = fp.read(min(remaining, self._READ_SIZE))
+            if not data:
+                break
+            self._md5.update(data)
+            remaining -= len(data)
+        fp.seek(offset)
+        fp.truncate()
+        
+    def write(self, data):
+        """
+        Appends data to the file
+        """
+        self._fp.write(data)
+        if self._md5:
+            self._md5.update(data)
+            
+    def restart(self):
+        """
+        Discards everything written so far
+        """
+        self._fp.seek(0)
+        self._fp.truncate()
+        if self._md5:
+            self._md5 = hashlib.md5()
+            
+    def sync(self):
+        """
+        Makes everything written so far durable
+        """
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        
+    def hexdigest(self):
+        """
+        Returns the MD5 checksum of the content (or None if not verifying)
+        """
+        return self._md5.hexdigest() if self._md5 else None
+    
+    _READ_SIZE = 1024 * 1024
+    
+
+class ChangeTokenExpiredError(Exception):
+    """
+    Exception class raised when Drive no longer accepts a changes feed token
+    """
+    def __init__(self, change_token):
+        self.change_token = change_token
+        
+    def __str__(self):
+        return 'Change token {0} is no longer valid'.format(self.change_token)
+
+
+class DriveFile(namedtuple('DriveFile', ['id', 'title', 'mime_type', 'parent_ids', 'trashed',
+                                         'modified_date', 'md5_checksum', 'file_size',
+                                         'download_url', 'export_links', 'version'])):
+    """
+    Compact record of the fields of a Drive file resource used by the backup
+    
+    parent_ids uses 'root' for the root of the drive.  Native Google files 
+    have export_links instead of a download_url, file_size and md5_checksum.
+    version is Drive's version number of the file, which increases with 
+    every change to it.
+    """
+    __slots__ = ()
+    
+    @classmethod
+    def from_resource(cls, resource, parent_ids):
+        """
+        Creates the record of a file resource with the given parent ids
+        """
+        file_size = resource.get(u'fileSize')
+        version = resource.get(u'version')
+        return cls(resource[u'id'], 
+                   resource[u'title'], 
+                   resource[u'mimeType'],
+                   parent_ids,
+                   resource.get(u'labels', {}).get(u'trashed', False),
+                   resource[u'modifiedDate'], 
+                   resource.get(u'md5Checksum'),
+                   int(file_size) if file_size is not None else None,
+                   resource.get(u'downloadUrl'), 
+                   resource.get(u'exportLinks'),
+                   int(version) if version is not None else None)
+
+
 class GoogleDriveDownload:
     _MIME_TYPE_FOLDER = u'application/vnd.google-apps.folder'
-    _ITEMS_PER_DOWNLOAD = 15
+    # NOTE: 1000 is the largest page size accepted by files().list
+    _ITEMS_PER_PAGE = 1000
+    # NOTE: keeps 'in parents' queries well within the query length limit
+    _FOLDERS_PER_QUERY = 50
+    # NOTE: listings only ask for the fields held in DriveFile records
+    _FILE_FIELDS = ('id,title,mimeType,parents(id,isRoot),labels/trashed,modifiedDate,'
+                    'md5Checksum,fileSize,downloadUrl,exportLinks,version')
+    _FILE_LIST_FIELDS = 'nextPageToken,items({0})'.format(_FILE_FIELDS)
+    _FOLDER_LIST_FIELDS = 'nextPageToken,items(id,title,parents(id,isRoot))'
+    _CHANGE_LIST_FIELDS = 'nextPageToken,newStartPageToken,items(fileId,deleted,file({0}))'.format(_FILE_FIELDS)
+    _EXPIRED_TOKEN_STATUSES = (400, 404, 410)
+    _DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+    _TEMP_SUFFIX = '.download'
+    _CHECKSUM_ATTEMPTS = 3
     
     """
     Manager to download a hierarchy of files from Google Drive
-    
-    Returns a tuple containing:
-        all_folders - list of folder meta information
-        folder_hierarchy - dict of dicts describing folder hierarchy (index by 'id')
     """
-    def __init__(self, config, drive_service, dry_run):
+    def __init__(self, config, drive_service, dry_run, journal=None, throttle=None):
         self._config = config[u'backup']
         self._drive_service = drive_service
         self._dry_run = dry_run
+        self._journal = journal
+        self._throttle = throttle or RequestThrottle(config)
         self._logger = logging.getLogger('drive_backup.backup.GoogleDriveDownload')
+        
+        # files sharing parents share a single tuple of their ids
+        self._parent_ids = {}
 
-    def iterfolder(self, folder_id):
+    def iterfiles(self):
         """
-        Iterator for all files in the drive
+        Iterator for all non-folder files in the drive using a single listing query
         """
         keep_downloading = True
         page_token = None
         while keep_downloading:
             current_drive_results = self._get_file_listing_page(
-                "trashed = %s and mimeType != '%s' and '%s' in parents" % 
-                    (self._config[u'include_trashed'], self._MIME_TYPE_FOLDER, folder_id), 
-                page_token)
+                "trashed = %s and mimeType != '%s'" %
+                    (self._config[u'include_trashed'], self._MIME_TYPE_FOLDER),
+                page_token, self._FILE_LIST_FIELDS)
             page_token = current_drive_results.get('nextPageToken')
             if not page_token:
                 keep_downloading = False
             for curr_file in current_drive_results[u'items']:
-                yield curr_file
+                yield self._make_record(curr_file)
+
+    def iterchildren(self, folder_ids):
+        """
+        Iterator for the files and folders directly inside any of the given
+        folders, listing several folders per query
+        """
+        folder_ids = list(folder_ids)
+        for batch_start in xrange(0, len(folder_ids), self._FOLDERS_PER_QUERY):
+            parents_query = ' or '.join(
+                "'%s' in parents" % folder_id
+                for folder_id in folder_ids[batch_start:batch_start + self._FOLDERS_PER_QUERY])
+            page_token = None
+            while True:
+                current_drive_results = self._get_file_listing_page(
+                    "trashed = %s and (%s)" % (self._config[u'include_trashed'], parents_query),
+                    page_token, self._FILE_LIST_FIELDS)
+                for curr_file in current_drive_results[u'items']:
+                    yield self._make_record(curr_file)
+                page_token = current_drive_results.get('nextPageToken')
+                if not page_token:
+                    break
+
+    def get_start_page_token(self):
+        """
+        Returns the changes feed token that marks the current state of the drive
+        """
+        results = self._throttle.execute(self._drive_service.changes().getStartPageToken())
+        return results[u'startPageToken']
     
-    def get_folder_hierarchy(self):
+    def get_changes(self, change_token):
         """
-        Downloads and constructs the folder hierarchy as a dictionary
+        Retrieves every change made since a changes feed token
         
-        Returns:
-            all_folders - dictionary of folder metadata all indexed by id
-            folder_hierarchy - dictionary of dictionaries describing the folder hierarchy
+        Returns a tuple containing:
+            changes - list of change resources (oldest first), with the file
+                      resources converted to DriveFile records
+            new_change_token - token to use for the next incremental run
+        
+        Raises ChangeTokenExpiredError if the token is no longer accepted
+        """
+        changes = []
+        page_token = change_token
+        while True:
+            try:
+                drive_results = self._throttle.execute(self._drive_service.changes().list(
+                    pageToken=page_token, includeDeleted=True, 
+                    maxResults=self._ITEMS_PER_PAGE, fields=self._CHANGE_LIST_FIELDS))
+            except HttpError as e:
+                if e.resp.status in self._EXPIRED_TOKEN_STATUSES:
+                    raise ChangeTokenExpiredError(change_token)
+                raise
+            for change in drive_results[u'items']:
+                if u'file' in change:
+                    change[u'file'] = self._make_record(change[u'file'])
+                changes.append(change)
+            page_token = drive_results.get(u'nextPageToken')
+            if not page_token:
+                return (changes, drive_results[u'newStartPageToken'])
+    
+    def is_folder(self, file_obj):
+        """
+        Determines if a file record is a folder
+        """
+        return file_obj.mime_type == self._MIME_TYPE_FOLDER
+    
+    def is_trashed(self, file_obj):
         """
+        Determines if a file record is trashed and should not be backed up
+        """
+        if self._config[u'include_trashed'].lower() == u'true':
+            return False
+        return file_obj.trashed
+    
+    def get_folder_tree(self):
+        """
+        Downloads the flat list of all folders and builds the folder tree
         
-        # retrieve the flat list of all folders and filter for only
-        # the salient hierarchical link information
-        all_folders = {}
+        Returns:
+            folder_tree - FolderTree of every folder in the drive
+        """
+        folder_tree = FolderTree(self._config.get(u'multiple_parents', True))
         keep_downloading = True
         page_token = None
         while keep_downloading:
             current_drive_results = self._get_file_listing_page("trashed = %s and mimeType = '%s'" % 
-                                (self._config[u'include_trashed'], self._MIME_TYPE_FOLDER), page_token)
+                                (self._config[u'include_trashed'], self._MIME_TYPE_FOLDER), page_token,
+                                self._FOLDER_LIST_FIELDS)
             page_token = current_drive_results.get('nextPageToken')
             
             for item in current_drive_results[u'items']:
-                # NOTE: we only care about the first parent 
-                parent = item['parents'][0] if len(item['parents']) > 0 else None
-                all_folders[ item[u'id'] ] = { 
-                    u'name' : item[u'title'], 
-                    u'id' : item[u'id'], 
-                    u'parent' : u'root' if parent is None or parent[u'isRoot'] else parent[u'id']}
+                folder_tree.add_folder(item[u'id'], item[u'title'], 
+                                       self._get_resource_parent_ids(item))
                 
             if not page_token:
                 keep_downloading = False
+        return folder_tree
     
-        # construct the hierarchy
-        folder_hierarchy = { u'root': {} }
-        for folder in all_folders.itervalues():
-            
-            parent_path = [folder[u'id']]
-            curr_parent_id = folder[u'parent']
-            while curr_parent_id != u'root':
-                parent_path.insert( 0, curr_parent_id)
-                curr_parent_id = all_folders[curr_parent_id][u'parent']
-            
-            curr_hierarchy = folder_hierarchy[u'root']
-            for curr_parent_id in parent_path:
-                if curr_parent_id not in curr_hierarchy:
-                    curr_hierarchy[curr_parent_id] = {}
-                curr_hierarchy = curr_hierarchy[curr_parent_id]
-    
-        all_folders[u'root'] = { u'name': 'root', u'id' : u'root', 
-                                u'parent' : None }
-        return (all_folders, folder_hierarchy)
-    
-    def get_relative_folder_path(self, folder_id, all_folders):
+    def get_parent_ids(self, file_obj):
         """
-        Returns a relative folder path
+        Returns the ids of the parent folders of a file, using 'root' for 
+        the root of the drive
         """
-        if folder_id == u'root':
-            return ''
-        
-        folder = all_folders[folder_id]
-        parent_path_components = [folder[u'name']]
-        curr_parent_id = folder[u'parent']
-        while curr_parent_id != u'root':
-            parent_path_components.insert( 0, all_folders[curr_parent_id][u'name'])
-            curr_parent_id = all_folders[curr_parent_id][u'parent']
-        return os.path.sep.join(parent_path_components)
+        return file_obj.parent_ids
     
     def get_filename(self, file_obj):
         """
         Determines the local filename for a file object
         """
-        if file_obj[u'mimeType'] in self._config[u'download_formats']:
-            file_format = self._config[u'download_formats'][file_obj[u'mimeType']]
-            return '{0}.{1}'.format(file_obj[u'title'], file_format['extension'])
+        if file_obj.mime_type in self._config[u'download_formats']:
+            file_format = self._config[u'download_formats'][file_obj.mime_type]
+            return '{0}.{1}'.format(file_obj.title, file_format['extension'])
         else:
-            return file_obj[u'title']
+            return file_obj.title
+        
+    def get_modification_time(self, file_obj):
+        """
+        Returns the Drive modification time of a file as seconds since the epoch
+        """
+        modification_time = datetime.strptime(file_obj.modified_date,
+                                              '%Y-%m-%dT%H:%M:%S.%fZ')
+        return time.mktime( modification_time.timetuple() )
+    
+    def get_export_format(self, file_obj):
+        """
+        Returns the content type a native Google file is exported to 
+        (or None for files downloaded as is)
+        """
+        if file_obj.export_links is None:
+            return None
+        return self._config[u'download_formats'][file_obj.mime_type]['content_type']
+    
+    def get_chunk_size(self):
+        """
+        Returns the number of bytes requested per download request
+        """
+        return self._config.get(u'download_chunk_size', self._DOWNLOAD_CHUNK_SIZE)
         
-    def download_file(self, file_obj, filename):
+    def download_file(self, file_obj, filename, http=None):
         """
         Downloads a drive file in a preferred format
         
-        file_obj - File resource meta-information
+        file_obj - DriveFile record of the file
         local_download_path - Local path to store the file
+        http - Authorized HTTP client to use (defaults to the drive service's client)
         """
         
-        # prepare the file metadata
-        modification_time = datetime.strptime(file_obj[u'modifiedDate'],
-                                          '%Y-%m-%dT%H:%M:%S.%fZ')
-        
-        self._logger.info('Downloading [{0}]: {1}'.format(file_obj[u'modifiedDate'], filename))
+        self._logger.info('Downloading [{0}]: {1}'.format(file_obj.modified_date, filename))
         if self._dry_run:
             return
 
         # download the file to the local storage
-        if u'exportLinks' in file_obj:
-            file_format = self._config[u'download_formats'][file_obj[u'mimeType']]
-            download_url = file_obj[u'exportLinks'][file_format['content_type']]
+        export_format = self.get_export_format(file_obj)
+        if export_format:
+            download_url = file_obj.export_links[export_format]
         else:
-            download_url = file_obj[u'downloadUrl']
-        http_response, content = self._drive_service._http.request(download_url)
-        if http_response.status != 200:
-            raise DownloadError(http_response.status, content)
-        with open(filename, 'w') as fp:
-            fp.write(content)
+            download_url = file_obj.download_url
+        if http is None:
+            http = self._drive_service._http
             
-        # artificially set the local file's modification time to match Google Drive
-        os.utime(filename, 
-                 (time.mktime( datetime.now().timetuple() ), 
-                  time.mktime( modification_time.timetuple() )))
+        # stream the content into a temporary file next to the target so 
+        # that the target is only ever replaced by a complete file
+        temp_filename = os.path.join(
+            os.path.dirname(filename), 
+            '.{0}{1}'.format(os.path.basename(filename), self._TEMP_SUFFIX))
+        
+        # binary downloads interrupted by an earlier run resume where they stopped
+        revision = None
+        offset = 0
+        if self._journal and not export_format:
+            revision = file_obj.md5_checksum or file_obj.modified_date
+            partial = self._journal.get_partial(filename, revision)
+            if partial:
+                (temp_filename, offset) = partial
+                self._logger.info('Resuming {0} from byte {1}'.format(filename, offset))
+                self._journal.update_partial(filename, revision, temp_filename, offset)
+                
+        def on_chunk(writer, offset):
+            """
+            Makes the chunks written so far durable and journals the progress
+            """
+            writer.sync()
+            self._journal.update_partial(filename, revision, temp_filename, offset)
+        
+        # binary files are verified against their Drive checksum as they stream
+        expected_md5 = None if export_format else file_obj.md5_checksum
+        expected_file_size = None if export_format else file_obj.file_size
+        try:
+            attempt_num = 1
+            while True:
+                with open(temp_filename, 'r+b' if offset else 'wb') as fp:
+                    writer = _ContentWriter(fp, offset, expected_md5 is not None)
+                    (actual_size, total_size) = self._stream_content(
+                        http, download_url, writer, offset, on_chunk if revision else None)
+                    writer.sync()
+                    
+                # a truncated download is never put in place
+                expected_size = total_size if total_size is not None else expected_file_size
+                if expected_size is not None and actual_size != expected_size:
+                    if revision:
+                        self._journal.remove_partial(filename)
+                    raise SizeMismatchError(filename, expected_size, actual_size)
+                actual_md5 = writer.hexdigest()
+                if actual_md5 == expected_md5:
+                    break
+                
+                # start over as the corrupt bytes could be anywhere in the file
+                if revision:
+                    self._journal.remove_partial(filename)
+                if attempt_num >= self._CHECKSUM_ATTEMPTS:
+                    raise ChecksumMismatchError(filename, expected_md5, actual_md5)
+                self._logger.info('Checksum mismatch for {0}, downloading again'.format(filename))
+                attempt_num += 1
+                offset = 0
+                
+            # artificially set the local file's modification time to match Google Drive
+            os.utime(temp_filename, 
+                     (time.mktime( datetime.now().timetuple() ), 
+                      self.get_modification_time(file_obj)))
+            os.rename(temp_filename, filename)
+        except:
+            # keep journaled progress for the next run to resume
+            if revision is None or self._journal.get_partial(filename, revision) is None:
+                if os.path.exists(temp_filename):
+                    os.unlink(temp_filename)
+            raise
+        if revision:
+            self._journal.remove_partial(filename)
         
+    def _stream_content(self, http, download_url, writer, offset, on_chunk):
+        """
+        Downloads content in bounded chunks using HTTP range requests
+        
+        Only one chunk is held in memory at a time.  Content served without 
+        range support (e.g. exports) arrives in a single response.  Chunks 
+        are requested until the total size given by Content-Range is reached;
+        a short chunk only ends the content when the total is unknown.
+        
+        writer - _ContentWriter positioned at offset to write the content to
+        offset - number of bytes of the content already written
+        on_chunk - called with (writer, offset) after each chunk when more are to follow
+        
+        Returns a tuple containing:
+            size - number of bytes of the content written
+            total_size - total size the server reported (or None if unknown)
+        """
+        chunk_size = self.get_chunk_size()
+        total_size = None
+        while True:
+            headers = {'Range': 'bytes={0}-{1}'.format(offset, offset + chunk_size - 1)}
+            http_response, content = self._throttle.request(http, download_url, headers=headers)
+            if http_response.status == 416:
+                # the previous chunk ended exactly at the end of the content
+                return (offset, total_size)
+            if http_response.status == 200:
+                # the server ignored the range and sent everything
+                writer.restart()
+                writer.write(content)
+                return (len(content), None)
+            if http_response.status != 206:
+                raise DownloadError(http_response.status, content)
+            
+            writer.write(content)
+            offset += len(content)
+            content_total = http_response.get('content-range', '*/*').rsplit('/', 1)[-1]
+            if content_total == '*':
+                if len(content) < chunk_size:
+                    return (offset, total_size)
+            else:
+                total_size = int(content_total)
+                if offset >= total_size:
+                    return (offset, total_size)
+                if not content:
+                    # NOTE: an empty chunk short of the total would be requested forever
+                    raise DownloadError(http_response.status, 
+                                        'No content at byte {0} of {1}'.format(offset, total_size))
+            if on_chunk:
+                on_chunk(writer, offset)
 
-    def _get_file_listing_page(self, query, page_token):
+    def _get_file_listing_page(self, query, page_token, fields):
         """
         Retrieves a file listing
         
         Returns:
         file_listing - list of file resources for this page
         """
-        query_params = {'q' : query, 'maxResults' : self._ITEMS_PER_DOWNLOAD}
+        query_params = {'q' : query, 'maxResults' : self._ITEMS_PER_PAGE, 'fields' : fields}
         if page_token:
             query_params['pageToken'] = page_token
-        drive_results = self._drive_service.files().list(**query_params).execute()
+        drive_results = self._throttle.execute(self._drive_service.files().list(**query_params))
         return drive_results
+    
+    def _make_record(self, resource):
+        """
+        Converts a file resource to a DriveFile record
+        """
+        return DriveFile.from_resource(resource, self._get_resource_parent_ids(resource))
+    
+    def _get_resource_parent_ids(self, resource):
+        """
+        Returns the tuple of parent ids of a file or folder resource, using 
+        'root' for the root of the drive
+        """
+        parent_ids = tuple(u'root' if parent[u'isRoot'] else parent[u'id'] 
+                           for parent in resource.get(u'parents', []))
+        return self._parent_ids.setdefault(parent_ids, parent_ids)
@@ -0,0 +1,373 @@
+from collections import namedtuple
+import logging
+import os
+import sqlite3
+import urllib
+
+class MetadataIndexError(Exception):
+    """
+    Exception class for all metadata index operations
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+"""
+Indexed metadata of a locally stored file
+"""
+IndexEntry = namedtuple('IndexEntry', ['file_id', 'path', 'modified_date', 
+                                       'md5_checksum', 'size', 'export_format', 'version'])
+
+
+class MetadataIndex:
+    """
+    On-disk (SQLite) index of everything stored locally, keyed by Drive id
+    
+    The index records:
+        the Drive start page token for the changes feed
+        the relative local path of each folder
+        the relative local path, modification date, checksum, size, export
+        format and Drive version of each file
+        
+    Paths are relative to the storage root.  A file with several parents has 
+    one entry per local path.  In dry run mode, the index is copied into 
+    memory and the file is only read (and never created): changes are 
+    visible for the lifetime of the index but are never committed.
+    """
+    def __init__(self, index_pathname, dry_run):
+        self._index_pathname = index_pathname
+        self._dry_run = dry_run
+        self._logger = logging.getLogger('drive_backup.backup.MetadataIndex')
+        self._pending_writes = 0
+        try:
+            if self._dry_run:
+                self._open_copy()
+            else:
+                self._db = sqlite3.connect(self._index_pathname)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('PRAGMA synchronous=NORMAL')
+                self._db.executescript(self._SCHEMA)
+                self._upgrade_schema()
+        except sqlite3.Error as e:
+            raise MetadataIndexError('Unable to open metadata index {0}: {1}'.format(index_pathname, e))
+        
+    def commit(self):
+        """
+        Persists all changes made so far
+        """
+        self._pending_writes = 0
+        if self._dry_run:
+            return
+        self._db.commit()
+        
+    def close(self):
+        """
+        Persists all changes and closes the index
+        """
+        self.commit()
+        self._db.rollback()
+        self._db.close()
+        
+    def remove(self):
+        """
+        Closes the index and removes it from disk
+        """
+        self._db.rollback()
+        self._db.close()
+        if self._dry_run:
+            return
+        if os.path.exists(self._index_pathname):
+            os.unlink(self._index_pathname)
+            
+    def get_change_token(self):
+        """
+        Returns the changes feed token recorded by the last successful run (or None)
+        """
+        return self._get_state(u'change_token')
+    
+    def set_change_token(self, change_token):
+        """
+        Records the changes feed token to resume from on the next run and commits
+        """
+        self._set_state(u'change_token', change_token)
+        self.commit()
+        
+    def begin_scan(self):
+        """
+        Starts a full scan: every folder and file recorded from now on is 
+        marked as seen by this scan
+        """
+        self._scan_id = int(self._get_state(u'scan_id') or 0) + 1
+        self._set_state(u'scan_id', unicode(self._scan_id))
+        
+    def end_scan(self):
+        """
+        Completes a full scan by forgetting everything it did not see
+        """
+        scan_id = self._get_scan_id()
+        self._db.execute('DELETE FROM folders WHERE scan_id != ?', (scan_id,))
+        self._db.execute('DELETE FROM files WHERE scan_id != ?', (scan_id,))
+        self.commit()
+        
+    def get_folder_path(self, folder_id):
+        """
+        Returns the relative local path of a folder (or None if unknown)
+        """
+        if folder_id == u'root':
+            return u''
+        row = self._db.execute('SELECT path FROM folders WHERE id = ?', 
+                               (folder_id,)).fetchone()
+        return row[0] if row else None
+        
+    def set_folder_path(self, folder_id, relative_path):
+        """
+        Records the relative local path of a folder
+        """
+        self._db.execute('INSERT OR REPLACE INTO folders (id, path, scan_id) VALUES (?, ?, ?)', 
+                         (folder_id, relative_path, self._get_scan_id()))
+        self._wrote()
+        
+    def remove_folder(self, folder_id):
+        """
+        Forgets a folder and everything recorded beneath it
+        """
+        relative_path = self.get_folder_path(folder_id)
+        if relative_path is None:
+            return
+        self._db.execute('DELETE FROM folders WHERE id = ?', (folder_id,))
+        (lower, upper) = self._prefix_range(relative_path)
+        self._db.execute('DELETE FROM folders WHERE path >= ? AND path < ?', (lower, upper))
+        self._db.execute('DELETE FROM files WHERE path >= ? AND path < ?', (lower, upper))
+        self._wrote()
+        
+    def rename_folder(self, old_relative_path, new_relative_path):
+        """
+        Updates every folder and file path recorded beneath a renamed folder
+        """
+        (lower, upper) = self._prefix_range(old_relative_path)
+        for table in ('folders', 'files'):
+            self._db.execute(
+                'UPDATE {0} SET path = ? || substr(path, ?) '
+                'WHERE path = ? OR (path >= ? AND path < ?)'.format(table),
+                (new_relative_path, len(old_relative_path) + 1, 
+                 old_relative_path, lower, upper))
+        self._wrote()
+        
+    def get_file_entry(self, file_id, relative_path):
+        """
+        Returns the IndexEntry of a file stored at a relative path (or None)
+        """
+        row = self._db.execute('SELECT ' + self._FILE_COLUMNS + ' FROM files '
+                               'WHERE id = ? AND path = ?', 
+                               (file_id, relative_path)).fetchone()
+        return IndexEntry(*row) if row else None
+    
+    def get_file_entries(self, file_id):
+        """
+        Returns the IndexEntry of every copy of a file, ordered by path
+        """
+        return [IndexEntry(*row) for row in 
+                self._db.execute('SELECT ' + self._FILE_COLUMNS + ' FROM files '
+                                 'WHERE id = ? ORDER BY path', (file_id,))]
+        
+    def iter_file_entries(self):
+        """
+        Iterates over the IndexEntry of every stored file, ordered by path
+        """
+        for row in self._db.execute('SELECT ' + self._FILE_COLUMNS + ' FROM files ORDER BY path'):
+            yield IndexEntry(*row)
+            
+    def get_file_paths(self, file_id):
+        """
+        Returns the list of relative local paths where a file is stored
+        """
+        return [row[0] for row in 
+                self._db.execute('SELECT path FROM files WHERE id = ? ORDER BY path', 
+                                 (file_id,))]
+        
+    def find_paths_by_checksum(self, md5_checksum, size):
+        """
+        Returns the relative local paths of every stored file with the given content
+        """
+        return [row[0] for row in 
+                self._db.execute('SELECT path FROM files WHERE md5_checksum = ? AND size = ?', 
+                                 (md5_checksum, size))]
+        
+    def find_paths_by_export(self, file_id, version, export_format):
+        """
+        Returns the relative local paths of every stored export of a 
+        version of a file to a format
+        """
+        return [row[0] for row in 
+                self._db.execute('SELECT path FROM files '
+                                 'WHERE id = ? AND version = ? AND export_format = ?', 
+                                 (file_id, version, export_format))]
+        
+    def is_file_current(self, file_id, relative_path, modified_date, export_format, 
+                        md5_checksum=None, version=None):
+        """
+        Determines if the file stored at a relative path matches the Drive file
+        
+        The export formats must match.  Then the checksums are compared when
+        md5_checksum is given and one was recorded; otherwise the file is 
+        current if its Drive version or its modification date is unchanged
+        """
+        entry = self.get_file_entry(file_id, relative_path)
+        return entry is not None and self.is_entry_current(entry, modified_date, 
+                                                           export_format, md5_checksum,
+                                                           version)
+    
+    def is_entry_current(self, entry, modified_date, export_format, md5_checksum=None, 
+                         version=None):
+        """
+        Determines if an IndexEntry matches the Drive file, as is_file_current
+        """
+        if entry.export_format != export_format:
+            return False
+        if md5_checksum and entry.md5_checksum:
+            return entry.md5_checksum == md5_checksum
+        if version is not None and entry.version == version:
+            return True
+        return entry.modified_date == modified_date
+    
+    def record_file(self, file_id, relative_path, modified_date, 
+                    md5_checksum, size, export_format, version=None):
+        """
+        Records that a file is stored at a relative path
+        """
+        self._db.execute('INSERT OR REPLACE INTO files (' + self._FILE_COLUMNS + ', scan_id) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', 
+                         (file_id, relative_path, modified_date, md5_checksum, 
+                          size, export_format, version, self._get_scan_id()))
+        self._wrote()
+        
+    def move_file(self, file_id, old_relative_path, new_relative_path):
+        """
+        Records that a stored file was moved to a new relative path
+        """
+        self._db.execute('DELETE FROM files WHERE path = ? AND id != ?', 
+                         (new_relative_path, file_id))
+        self._db.execute('UPDATE files SET path = ? WHERE id = ? AND path = ?', 
+                         (new_relative_path, file_id, old_relative_path))
+        self._wrote()
+        
+    def remove_file_path(self, file_id, relative_path):
+        """
+        Forgets a single stored copy of a file
+        """
+        self._db.execute('DELETE FROM files WHERE id = ? AND path = ?', 
+                         (file_id, relative_path))
+        self._wrote()
+        
+    def remove_file(self, file_id):
+        """
+        Forgets every stored copy of a file
+        """
+        self._db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        self._wrote()
+        
+    def _get_state(self, key):
+        """
+        Returns a state value (or None)
+        """
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_state(self, key, value):
+        """
+        Sets a state value
+        """
+        self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+        self._wrote()
+        
+    def _get_scan_id(self):
+        """
+        Returns the id of the current (or most recent) full scan
+        """
+        if not hasattr(self, '_scan_id'):
+            self._scan_id = int(self._get_state(u'scan_id') or 0)
+        return self._scan_id
+    
+    def _wrote(self):
+        """
+        Commits periodically so that an interrupted run keeps most of its work
+        """
+        self._pending_writes += 1
+        if self._pending_writes >= self._COMMIT_INTERVAL:
+            self.commit()
+        
+    def _open_copy(self):
+        """
+        Opens an in-memory copy of the index file, which is attached read-only
+        """
+        self._db = sqlite3.connect(':memory:')
+        self._db.executescript(self._SCHEMA)
+        if not os.path.exists(self._index_pathname):
+            return
+        self._db.execute('ATTACH DATABASE ? AS disk', (self._get_read_only_name(),))
+        for table in ('state', 'folders', 'files'):
+            # NOTE: an index created by an older version lacks the newer columns
+            disk_columns = set(row[1] for row in 
+                               self._db.execute('PRAGMA disk.table_info({0})'.format(table)))
+            columns = ', '.join(row[1] for row in self._db.execute('PRAGMA table_info({0})'.format(table))
+                                if row[1] in disk_columns)
+            if columns:
+                self._db.execute('INSERT INTO main.{0} ({1}) SELECT {1} FROM disk.{0}'.format(
+                    table, columns))
+        self._db.commit()
+        self._db.execute('DETACH DATABASE disk')
+        
+    def _get_read_only_name(self):
+        """
+        Returns the name to attach the index file by: a read-only URI where 
+        SQLite accepts them, otherwise its path (which is then only read)
+        """
+        compile_options = [row[0] for row in self._db.execute('PRAGMA compile_options')]
+        if not any(option.startswith('USE_URI') for option in compile_options):
+            return self._index_pathname
+        return 'file:{0}?mode=ro'.format(urllib.pathname2url(os.path.abspath(self._index_pathname)))
+        
+    def _upgrade_schema(self):
+        """
+        Adds the columns introduced since an existing index was created
+        """
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(files)')]
+        if u'version' not in columns:
+            self._db.execute('ALTER TABLE files ADD COLUMN version INTEGER')
+        
+    def _prefix_range(self, relative_path):
+        """
+        Returns the range of paths strictly beneath a folder, usable by the path index
+        """
+        prefix = relative_path + os.path.sep
+        return (prefix, relative_path + unichr(ord(os.path.sep) + 1))
+
+    _COMMIT_INTERVAL = 500
+    _FILE_COLUMNS = 'id, path, modified_date, md5_checksum, size, export_format, version'
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS folders (
+            id TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            scan_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS folders_by_path ON folders (path);
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            modified_date TEXT,
+            md5_checksum TEXT,
+            size INTEGER,
+            export_format TEXT,
+            version INTEGER,
+            scan_id INTEGER,
+            PRIMARY KEY (id, path)
+        );
+        CREATE INDEX IF NOT EXISTS files_by_path ON files (path);
+        CREATE INDEX IF NOT EXISTS files_by_checksum ON files (md5_checksum, size);
+    """
@@ -0,0 +1,149 @@
+import logging
+import os
+import sqlite3
+import threading
+
+class JournalError(Exception):
+    """
+    Exception class for all run journal operations
+    """
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
+class RunJournal:
+    """
+    Journal of the downloads in flight, so that an interrupted run can 
+    resume partially transferred files instead of fetching them again
+    
+    Each partial download records the temporary file it is written to, the 
+    Drive revision it belongs to and how many bytes are safely on disk.
+    Completed downloads are recorded (and committed) in the metadata index,
+    so a restarted run skips them.  The journal is shared by the download 
+    workers and is safe to use from several threads.  In dry run mode, the
+    journal is copied into memory and the file is only read (and never 
+    created).
+    """
+    def __init__(self, journal_pathname, dry_run):
+        self._journal_pathname = journal_pathname
+        self._dry_run = dry_run
+        self._logger = logging.getLogger('drive_backup.backup.RunJournal')
+        self._lock = threading.Lock()
+        try:
+            if self._dry_run:
+                self._open_copy()
+            else:
+                self._db = sqlite3.connect(self._journal_pathname, check_same_thread=False)
+                self._db.executescript(self._SCHEMA)
+        except sqlite3.Error as e:
+            raise JournalError('Unable to open run journal {0}: {1}'.format(journal_pathname, e))
+        
+    def close(self):
+        """
+        Closes the journal
+        """
+        with self._lock:
+            self._db.close()
+            
+    def remove(self):
+        """
+        Closes the journal and removes it from disk
+        """
+        self.close()
+        if self._dry_run:
+            return
+        if os.path.exists(self._journal_pathname):
+            os.unlink(self._journal_pathname)
+            
+    def begin_run(self):
+        """
+        Starts a new run, reporting if the previous one was interrupted
+        """
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*), SUM(offset) FROM partial').fetchone()
+            if row[0]:
+                self._logger.info('Resuming {0} interrupted download(s) ({1} bytes already transferred)'.format(row[0], row[1]))
+            self._run_id = self._db.execute('SELECT COALESCE(MAX(run_id), 0) + 1 FROM partial').fetchone()[0]
+        
+    def end_run(self):
+        """
+        Completes a successful run by discarding partial downloads that were 
+        not resumed by it (i.e. whose files changed or no longer exist)
+        """
+        with self._lock:
+            stale = self._db.execute('SELECT temp_path FROM partial WHERE run_id < ?', 
+                                     (self._run_id,)).fetchall()
+            if self._dry_run:
+                return
+            for (temp_path,) in stale:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            self._db.execute('DELETE FROM partial WHERE run_id < ?', (self._run_id,))
+            self._db.commit()
+        
+    def get_partial(self, local_path, revision):
+        """
+        Returns a (temp_path, offset) tuple describing a partial download of 
+        the given revision of a file (or None if there is nothing to resume)
+        """
+        with self._lock:
+            row = self._db.execute('SELECT temp_path, offset, revision FROM partial WHERE path = ?', 
+                                   (local_path,)).fetchone()
+        if row is None or row[2] != revision or not os.path.exists(row[0]):
+            return None
+        return (row[0], row[1])
+    
+    def update_partial(self, local_path, revision, temp_path, offset):
+        """
+        Records that offset bytes of a download are safely on disk in temp_path
+        """
+        if self._dry_run:
+            return
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO partial (path, revision, temp_path, offset, run_id) '
+                             'VALUES (?, ?, ?, ?, ?)', 
+                             (local_path, revision, temp_path, offset, self._get_run_id()))
+            self._db.commit()
+            
+    def remove_partial(self, local_path):
+        """
+        Forgets the partial download of a file
+        """
+        if self._dry_run:
+            return
+        with self._lock:
+            self._db.execute('DELETE FROM partial WHERE path = ?', (local_path,))
+            self._db.commit()
+            
+    def _open_copy(self):
+        """
+        Opens an in-memory copy of the journal file, which is only read
+        """
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.executescript(self._SCHEMA)
+        if not os.path.exists(self._journal_pathname):
+            return
+        self._db.execute('ATTACH DATABASE ? AS disk', (self._journal_pathname,))
+        self._db.execute('INSERT INTO main.partial SELECT * FROM disk.partial')
+        self._db.commit()
+        self._db.execute('DETACH DATABASE disk')
+        
+    def _get_run_id(self):
+        """
+        Returns the id of the current run
+        """
+        if not hasattr(self, '_run_id'):
+            self._run_id = 1
+        return self._run_id
+            
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS partial (
+            path TEXT PRIMARY KEY,
+            revision TEXT NOT NULL,
+            temp_path TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            run_id INTEGER NOT NULL
+        );
+    """
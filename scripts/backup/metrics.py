@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+class RunMetrics:
+    """
+    Timing and throughput metrics of a backup run
+
+    Phases (listing, planning, downloads, ...) are timed with phase(),
+    Drive requests are recorded by the RequestThrottle and file outcomes by
+    the syncs and the download pool.  Recording is safe from any thread.
+    At the end of a run the metrics are written as a JSON report and as a
+    Prometheus textfile collector file, labelled with the account's name 
+    when several accounts are backed up.
+    """
+    def __init__(self, account=None):
+        self._account = account
+        self._logger = logging.getLogger('drive_backup.backup.RunMetrics')
+        self._lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        """
+        Starts the metrics of a new run (e.g. between runs of the watch command)
+        """
+        with self._lock:
+            self._start_time = time.time()
+            self._end_time = None
+            self._success = None
+            self._phases = OrderedDict()
+            self._request_count = 0
+            self._request_time = 0.0
+            self._max_request_time = 0.0
+            self._bytes_downloaded = 0
+            self._file_counts = OrderedDict((state, 0) for state in self._FILE_STATES)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing a phase of the run (repeated phases add up)
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + time.time() - start_time
+
+    def record_request(self, latency):
+        """
+        Records a Drive request attempt and its latency in seconds
+        """
+        with self._lock:
+            self._request_count += 1
+            self._request_time += latency
+            self._max_request_time = max(self._max_request_time, latency)
+
+    def count_bytes(self, byte_count):
+        """
+        Counts downloaded content bytes
+        """
+        with self._lock:
+            self._bytes_downloaded += byte_count
+
+    def count_file(self, state):
+        """
+        Counts a file by outcome: downloaded, linked, skipped or failed
+        """
+        with self._lock:
+            self._file_counts[state] += 1
+
+    def finish(self, success):
+        """
+        Marks the end of the run
+        """
+        self._end_time = time.time()
+        self._success = success
+
+    def get_report(self):
+        """
+        Returns the metrics as a dictionary
+        """
+        with self._lock:
+            end_time = self._end_time or time.time()
+            duration = end_time - self._start_time
+            download_time = self._phases.get(u'downloads', duration)
+            return OrderedDict([
+                (u'account', self._account),
+                (u'start_time', self._start_time),
+                (u'end_time', end_time),
+                (u'success', self._success),
+                (u'duration', duration),
+                (u'phases', OrderedDict(self._phases)),
+                (u'requests', OrderedDict([
+                    (u'count', self._request_count),
+                    (u'total_latency', self._request_time),
+                    (u'mean_latency', self._request_time / self._request_count
+                                      if self._request_count else 0.0),
+                    (u'max_latency', self._max_request_time)])),
+                (u'bytes_downloaded', self._bytes_downloaded),
+                (u'throughput', self._bytes_downloaded / download_time if download_time else 0.0),
+                (u'files', OrderedDict(self._file_counts))])
+
+    def log_summary(self):
+        """
+        Logs the totals and the time taken by each phase
+        """
+        report = self.get_report()
+        self._logger.info('Run took {0:.1f}s: {1}, {2} request(s), {3} byte(s) at {4:.0f} B/s'.format(
+            report[u'duration'],
+            ', '.join('{0} {1}'.format(count, state) for (state, count) in report[u'files'].iteritems()),
+            report[u'requests'][u'count'], report[u'bytes_downloaded'], report[u'throughput']))
+        for (name, duration) in report[u'phases'].iteritems():
+            self._logger.info('  {0}: {1:.1f}s'.format(name, duration))
+
+    def write_report(self, report_pathname):
+        """
+        Writes the metrics as JSON
+        """
+        self._write_atomically(report_pathname, json.dumps(self.get_report(), indent=2))
+
+    def write_textfile(self, textfile_pathname):
+        """
+        Writes the metrics in the Prometheus text exposition format, for the
+        node exporter's textfile collector
+        """
+        report = self.get_report()
+        samples = [
+            ('last_run_timestamp_seconds', 'Time the last run finished',
+             [((), report[u'end_time'])]),
+            ('last_run_success', 'Whether the last run succeeded',
+             [((), 1 if report[u'success'] else 0)]),
+            ('run_duration_seconds', 'Duration of the last run',
+             [((), report[u'duration'])]),
+            ('phase_duration_seconds', 'Duration of each phase of the last run',
+             [((('phase', name),), duration)
+              for (name, duration) in report[u'phases'].iteritems()]),
+            ('requests', 'Drive requests made by the last run',
+             [((), report[u'requests'][u'count'])]),
+            ('request_latency_seconds_sum', 'Total latency of the Drive requests of the last run',
+             [((), report[u'requests'][u'total_latency'])]),
+            ('request_latency_seconds_max', 'Slowest Drive request of the last run',
+             [((), report[u'requests'][u'max_latency'])]),
+            ('downloaded_bytes', 'Bytes downloaded by the last run',
+             [((), report[u'bytes_downloaded'])]),
+            ('throughput_bytes_per_second', 'Download throughput of the last run',
+             [((), report[u'throughput'])]),
+            ('files', 'Files handled by the last run by outcome',
+             [((('state', state),), count)
+              for (state, count) in report[u'files'].iteritems()])]
+
+        common_labels = (('account', self._account),) if self._account else ()
+        lines = []
+        for (name, description, values) in samples:
+            metric_name = self._METRIC_PREFIX + name
+            lines.append('# HELP {0} {1}'.format(metric_name, description))
+            lines.append('# TYPE {0} gauge'.format(metric_name))
+            for (labels, value) in values:
+                labels = common_labels + labels
+                label_text = ('{' + ','.join('{0}="{1}"'.format(key, label_value) 
+                                             for (key, label_value) in labels) + '}'
+                              if labels else '')
+                lines.append('{0}{1} {2}'.format(metric_name, label_text, repr(float(value))))
+        self._write_atomically(textfile_pathname, '\n'.join(lines) + '\n')
+
+    def _write_atomically(self, pathname, content):
+        """
+        Writes a file through a temporary file so readers never see it partially written
+        """
+        temp_pathname = pathname + self._TEMP_SUFFIX
+        with open(temp_pathname, 'wt') as fp:
+            fp.write(content)
+        os.rename(temp_pathname, pathname)
+
+    _FILE_STATES = (u'downloaded', u'linked', u'skipped', u'failed')
+    _METRIC_PREFIX = 'drive_backup_'
+    _TEMP_SUFFIX = '.tmp'
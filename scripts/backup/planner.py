@@ -0,0 +1,286 @@
+import logging
+import math
+import os
+
+from backup.content import ContentMatcher
+
+class Plan:
+    """
+    Operations that bring local storage in line with Google Drive
+    
+    Operations are listed in the order they are applied:
+        folder_renames - (folder id, old path, new path) of renamed or moved folders
+        new_folders - paths of folders to create, parents first
+        file_renames - (DriveFile, old path, new path) of renamed or moved files
+        deletions - paths of local files and folders that no longer exist in Drive
+        downloads - (DriveFile, path) of files to download
+        unchanged - (DriveFile, path) of files already up to date
+        
+    folder_paths lists the (folder id, path) of every folder in the tree and
+    duplicates the downloads expected to be satisfied by linking to content
+    that is already stored.
+    """
+    def __init__(self):
+        self.folder_renames = []
+        self.new_folders = []
+        self.file_renames = []
+        self.deletions = []
+        self.downloads = []
+        self.unchanged = []
+        self.folder_paths = []
+        self.duplicates = set()
+        
+    def describe(self, listing_requests, chunk_size):
+        """
+        Returns the plan as a list of human readable lines, followed by the 
+        expected number of API requests and bytes to transfer
+        
+        listing_requests - number of API requests the listing took
+        chunk_size - number of bytes fetched per download request
+        """
+        lines = []
+        for (_, old_path, new_path) in self.folder_renames:
+            lines.append('rename folder {0} -> {1}'.format(old_path, new_path))
+        for relative_path in self.new_folders:
+            lines.append('mkdir {0}'.format(relative_path))
+        for (_, old_path, new_path) in self.file_renames:
+            lines.append('rename {0} -> {1}'.format(old_path, new_path))
+        for relative_path in self.deletions:
+            lines.append('delete {0}'.format(relative_path))
+            
+        download_requests = 0
+        download_bytes = 0
+        exports = 0
+        for (file_obj, relative_path) in self.downloads:
+            if relative_path in self.duplicates:
+                lines.append('link {0}'.format(relative_path))
+            elif file_obj.file_size is not None:
+                lines.append('download {0} ({1} bytes)'.format(relative_path, file_obj.file_size))
+                download_requests += max(1, int(math.ceil(float(file_obj.file_size) / chunk_size)))
+                download_bytes += file_obj.file_size
+            else:
+                lines.append('export {0}'.format(relative_path))
+                download_requests += 1
+                exports += 1
+                
+        lines.append('{0} folder rename(s), {1} new folder(s), {2} file rename(s), '
+                     '{3} deletion(s), {4} download(s), {5} unchanged file(s)'.format(
+                        len(self.folder_renames), len(self.new_folders), 
+                        len(self.file_renames), len(self.deletions), 
+                        len(self.downloads), len(self.unchanged)))
+        lines.append('API requests: {0} made for listing, {1} expected for downloads'.format(
+                        listing_requests, download_requests))
+        lines.append('Bytes to download: {0} (plus {1} export(s) of unknown size)'.format(
+                        download_bytes, exports))
+        return lines
+
+
+class MirrorPlanner:
+    """
+    Computes the Plan that mirrors the Drive tree into local storage
+    
+    The local tree is read with a single walk and the metadata index with 
+    one lookup per file, then remote and local are diffed in memory.
+    
+    Planning happens in stages so that a plan can also be applied while the
+    drive is still being listed: plan_folders once the folder tree is known,
+    plan_file for each file as it is listed and plan_deletions once the 
+    listing is complete.  plan runs every stage at once.
+    """
+    def __init__(self, config, drive_download, storage, index, exclusions, 
+                 compare_checksums, ignore_modtime):
+        self._drive_download = drive_download
+        self._storage = storage
+        self._index = index
+        self._exclusions = exclusions
+        self._content = ContentMatcher(config, drive_download, index, compare_checksums)
+        self._ignore_modtime = ignore_modtime
+        self._logger = logging.getLogger('drive_backup.backup.MirrorPlanner')
+        
+        self._folder_tree = None
+        self._local_files = None
+        self._unclaimed_files = None
+        self._deleted_folders = []
+        self._renames = []
+        self._seen_content = set()
+        
+    def plan(self, folder_tree, drive_files):
+        """
+        Diffs a folder tree and an iterable of DriveFile records against storage
+        
+        Returns the Plan
+        """
+        plan = self.plan_folders(folder_tree)
+        for curr_file in drive_files:
+            self.plan_file(curr_file, plan)
+        self.plan_deletions(plan)
+        return plan
+    
+    def plan_folders(self, folder_tree):
+        """
+        Reads storage and diffs the folder tree against it
+        
+        Returns a Plan of the folder renames, new folders and deleted folders
+        """
+        plan = Plan()
+        (local_folders, local_files) = self._storage.list_tree()
+        self._folder_tree = folder_tree
+        
+        # folders: renames first (parents before children), then creations
+        for folder_id in folder_tree.iterfolders():
+            new_path = folder_tree.get_path(folder_id)
+            plan.folder_paths.append((folder_id, new_path))
+            old_path = self._index.get_folder_path(folder_id)
+            if old_path is None:
+                continue
+            old_path = self._translate(old_path, self._renames)
+            if (old_path != new_path and old_path in local_folders and 
+                new_path not in local_folders):
+                plan.folder_renames.append((folder_id, old_path, new_path))
+                self._renames.append((old_path, new_path))
+                local_folders = self._move_paths(local_folders, old_path, new_path)
+                local_files = self._move_paths(local_files, old_path, new_path)
+        for (_, relative_path) in plan.folder_paths:
+            if relative_path not in local_folders:
+                plan.new_folders.append(relative_path)
+                
+        # local folders missing from the tree are deleted with their contents
+        tree_paths = set(relative_path for (_, relative_path) in plan.folder_paths)
+        for relative_path in sorted(local_folders - tree_paths):
+            if relative_path and not self._is_beneath(relative_path, self._deleted_folders):
+                plan.deletions.append(relative_path)
+                self._deleted_folders.append(relative_path)
+                
+        # NOTE: files are claimed as they are listed, what is left unclaimed
+        # at the end is no longer in the drive
+        self._local_files = local_files
+        self._unclaimed_files = set(local_files)
+        return plan
+    
+    def mark_folders_applied(self):
+        """
+        Notes that the folder renames planned so far were applied to the 
+        index, so that its paths are no longer translated
+        """
+        self._renames = []
+    
+    def plan_file(self, file_obj, plan):
+        """
+        Adds the renames, downloads and unchanged copies of a listed 
+        DriveFile record to a Plan
+        """
+        # determine where the file should be stored
+        wanted_paths = []
+        parent_ids = self._drive_download.get_parent_ids(file_obj)
+        for curr_folder_id in self._folder_tree.get_file_parents(parent_ids):
+            
+            # determine if the current file should be skipped due to 
+            # configured exclusions
+            relative_pathname = os.path.sep.join(
+                [ self._folder_tree.get_path(curr_folder_id), 
+                 self._drive_download.get_filename(file_obj)])
+            if self._exclusions.is_excluded_file(relative_pathname):
+                self._logger.debug('Excluding {0}'.format(relative_pathname))
+                continue
+            
+            if relative_pathname[0] == '/':
+                relative_pathname = relative_pathname[1:]
+            wanted_paths.append(relative_pathname)
+        if not wanted_paths:
+            return
+        
+        # claimed paths are never reused as the old copy of a renamed file
+        for relative_pathname in wanted_paths:
+            self._unclaimed_files.discard(relative_pathname)
+        entries = dict((self._translate(entry.path, self._renames), entry) 
+                       for entry in self._index.get_file_entries(file_obj.id))
+        
+        # renames, downloads and unchanged
+        for relative_pathname in wanted_paths:
+            if self._is_unchanged(file_obj, relative_pathname, entries):
+                plan.unchanged.append((file_obj, relative_pathname))
+                continue
+            
+            # renamed or moved files are moved locally instead of downloaded again
+            old_path = self._find_stored_copy(file_obj, entries, wanted_paths)
+            if old_path is not None:
+                plan.file_renames.append((file_obj, old_path, relative_pathname))
+                self._local_files.discard(old_path)
+                self._unclaimed_files.discard(old_path)
+                self._local_files.add(relative_pathname)
+                plan.unchanged.append((file_obj, relative_pathname))
+                continue
+            
+            plan.downloads.append((file_obj, relative_pathname))
+            content_key = self._content.get_content_key(file_obj)
+            if content_key:
+                stored_paths = self._content.find_content_paths(file_obj)
+                if (content_key in self._seen_content or 
+                    any(path != relative_pathname for path in stored_paths)):
+                    plan.duplicates.add(relative_pathname)
+                self._seen_content.add(content_key)
+                
+    def plan_deletions(self, plan):
+        """
+        Adds the stored files that no listed file claimed to a Plan
+        """
+        for relative_path in sorted(self._unclaimed_files):
+            if not self._is_beneath(relative_path, self._deleted_folders):
+                plan.deletions.append(relative_path)
+        self._unclaimed_files = set()
+    
+    def _is_unchanged(self, file_obj, relative_path, entries):
+        """
+        Determines if the copy stored at a relative path is up to date
+        """
+        if self._ignore_modtime or relative_path not in self._local_files:
+            return False
+        entry = entries.get(relative_path)
+        if entry is not None:
+            return self._content.is_entry_current(entry, file_obj)
+        if entries:
+            return False
+        
+        # files stored before the index existed fall back to the local copy
+        md5_checksum = self._content.get_checksum(file_obj)
+        if md5_checksum:
+            return self._storage.compute_checksum(relative_path) == md5_checksum
+        return not self._content.is_drive_file_newer(file_obj, self._storage.get_local_path(relative_path))
+    
+    def _find_stored_copy(self, file_obj, entries, wanted_paths):
+        """
+        Returns the path of an up to date stored copy of a file that is no 
+        longer wanted where it is, i.e. the file was renamed or moved (or None)
+        """
+        if self._ignore_modtime:
+            return None
+        for (old_path, entry) in sorted(entries.iteritems()):
+            if (old_path not in wanted_paths and old_path in self._unclaimed_files and 
+                self._content.is_entry_current(entry, file_obj)):
+                return old_path
+        return None
+    
+    def _translate(self, relative_path, renames):
+        """
+        Returns where a path ends up after the planned folder renames
+        """
+        for (old_path, new_path) in renames:
+            if self._is_beneath(relative_path, [old_path]):
+                relative_path = new_path + relative_path[len(old_path):]
+        return relative_path
+    
+    def _move_paths(self, relative_paths, old_path, new_path):
+        """
+        Returns a set of paths with everything beneath old_path moved to new_path
+        """
+        return set(self._translate(relative_path, [(old_path, new_path)]) 
+                   for relative_path in relative_paths)
+    
+    def _is_beneath(self, relative_path, folder_paths):
+        """
+        Determines if a path is one of the folders or is inside one of them
+        """
+        for folder_path in folder_paths:
+            if relative_path == folder_path or relative_path.startswith(folder_path + os.path.sep):
+                return True
+        return False
@@ -0,0 +1,169 @@
+import logging
+import multiprocessing
+import time
+
+class DownloadScheduler:
+    """
+    Orders pending downloads by the configured policy
+
+        listing - in the order files are listed or changed (the default)
+        recent_first - most recently modified files first
+        smallest_first - smallest files first; exports, whose size is only
+                         known once downloaded, count as small
+
+    Downloads wait in the download pool's backlog, so the order applies to
+    the files pending at any one time: all of them for a typical changes
+    feed, the next backlog files of a full scan's listing.
+    """
+    def __init__(self, config, drive_download):
+        scheduling_config = config[u'backup'].get(u'scheduling', {})
+        self._order = scheduling_config.get(u'order', self._ORDER_LISTING)
+        self._backlog = scheduling_config.get(u'backlog', self._DEFAULT_BACKLOG)
+        self._drive_download = drive_download
+        if self._order not in self._ORDERS:
+            raise ValueError('Unknown download order {0} (expected one of: {1})'.format(
+                self._order, ', '.join(self._ORDERS)))
+
+    def get_priority(self, file_obj):
+        """
+        Returns the sort key of a DriveFile record: lower keys download first
+        """
+        if self._order == self._ORDER_RECENT_FIRST:
+            return -self._drive_download.get_modification_time(file_obj)
+        elif self._order == self._ORDER_SMALLEST_FIRST:
+            return file_obj.file_size or 0
+        return 0
+
+    def get_backlog(self):
+        """
+        Returns the number of downloads that may wait to be scheduled
+        """
+        return self._backlog
+
+    _ORDER_LISTING = 'listing'
+    _ORDER_RECENT_FIRST = 'recent_first'
+    _ORDER_SMALLEST_FIRST = 'smallest_first'
+    _ORDERS = (_ORDER_LISTING, _ORDER_RECENT_FIRST, _ORDER_SMALLEST_FIRST)
+    _DEFAULT_BACKLOG = 1000
+
+
+class RequestRateLimit:
+    """
+    Caps the Drive requests of every account backed up at once 
+    (backup.throttle.global_requests_per_second)
+    
+    Each account's RequestThrottle still adapts its own rate to the 
+    throttling Drive reports; this limit is shared by the threads and by the 
+    account processes started after it was created, so accounts sharing one
+    OAuth client stay within the client's quota together.
+    """
+    def __init__(self, config):
+        self._rate = config[u'backup'].get(u'throttle', {}).get(u'global_requests_per_second')
+        self._next_time = multiprocessing.Value('d', 0.0)
+        
+    def acquire(self):
+        """
+        Waits until another request may be sent
+        """
+        if not self._rate:
+            return
+        with self._next_time.get_lock():
+            now = time.time()
+            send_time = max(now, self._next_time.value)
+            self._next_time.value = send_time + 1.0 / self._rate
+        if send_time > now:
+            time.sleep(send_time - now)
+
+
+class BandwidthLimiter:
+    """
+    Caps the download bandwidth shared by every download worker
+
+    The cap (bytes_per_second) can be replaced during time-of-day windows,
+    e.g. to keep backups from saturating the uplink during business hours:
+
+        "bandwidth" : {
+            "bytes_per_second" : null,
+            "windows" : [ { "days" : ["mon", "tue", "wed", "thu", "fri"],
+                            "start" : "08:00", "end" : "18:00",
+                            "bytes_per_second" : 1048576 } ]
+        }
+
+    Times are local and a window ending before it starts runs past midnight.
+    Windows without days apply every day and the first matching window
+    wins.  A cap of null (or 0) leaves downloads unlimited.
+
+    Bytes are charged once received, so the cap holds on average rather
+    than within each download request.  The cap is shared by every thread 
+    and by the account processes started after the limiter was created.
+    """
+    def __init__(self, config):
+        bandwidth_config = config[u'backup'].get(u'scheduling', {}).get(u'bandwidth', {})
+        self._default_rate = bandwidth_config.get(u'bytes_per_second')
+        self._windows = [self._parse_window(window)
+                         for window in bandwidth_config.get(u'windows', [])]
+        self._logger = logging.getLogger('drive_backup.backup.BandwidthLimiter')
+
+        # NOTE: kept in shared memory so that forked processes share the cap,
+        # the rate the clock runs at (0 if unlimited) is guarded by its lock
+        self._available_time = multiprocessing.Value('d', 0.0)
+        self._shared_rate = multiprocessing.Value('d', self._UNSET_RATE, lock=False)
+
+    def get_rate(self, now=None):
+        """
+        Returns the cap in bytes per second at a time (or None if unlimited)
+        """
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for (days, start, end, rate) in self._windows:
+            if start <= end:
+                applies = start <= minute < end and local_time.tm_wday in days
+            elif minute >= start:
+                applies = local_time.tm_wday in days
+            else:
+                # the part of an overnight window after midnight
+                applies = minute < end and (local_time.tm_wday - 1) % 7 in days
+            if applies:
+                return rate or None
+        return self._default_rate or None
+
+    def consume(self, byte_count):
+        """
+        Charges received bytes against the cap, waiting as long as the
+        bytes received so far are ahead of it
+        """
+        now = time.time()
+        rate = self.get_rate(now)
+        with self._available_time.get_lock():
+            # NOTE: only the first process to see a new cap restarts the clock,
+            # so the bytes charged by the others since are kept
+            if (rate or 0.0) != self._shared_rate.value:
+                self._logger.debug('Download bandwidth cap is now {0} bytes/s'.format(
+                    rate or 'unlimited'))
+                self._shared_rate.value = rate or 0.0
+                self._available_time.value = now
+            if rate is None:
+                return
+            self._available_time.value = (max(self._available_time.value, now) + 
+                                          float(byte_count) / rate)
+            delay = self._available_time.value - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _parse_window(self, window):
+        """
+        Returns a (days, start minute, end minute, rate) tuple of a configured window
+        """
+        days = set(self._DAYS.index(day.lower()[:3]) for day in window.get(u'days', self._DAYS))
+        return (days, self._parse_time(window[u'start']), self._parse_time(window[u'end']),
+                window.get(u'bytes_per_second'))
+
+    def _parse_time(self, time_of_day):
+        """
+        Returns the minute of the day of an HH:MM time
+        """
+        (hours, minutes) = time_of_day.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    _DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    _UNSET_RATE = -1.0
@@ -1,6 +1,10 @@
+import errno
+import fcntl
+import hashlib
 import logging
 import os
 import shutil
+import time
 
 class Storage:
     """
@@ -11,22 +15,14 @@ class Storage:
         self._logger = logging.getLogger('drive_backup.backup.Storage')
         self._dry_run = dry_run
         self._root_folder = self._config[u'backup'][u'storage_path']
-        self._all_folders = None
-        self._hierarchy = None
-
+        self._reflink_unsupported = False
         
+        snapshot_config = self._config[u'backup'].get(u'snapshots', {})
+        self._snapshots_enabled = snapshot_config.get(u'enabled', False)
+        self._snapshot_folder = snapshot_config.get(u'path')
+        self._snapshot_keep_last = snapshot_config.get(u'keep_last', self._DEFAULT_SNAPSHOT_KEEP_LAST)
+        self._snapshot_keep_days = snapshot_config.get(u'keep_days')
 
-    def _create_folder_hierarchy(self, curr_hierarchy, parent_path):
-        """
-        Recursive function to output the hierarchy
-        """
-        # output the current node
-        for curr_node in curr_hierarchy.iterkeys():
-            curr_path = parent_path + os.path.sep + self._all_folders[curr_node][u'name']
-            if not os.path.exists(curr_path):
-                self._logger.debug('Creating folder {0}'.format(curr_path))
-                os.mkdir(curr_path)
-            self._create_folder_hierarchy(curr_hierarchy[curr_node], curr_path)
 
     def erase(self):
         """
@@ -36,28 +32,360 @@ class Storage:
         if self._dry_run:
             return
         
-        if os.path.exists(self._root_folder):
-            for root, dirs, files in os.walk(self._root_folder):
-                for f in files:
-                    os.unlink(os.path.join(root, f))
-                for d in dirs:
-                    shutil.rmtree(os.path.join(root, d))            
+        storage_folders = [self._config[u'backup'][u'storage_path']]
+        if self._snapshots_enabled:
+            storage_folders.append(self._snapshot_folder)
+        for storage_folder in storage_folders:
+            if not os.path.isdir(storage_folder):
+                continue
+            # NOTE: each top level entry is removed whole, never descended into
+            for name in os.listdir(storage_folder):
+                curr_path = os.path.join(storage_folder, name)
+                if os.path.isdir(curr_path) and not os.path.islink(curr_path):
+                    shutil.rmtree(curr_path)
+                else:
+                    os.unlink(curr_path)
     
-    def prepare_storage(self, all_folders, folder_hierarchy):
+    def list_tree(self):
         """
-        Recreates the folder hierarchy
+        Walks the storage folder once
+        
+        Returns a tuple of sets with the relative paths of every (folder, file)
+        in storage.  Temporary files of downloads and links are left out.
         """
-        self._all_folders = all_folders
-        self._hierarchy = folder_hierarchy
-
+        folders = set()
+        files = set()
+        if not os.path.isdir(self._root_folder):
+            return (folders, files)
+        for (root, dirs, filenames) in os.walk(self._root_folder):
+            relative_root = os.path.relpath(root, self._root_folder)
+            if relative_root == os.curdir:
+                relative_root = ''
+            for d in dirs:
+                folders.add(os.path.join(relative_root, d))
+            for f in filenames:
+                if f.startswith('.') and f.endswith(self._TEMP_SUFFIXES):
+                    continue
+                files.add(os.path.join(relative_root, f))
+        return (folders, files)
+    
+    def create_folders(self, relative_paths):
+        """
+        Creates folders known to be missing, parents first
+        
+        NOTE: a missing folder may already have been created as the parent of
+        a folder moved into it
+        """
+        if self._dry_run:
+            return
         if not os.path.exists(self._root_folder):
             self._logger.debug('Creating root folder {0}'.format(self._root_folder))
-            os.mkdir(self._root_folder)
-        self._create_folder_hierarchy(self._hierarchy[u'root'], 
-                                      self._root_folder)
+            os.makedirs(self._root_folder)
+        for relative_path in relative_paths:
+            self._logger.debug('Creating folder {0}'.format(relative_path))
+            try:
+                os.mkdir(self.get_local_path(relative_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
 
+    def begin_snapshot(self):
+        """
+        Starts a run in a new point-in-time snapshot of the backup tree (when
+        snapshots are enabled)
+        
+        The snapshot starts as a hardlinked clone of the previous one, in 
+        the style of rsync --link-dest, so only files changed by the run use
+        new disk space.  Downloads replace files by renaming over them, which
+        never writes through a link into an older snapshot.  A snapshot left
+        incomplete by a failed run is continued instead.
+        """
+        if not self._snapshots_enabled:
+            return
+        
+        snapshot_names = self._list_snapshots()
+        current_name = self._get_current_snapshot()
+        if self._dry_run:
+            # NOTE: simulate against the latest snapshot without creating one
+            self.use_latest_snapshot()
+            return
+        
+        if snapshot_names and snapshot_names[-1] != current_name:
+            snapshot_name = snapshot_names[-1]
+            self._logger.info('Continuing incomplete snapshot {0}'.format(snapshot_name))
+        else:
+            snapshot_name = self._get_new_snapshot_name(snapshot_names)
+            if current_name:
+                source_folder = os.path.join(self._snapshot_folder, current_name)
+            else:
+                # the first snapshot starts from the plain mirror, if any
+                source_folder = self._root_folder
+            snapshot_path = os.path.join(self._snapshot_folder, snapshot_name)
+            self._logger.debug('Creating snapshot {0}'.format(snapshot_name))
+            if os.path.isdir(source_folder):
+                self._link_tree(source_folder, snapshot_path)
+            else:
+                os.makedirs(snapshot_path)
+        self._root_folder = os.path.join(self._snapshot_folder, snapshot_name)
+        
+    def use_latest_snapshot(self):
+        """
+        Points storage at the latest snapshot, which the index describes 
+        (when snapshots are enabled)
+        """
+        if not self._snapshots_enabled:
+            return
+        snapshot_names = self._list_snapshots()
+        if snapshot_names:
+            self._root_folder = os.path.join(self._snapshot_folder, snapshot_names[-1])
+        
+    def complete_snapshot(self):
+        """
+        Marks the snapshot of a successful run as the current one and prunes
+        snapshots that fall outside of the retention policy
+        """
+        if not self._snapshots_enabled or self._dry_run:
+            return
+        
+        # atomically repoint the 'current' link
+        snapshot_name = os.path.basename(self._root_folder)
+        current_link = os.path.join(self._snapshot_folder, self._CURRENT_SNAPSHOT)
+        temp_link = current_link + self._LINK_SUFFIX
+        if os.path.lexists(temp_link):
+            os.unlink(temp_link)
+        os.symlink(snapshot_name, temp_link)
+        os.rename(temp_link, current_link)
+        
+        self._prune_snapshots()
+        
     def get_root_folder(self):
         """
         Returns the storage path for a drive folder
         """
         return self._root_folder
+    
+    def get_local_path(self, relative_path):
+        """
+        Returns the absolute local path for a path relative to the storage root
+        """
+        return os.path.join(self._root_folder, relative_path)
+    
+    def compute_checksum(self, relative_path):
+        """
+        Returns the MD5 checksum of a stored file (or None if it does not exist)
+        """
+        local_path = self.get_local_path(relative_path)
+        if not os.path.isfile(local_path):
+            return None
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as fp:
+            for data in iter(lambda: fp.read(self._READ_SIZE), ''):
+                md5.update(data)
+        return md5.hexdigest()
+    
+    def store_duplicate(self, source_relative_path, relative_path, size, modification_time):
+        """
+        Stores a file whose content is already stored elsewhere without 
+        copying the data: as a reflink (copy-on-write clone) where the 
+        filesystem supports it, otherwise as a hardlink
+        
+        NOTE: hardlinked copies share a single modification time
+        
+        size - expected size of the content (None if unknown, e.g. an export)
+        
+        Returns True if the file was stored, False if the source is unusable
+        """
+        source_path = self.get_local_path(source_relative_path)
+        local_path = self.get_local_path(relative_path)
+        if not os.path.isfile(source_path):
+            return False
+        if size is not None and os.path.getsize(source_path) != size:
+            return False
+        self._logger.debug('Storing {0} as a duplicate of {1}'.format(relative_path, source_relative_path))
+        if self._dry_run:
+            return True
+        # NOTE: renaming a link over another link to the same file is a no-op
+        # that would leave the temporary link behind
+        if os.path.exists(local_path) and os.path.samefile(source_path, local_path):
+            return True
+
+        # the link is made next to the target and renamed into place so the 
+        # target is replaced atomically and never written through
+        temp_path = os.path.join(os.path.dirname(local_path), 
+                                 '.{0}{1}'.format(os.path.basename(local_path), self._LINK_SUFFIX))
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        try:
+            if self._reflink(source_path, temp_path):
+                os.utime(temp_path, (modification_time, modification_time))
+            else:
+                os.link(source_path, temp_path)
+        except OSError as e:
+            if e.errno not in self._LINK_UNSUPPORTED_ERRORS:
+                raise
+            return False
+        os.rename(temp_path, local_path)
+        return True
+    
+    def make_folder(self, relative_path):
+        """
+        Creates a folder (and any missing parents) in storage
+        """
+        local_path = self.get_local_path(relative_path)
+        if os.path.isdir(local_path):
+            return
+        self._logger.debug('Creating folder {0}'.format(local_path))
+        if self._dry_run:
+            return
+        os.makedirs(local_path)
+        
+    def move(self, old_relative_path, new_relative_path):
+        """
+        Renames a file or folder in storage
+        
+        Returns True if the item was moved, False if there was nothing to move
+        """
+        old_path = self.get_local_path(old_relative_path)
+        new_path = self.get_local_path(new_relative_path)
+        if not os.path.exists(old_path):
+            return False
+        self._logger.info('Moving {0} to {1}'.format(old_relative_path, new_relative_path))
+        if self._dry_run:
+            return True
+        parent_path = os.path.dirname(new_path)
+        if not os.path.isdir(parent_path):
+            os.makedirs(parent_path)
+        os.rename(old_path, new_path)
+        return True
+    
+    def remove(self, relative_path):
+        """
+        Removes a file or folder (including its contents) from storage
+        """
+        local_path = self.get_local_path(relative_path)
+        if not os.path.lexists(local_path):
+            return
+        self._logger.info('Removing {0}'.format(relative_path))
+        if self._dry_run:
+            return
+        if os.path.isdir(local_path) and not os.path.islink(local_path):
+            shutil.rmtree(local_path)
+        else:
+            os.unlink(local_path)
+
+    _READ_SIZE = 1024 * 1024
+    
+    def _reflink(self, source_path, target_path):
+        """
+        Clones a file with the FICLONE ioctl (btrfs, xfs, ...)
+        
+        Returns False (leaving no target behind) if the filesystem cannot clone
+        """
+        if self._reflink_unsupported:
+            return False
+        try:
+            with open(source_path, 'rb') as source_fp:
+                with open(target_path, 'wb') as target_fp:
+                    fcntl.ioctl(target_fp.fileno(), self._FICLONE, source_fp.fileno())
+            return True
+        except IOError:
+            # NOTE: assume every file in storage lives on the same filesystem
+            self._reflink_unsupported = True
+            if os.path.exists(target_path):
+                os.unlink(target_path)
+            return False
+
+            
+    def _list_snapshots(self):
+        """
+        Returns the names of every snapshot, oldest first
+        """
+        if not os.path.isdir(self._snapshot_folder):
+            return []
+        snapshots = []
+        for name in os.listdir(self._snapshot_folder):
+            parsed_name = self._parse_snapshot_name(name)
+            if parsed_name is not None:
+                snapshots.append((parsed_name, name))
+        return [name for (_, name) in sorted(snapshots)]
+    
+    def _get_new_snapshot_name(self, snapshot_names):
+        """
+        Returns the name of a new snapshot, which sorts after every existing 
+        one: the current time, followed by a sequence number when a snapshot
+        was already taken in the same second (e.g. 2016-01-31_120000.1)
+        """
+        base_name = time.strftime(self._SNAPSHOT_NAME_FORMAT)
+        sequence_nums = [self._parse_snapshot_name(name)[1] for name in snapshot_names
+                         if name.partition('.')[0] == base_name]
+        if not sequence_nums:
+            return base_name
+        return '{0}.{1}'.format(base_name, max(sequence_nums) + 1)
+    
+    def _parse_snapshot_name(self, name):
+        """
+        Returns the (time tuple, sequence number) of a snapshot name (or None
+        if the name is not a snapshot's)
+        """
+        (base_name, _, sequence) = name.partition('.')
+        try:
+            return (time.strptime(base_name, self._SNAPSHOT_NAME_FORMAT), 
+                    int(sequence) if sequence else 0)
+        except ValueError:
+            return None
+    
+    def _get_current_snapshot(self):
+        """
+        Returns the name of the snapshot of the last successful run (or None)
+        """
+        current_link = os.path.join(self._snapshot_folder, self._CURRENT_SNAPSHOT)
+        if not os.path.islink(current_link):
+            return None
+        return os.path.basename(os.readlink(current_link))
+    
+    def _prune_snapshots(self):
+        """
+        Removes snapshots beyond the newest keep_last ones that are also 
+        older than keep_days (when set)
+        
+        As snapshots share unchanged files, removing one only frees the 
+        space of the versions nothing else links to
+        """
+        snapshot_names = self._list_snapshots()
+        candidates = snapshot_names[:max(0, len(snapshot_names) - self._snapshot_keep_last)]
+        current_name = self._get_current_snapshot()
+        for snapshot_name in candidates:
+            if snapshot_name == current_name:
+                continue
+            if self._snapshot_keep_days is not None:
+                age = time.time() - time.mktime(self._parse_snapshot_name(snapshot_name)[0])
+                if age < self._snapshot_keep_days * 24 * 60 * 60:
+                    continue
+            self._logger.info('Pruning snapshot {0}'.format(snapshot_name))
+            shutil.rmtree(os.path.join(self._snapshot_folder, snapshot_name))
+            
+    def _link_tree(self, source_folder, target_folder):
+        """
+        Recreates a folder tree with every file hardlinked from the source
+        """
+        for (root, dirs, files) in os.walk(source_folder):
+            target_root = os.path.join(target_folder, os.path.relpath(root, source_folder))
+            os.makedirs(target_root)
+            for f in files:
+                # leftover temporary files are not carried over
+                if f.startswith('.') and f.endswith(self._TEMP_SUFFIXES):
+                    continue
+                source_path = os.path.join(root, f)
+                target_path = os.path.join(target_root, f)
+                if os.path.islink(source_path):
+                    os.symlink(os.readlink(source_path), target_path)
+                else:
+                    os.link(source_path, target_path)
+
+    _LINK_SUFFIX = '.link'
+    _FICLONE = 0x40049409
+    _LINK_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOTSUP)
+    _SNAPSHOT_NAME_FORMAT = '%Y-%m-%d_%H%M%S'
+    _CURRENT_SNAPSHOT = 'current'
+    _TEMP_SUFFIXES = ('.download', _LINK_SUFFIX)
+    _DEFAULT_SNAPSHOT_KEEP_LAST = 7
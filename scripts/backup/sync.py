@@ -0,0 +1,532 @@
+from collections import OrderedDict
+import logging
+import os
+
+from backup.content import ContentMatcher
+from backup.metrics import RunMetrics
+from backup.planner import MirrorPlanner, Plan
+from backup.workers import Prefetcher
+
+class _Sync:
+    """
+    Shared bookkeeping for bringing storage and the metadata index in line 
+    with Google Drive
+    
+    Everything Drive is accessed through drive_download so a sync can be 
+    driven by any service implementing the Drive v2 API.  Phases and file
+    outcomes are recorded in the run's metrics.
+    """
+    def __init__(self, config, drive_download, storage, index, download_pool, 
+                 exclusions, compare_checksums, metrics=None):
+        self._multiple_parents = config[u'backup'].get(u'multiple_parents', True)
+        self._drive_download = drive_download
+        self._storage = storage
+        self._index = index
+        self._download_pool = download_pool
+        self._exclusions = exclusions
+        self._compare_checksums = compare_checksums
+        self._content = ContentMatcher(config, drive_download, index, compare_checksums)
+        self._metrics = metrics or RunMetrics()
+        
+        # downloads in flight indexed by content, with the files waiting on them
+        self._downloads_by_content = {}
+        
+    def _reuse_stored_copy(self, file_obj, relative_path, wanted_paths):
+        """
+        Moves a stored copy of a file that is no longer wanted where it is 
+        (i.e. the file was renamed or moved) to a relative path
+        
+        Returns True if a copy was moved into place
+        """
+        for old_path in self._index.get_file_paths(file_obj.id):
+            if old_path in wanted_paths:
+                continue
+            if self._storage.move(old_path, relative_path):
+                self._index.move_file(file_obj.id, old_path, relative_path)
+                return True
+            self._index.remove_file_path(file_obj.id, old_path)
+        return False
+    
+    def _download_file(self, file_obj, relative_path):
+        """
+        Queues a file for download to a relative path; it is recorded in the 
+        index once the download succeeds
+        
+        With dedupe enabled, content that is already stored (or being 
+        downloaded) is linked instead of transferred again, including the 
+        export of the same version of a native Google file to the same format
+        """
+        content_key = self._content.get_content_key(file_obj)
+        if content_key:
+            if content_key in self._downloads_by_content:
+                self._downloads_by_content[content_key].append((file_obj, relative_path))
+                return
+            if self._store_duplicate(file_obj, relative_path):
+                return
+            self._downloads_by_content[content_key] = []
+            
+        def on_complete():
+            # NOTE: committed right away so that a restarted run skips it
+            self._record_file(file_obj, relative_path)
+            self._index.commit()
+            for (waiting_file_obj, waiting_path) in self._downloads_by_content.pop(content_key, []):
+                if not self._store_duplicate(waiting_file_obj, waiting_path):
+                    self._download_file(waiting_file_obj, waiting_path)
+                    
+        def on_failure():
+            for (waiting_file_obj, waiting_path) in self._downloads_by_content.pop(content_key, []):
+                self._download_file(waiting_file_obj, waiting_path)
+                
+        self._download_pool.submit(file_obj, self._storage.get_local_path(relative_path),
+                                   on_complete, on_failure)
+        
+    def _store_duplicate(self, file_obj, relative_path):
+        """
+        Stores a file by linking to an already stored copy of its content
+        
+        Returns True if the file was stored
+        """
+        for source_path in self._content.find_content_paths(file_obj):
+            if source_path == relative_path:
+                continue
+            if self._storage.store_duplicate(source_path, relative_path, file_obj.file_size, 
+                                             self._drive_download.get_modification_time(file_obj)):
+                self._record_file(file_obj, relative_path)
+                self._index.commit()
+                self._metrics.count_file(u'linked')
+                return True
+        return False
+    
+    def _record_file(self, file_obj, relative_path):
+        """
+        Records the file stored at a relative path in the index
+        """
+        self._index.record_file(file_obj.id, relative_path, 
+                                file_obj.modified_date,
+                                file_obj.md5_checksum,
+                                file_obj.file_size,
+                                self._drive_download.get_export_format(file_obj),
+                                file_obj.version)
+
+
+class FullScan(_Sync):
+    """
+    Lists and backs up the whole drive
+    """
+    def __init__(self, config, drive_download, storage, index, download_pool, 
+                 exclusions, compare_checksums, ignore_modtime, metrics=None):
+        _Sync.__init__(self, config, drive_download, storage, index, download_pool, 
+                       exclusions, compare_checksums, metrics)
+        self._config = config
+        self._ignore_modtime = ignore_modtime
+        self._logger = logging.getLogger('drive_backup.backup.FullScan')
+        
+    def run(self):
+        """
+        Backs up every file in the drive
+        
+        Listing, planning and downloading overlap: the listing is fetched 
+        on a background thread a bounded number of files ahead, each file is
+        planned and applied as it arrives and its download starts right 
+        away, so neither the network nor memory use depends on waiting for 
+        the whole drive to be listed.  Files and folders no longer in the 
+        drive are removed once the listing is complete, so that files moved
+        out of a removed folder are moved rather than downloaded again.
+        
+        Returns the changes feed token from before the listing started
+        """
+        # NOTE: the token is taken first so that nothing changed while 
+        # listing is missed by the next incremental run
+        change_token = self._drive_download.get_start_page_token()
+        folder_tree = self._get_folder_tree()
+        planner = self._create_planner()
+        
+        self._index.begin_scan()
+        with self._metrics.phase(u'storage'):
+            folder_plan = planner.plan_folders(folder_tree)
+            self._apply_folders(folder_plan)
+        planner.mark_folders_applied()
+        
+        self._logger.debug('Retrieving file listing...')
+        with self._metrics.phase(u'listing'):
+            listing = Prefetcher(self._drive_download.iterfiles(), self._LISTING_BACKLOG)
+            try:
+                for file_obj in listing:
+                    plan = Plan()
+                    planner.plan_file(file_obj, plan)
+                    self._apply_files(plan)
+            finally:
+                listing.close()
+        
+        with self._metrics.phase(u'storage'):
+            plan = Plan()
+            planner.plan_deletions(plan)
+            self._apply_deletions(folder_plan)
+            self._apply_deletions(plan)
+        with self._metrics.phase(u'downloads'):
+            self._download_pool.wait()
+        self._index.end_scan()
+        return change_token
+    
+    def plan(self):
+        """
+        Lists the drive and diffs it against storage and the index without 
+        changing either
+        
+        Returns the Plan
+        """
+        folder_tree = self._get_folder_tree()
+        self._logger.debug('Retrieving file listing...')
+        with self._metrics.phase(u'listing'):
+            return self._create_planner().plan(folder_tree, self._drive_download.iterfiles())
+    
+    def _get_folder_tree(self):
+        """
+        Returns the folder tree of the drive without the excluded folders
+        """
+        self._logger.debug('Retrieving folder hierarchy...')
+        with self._metrics.phase(u'hierarchy'):
+            folder_tree = self._drive_download.get_folder_tree()
+            self._prune_excluded_folders(folder_tree)
+        return folder_tree
+    
+    def _create_planner(self):
+        """
+        Returns a MirrorPlanner for the current state of storage and the index
+        """
+        return MirrorPlanner(self._config, self._drive_download, self._storage, 
+                             self._index, self._exclusions, self._compare_checksums, 
+                             self._ignore_modtime)
+    
+    def _apply_folders(self, plan):
+        """
+        Applies the folder renames, new folders and folder paths of a Plan
+        """
+        # NOTE: parents are renamed before their children so that the 
+        # children's indexed paths already reflect the move
+        for (_, old_path, new_path) in plan.folder_renames:
+            if self._storage.move(old_path, new_path):
+                self._index.rename_folder(old_path, new_path)
+        self._storage.create_folders(plan.new_folders)
+        for (folder_id, relative_path) in plan.folder_paths:
+            self._index.set_folder_path(folder_id, relative_path)
+            
+    def _apply_files(self, plan):
+        """
+        Applies the file renames and unchanged files of a Plan and queues 
+        its downloads
+        """
+        for (file_obj, old_path, new_path) in plan.file_renames:
+            if self._storage.move(old_path, new_path):
+                self._index.move_file(file_obj.id, old_path, new_path)
+        for (file_obj, relative_path) in plan.unchanged:
+            self._logger.debug('Skipping {0} as there has been no change'.format(relative_path))
+            self._record_file(file_obj, relative_path)
+            self._metrics.count_file(u'skipped')
+        for (file_obj, relative_path) in plan.downloads:
+            self._download_file(file_obj, relative_path)
+                
+    def _apply_deletions(self, plan):
+        """
+        Removes the files and folders of a Plan that are no longer in the drive
+        """
+        for relative_path in plan.deletions:
+            self._storage.remove(relative_path)
+    
+    def _prune_excluded_folders(self, folder_tree):
+        """
+        Removes excluded folders and their subtrees from the folder tree, so 
+        they are neither created nor searched for files
+        """
+        for folder_id in list(folder_tree.iterfolders()):
+            relative_path = folder_tree.get_path(folder_id)
+            if relative_path is not None and self._exclusions.is_excluded_folder(relative_path):
+                self._logger.debug('Excluding folder {0}'.format(relative_path))
+                folder_tree.remove_subtree(folder_id)
+                
+    _LISTING_BACKLOG = 2000
+
+
+class IncrementalSync(_Sync):
+    """
+    Applies the Drive changes feed to the local backup
+    
+    Additions, modifications, renames, moves and trashes recorded since the
+    last successful run are replayed against storage using the paths kept in
+    the metadata index.  The feed only reports a folder that comes into the
+    backed up tree (e.g. moved in, restored from the trash, shared in or 
+    renamed out of an exclusion), not what it holds, so its subtree is 
+    listed.  With exclusions configured, so is the subtree of a renamed or
+    moved folder, as what its new path excludes beneath it may differ.
+    
+    As in a full scan, removals are applied last, so whatever is moved out 
+    of a trashed folder is moved rather than downloaded again.  An item 
+    awaiting removal is only removed early when another item takes its path.
+    """
+    def __init__(self, config, drive_download, storage, index, download_pool, 
+                 exclusions, compare_checksums, metrics=None):
+        _Sync.__init__(self, config, drive_download, storage, index, download_pool, 
+                       exclusions, compare_checksums, metrics)
+        self._logger = logging.getLogger('drive_backup.backup.IncrementalSync')
+        
+        # items awaiting removal and the relative paths they are stored at
+        self._pending_removals = OrderedDict()
+        self._removal_paths = {}
+        
+    def get_changes(self, change_token):
+        """
+        Retrieves every change since change_token
+        
+        Returns a tuple containing:
+            changes - list of the changes to apply
+            new_change_token - change token to store once they are applied
+        
+        Raises ChangeTokenExpiredError if the token can no longer be used
+        """
+        with self._metrics.phase(u'changes'):
+            (changes, new_change_token) = self._drive_download.get_changes(change_token)
+        self._logger.debug('Retrieved {0} changes'.format(len(changes)))
+        return (changes, new_change_token)
+        
+    def apply(self, changes):
+        """
+        Applies the changes retrieved by get_changes
+        """
+        # only the latest change for each item matters
+        latest_changes = OrderedDict()
+        for change in changes:
+            latest_changes.pop(change[u'fileId'], None)
+            latest_changes[change[u'fileId']] = change
+        
+        # split into removals, folder updates and file updates
+        removed_ids = []
+        folders = []
+        files = []
+        for (file_id, change) in latest_changes.iteritems():
+            file_obj = change.get(u'file')
+            if change.get(u'deleted') or file_obj is None or self._drive_download.is_trashed(file_obj):
+                removed_ids.append(file_id)
+            elif self._drive_download.is_folder(file_obj):
+                folders.append(file_obj)
+            else:
+                files.append(file_obj)
+                
+        for file_id in removed_ids:
+            self._defer_removal(file_id)
+        with self._metrics.phase(u'storage'):
+            listed_folder_ids = self._apply_folders(folders)
+        if listed_folder_ids:
+            with self._metrics.phase(u'listing'):
+                changed_file_ids = set(file_obj.id for file_obj in files)
+                files.extend(file_obj for file_obj in self._list_subtrees(listed_folder_ids)
+                             if file_obj.id not in changed_file_ids)
+        with self._metrics.phase(u'downloads'):
+            for file_obj in files:
+                self._apply_file(file_obj)
+        with self._metrics.phase(u'storage'):
+            for file_id in self._pending_removals.keys():
+                self._remove_item(file_id)
+            self._pending_removals.clear()
+            self._removal_paths.clear()
+        with self._metrics.phase(u'downloads'):
+            self._download_pool.wait()
+    
+    def _defer_removal(self, file_id):
+        """
+        Schedules a deleted or trashed file or folder (or one that is no longer
+        backed up) for removal once everything else is applied
+        """
+        folder_path = self._index.get_folder_path(file_id)
+        if folder_path is not None:
+            relative_paths = [folder_path]
+        else:
+            relative_paths = self._index.get_file_paths(file_id)
+        self._pending_removals[file_id] = None
+        for relative_path in relative_paths:
+            self._removal_paths[relative_path] = file_id
+            
+    def _claim_path(self, relative_path):
+        """
+        Removes right away an item awaiting removal that is stored at a 
+        relative path about to be taken over
+        """
+        file_id = self._removal_paths.get(relative_path)
+        if file_id is None:
+            return
+        prefix = relative_path + os.path.sep
+        self._removal_paths = dict(item for item in self._removal_paths.iteritems()
+                                   if item[1] != file_id and not item[0].startswith(prefix))
+        del self._pending_removals[file_id]
+        self._remove_item(file_id)
+                
+    def _cancel_removal(self, file_id):
+        """
+        Keeps an item awaiting removal that turned out to be in the backed up
+        tree after all (e.g. a folder found while listing a subtree)
+        """
+        if file_id in self._pending_removals:
+            del self._pending_removals[file_id]
+            self._removal_paths = dict(item for item in self._removal_paths.iteritems()
+                                       if item[1] != file_id)
+            
+    def _rename_removal_paths(self, old_path, new_path):
+        """
+        Follows the items awaiting removal beneath a renamed folder
+        """
+        prefix = old_path + os.path.sep
+        for (relative_path, file_id) in self._removal_paths.items():
+            if relative_path.startswith(prefix):
+                del self._removal_paths[relative_path]
+                self._removal_paths[new_path + relative_path[len(old_path):]] = file_id
+    
+    def _remove_item(self, file_id):
+        """
+        Removes a deleted or trashed file or folder from storage
+        """
+        folder_path = self._index.get_folder_path(file_id)
+        if folder_path is not None:
+            self._storage.remove(folder_path)
+            self._index.remove_folder(file_id)
+            return
+        
+        for relative_path in self._index.get_file_paths(file_id):
+            self._storage.remove(relative_path)
+        self._index.remove_file(file_id)
+            
+    def _apply_folders(self, folders):
+        """
+        Creates, renames and moves folders
+        
+        Folders are applied once their parent's path is known, so a new folder
+        nested inside another new folder is resolved regardless of feed order.
+        The same goes for a folder moved beneath a folder that is moved as well,
+        as the indexed paths beneath a folder are only current once it is 
+        applied.  Folders that remain unresolved are outside of the backed up 
+        tree and are removed if they were backed up before.
+        
+        Returns the ids of the folders whose subtrees need to be listed
+        """
+        listed_folder_ids = []
+        pending = folders
+        while pending:
+            pending_paths = set(self._index.get_folder_path(folder.id) for folder in pending)
+            ready = []
+            unresolved = []
+            for folder in pending:
+                parent_path = self._get_parent_paths(folder)[:1]
+                if not parent_path or self._is_within(parent_path[0], pending_paths):
+                    unresolved.append(folder)
+                else:
+                    ready.append((folder, parent_path[0]))
+            
+            # NOTE: applying a folder only changes the paths beneath it, which 
+            # the parent paths of the ready folders never run through
+            for (folder, parent_path) in ready:
+                new_path = os.path.join(parent_path, folder.title)
+                old_path = self._index.get_folder_path(folder.id)
+                if self._exclusions.is_excluded_folder(new_path):
+                    # its contents are never backed up, so the folder is left 
+                    # unresolved like folders outside of the backed up tree
+                    self._logger.debug('Excluding folder {0}'.format(new_path))
+                    self._defer_removal(folder.id)
+                    continue
+                self._cancel_removal(folder.id)
+                if old_path is not None and old_path != new_path:
+                    self._claim_path(new_path)
+                    if not self._storage.move(old_path, new_path):
+                        self._storage.make_folder(new_path)
+                    self._index.rename_folder(old_path, new_path)
+                    self._rename_removal_paths(old_path, new_path)
+                else:
+                    self._claim_path(new_path)
+                    self._storage.make_folder(new_path)
+                if old_path is None or (old_path != new_path and self._exclusions.has_exclusions()):
+                    listed_folder_ids.append(folder.id)
+                self._index.set_folder_path(folder.id, new_path)
+                
+            if len(unresolved) == len(pending):
+                # the remaining folders live outside of the backed up tree
+                for folder in unresolved:
+                    self._logger.debug('Ignoring folder {0} outside of the drive hierarchy'.format(folder.title))
+                    self._defer_removal(folder.id)
+                break
+            pending = unresolved
+        return listed_folder_ids
+    
+    def _is_within(self, relative_path, folder_paths):
+        """
+        Determines if a relative path is one of the folder paths or lies beneath one
+        """
+        path_parts = relative_path.split(os.path.sep) if relative_path else []
+        return any(os.path.sep.join(path_parts[:part_count]) in folder_paths 
+                   for part_count in xrange(1, len(path_parts) + 1))
+    
+    def _list_subtrees(self, folder_ids):
+        """
+        Lists everything beneath folders, applying the subfolders found along
+        the way
+        
+        Returns the files found
+        """
+        files = []
+        listed_ids = set()
+        pending_ids = folder_ids
+        while pending_ids:
+            self._logger.debug('Listing the contents of {0} folders'.format(len(pending_ids)))
+            listed_ids.update(pending_ids)
+            subfolders = []
+            for file_obj in self._drive_download.iterchildren(pending_ids):
+                if self._drive_download.is_trashed(file_obj):
+                    continue
+                if self._drive_download.is_folder(file_obj):
+                    subfolders.append(file_obj)
+                else:
+                    files.append(file_obj)
+            self._apply_folders(subfolders)
+            pending_ids = [folder.id for folder in subfolders
+                           if folder.id not in listed_ids and 
+                              self._index.get_folder_path(folder.id) is not None]
+        return files
+            
+    def _apply_file(self, file_obj):
+        """
+        Downloads, renames or moves a file
+        """
+        filename = self._drive_download.get_filename(file_obj)
+        new_paths = []
+        for parent_path in self._get_parent_paths(file_obj):
+            relative_path = os.path.join(parent_path, filename)
+            if self._exclusions.is_excluded_file(os.path.sep.join([parent_path, filename])):
+                self._logger.debug('Excluding {0}'.format(relative_path))
+                continue
+            new_paths.append(relative_path)
+        
+        for relative_path in new_paths:
+            self._claim_path(relative_path)
+            if (self._content.is_file_current(file_obj, relative_path) or
+                (self._reuse_stored_copy(file_obj, relative_path, new_paths) and 
+                 self._content.is_file_current(file_obj, relative_path))):
+                self._metrics.count_file(u'skipped')
+                continue
+            self._download_file(file_obj, relative_path)
+            
+        # remove stored copies the file no longer occupies
+        for relative_path in self._index.get_file_paths(file_obj.id):
+            if relative_path not in new_paths:
+                self._storage.remove(relative_path)
+                self._index.remove_file_path(file_obj.id, relative_path)
+            
+    def _get_parent_paths(self, file_obj):
+        """
+        Returns the relative local paths of the known parent folders: the 
+        first one, or all of them when multiple parents are exposed
+        """
+        parent_paths = []
+        for parent_id in self._drive_download.get_parent_ids(file_obj):
+            parent_path = self._index.get_folder_path(parent_id)
+            # NOTE: nothing is placed in a folder that is about to be removed
+            if parent_path is not None and not self._is_within(parent_path, self._removal_paths):
+                parent_paths.append(parent_path)
+        if self._multiple_parents:
+            return parent_paths
+        return parent_paths[:1]
@@ -0,0 +1,221 @@
+from email.utils import mktime_tz, parsedate_tz
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+
+import httplib2
+from apiclient.errors import HttpError
+
+from backup.metrics import RunMetrics
+from backup.scheduling import BandwidthLimiter, RequestRateLimit
+
+class _Retry(Exception):
+    """
+    Raised by a request attempt that should be retried
+    
+    give_up - callable returning (or raising) the outcome once retries are exhausted
+    """
+    def __init__(self, status, retry_after, give_up):
+        self.status = status
+        self.retry_after = retry_after
+        self.give_up = give_up
+
+
+class RequestThrottle:
+    """
+    Shared scheduler for every Drive request (listings and downloads)
+    
+    Requests are admitted by a token bucket whose rate adapts to the 
+    throttling Drive reports: it backs off multiplicatively whenever a request
+    is rate limited and creeps back up additively while requests succeed.
+    Rate limited, server error and network failures are retried with 
+    jittered exponential backoff, honouring Retry-After when Drive sends it.
+    Rate limiting and Retry-After hold back every request sharing the 
+    throttle, while other failures only delay the retry of the failed request.
+    Requests are also held to the global request rate limit and downloaded 
+    content to the bandwidth cap, both of which may be shared with other 
+    account processes.  The throttle is safe to share between threads and 
+    records every attempt in the run's metrics.
+    """
+    def __init__(self, config, metrics=None, rate_limit=None, bandwidth_limiter=None):
+        throttle_config = config[u'backup'].get(u'throttle', {})
+        self._max_rate = float(throttle_config.get(u'max_requests_per_second', 
+                                                   self._DEFAULT_MAX_RATE))
+        self._min_rate = float(throttle_config.get(u'min_requests_per_second', 
+                                                   self._DEFAULT_MIN_RATE))
+        self._max_retries = throttle_config.get(u'max_retries', self._DEFAULT_MAX_RETRIES)
+        self._max_backoff = throttle_config.get(u'max_backoff', self._DEFAULT_MAX_BACKOFF)
+        self._rate = min(self._max_rate, float(throttle_config.get(u'requests_per_second', 
+                                                                   self._max_rate)))
+        self._metrics = metrics or RunMetrics()
+        self._rate_limit = rate_limit or RequestRateLimit(config)
+        self._bandwidth_limiter = bandwidth_limiter or BandwidthLimiter(config)
+        self._logger = logging.getLogger('drive_backup.backup.RequestThrottle')
+        
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._last_refill = time.time()
+        self._blocked_until = 0.0
+        self._request_count = 0
+        
+    def execute(self, request):
+        """
+        Executes a Drive API (apiclient) request
+        
+        Returns the response; raises HttpError once retries are exhausted
+        """
+        def attempt():
+            try:
+                return request.execute()
+            except HttpError as e:
+                if not self._is_retryable(e.resp.status, e.content):
+                    raise
+                def give_up():
+                    raise e
+                raise _Retry(e.resp.status, e.resp.get('retry-after'), give_up)
+        return self._call(attempt)
+    
+    def request(self, http, uri, **kwargs):
+        """
+        Issues a raw HTTP request (e.g. a download) through an authorized client
+        
+        Returns the (response, content) tuple, which is the last failed 
+        response if retries are exhausted
+        """
+        def attempt():
+            (response, content) = http.request(uri, **kwargs)
+            self._metrics.count_bytes(len(content))
+            if self._is_retryable(response.status, content):
+                raise _Retry(response.status, response.get('retry-after'), 
+                             lambda: (response, content))
+            return (response, content)
+        (response, content) = self._call(attempt)
+        self._bandwidth_limiter.consume(len(content))
+        return (response, content)
+    
+    def get_rate(self):
+        """
+        Returns the current number of requests admitted per second
+        """
+        return self._rate
+    
+    def get_request_count(self):
+        """
+        Returns the number of requests (including retries) sent so far
+        """
+        return self._request_count
+    
+    def _call(self, attempt):
+        """
+        Runs a request attempt until it succeeds or retries are exhausted
+        """
+        retry_num = 0
+        while True:
+            self._acquire()
+            self._rate_limit.acquire()
+            with self._lock:
+                self._request_count += 1
+            start_time = time.time()
+            try:
+                result = attempt()
+            except _Retry as e:
+                throttled = e.status in self._THROTTLED_STATUSES
+                if throttled:
+                    self._on_throttled()
+                if retry_num >= self._max_retries:
+                    return e.give_up()
+                delay = self._get_backoff(retry_num, e.retry_after)
+                block_all = throttled or e.retry_after is not None
+                self._logger.debug('Request failed with HTTP code {0}, retrying in {1:.1f}s'.format(e.status, delay))
+            except self._NETWORK_ERRORS as e:
+                if retry_num >= self._max_retries:
+                    raise
+                delay = self._get_backoff(retry_num, None)
+                block_all = False
+                self._logger.debug('Request failed ({0}), retrying in {1:.1f}s'.format(e, delay))
+            else:
+                self._on_success()
+                return result
+            finally:
+                self._metrics.record_request(time.time() - start_time)
+            
+            if block_all:
+                # NOTE: rate limiting holds back every request sharing the throttle
+                with self._lock:
+                    self._blocked_until = max(self._blocked_until, time.time() + delay)
+            else:
+                time.sleep(delay)
+            retry_num += 1
+    
+    def _acquire(self):
+        """
+        Blocks until the token bucket admits a request
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                if now >= self._blocked_until:
+                    self._tokens = min(self._BURST, self._tokens + (now - self._last_refill) * self._rate)
+                    self._last_refill = now
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self._rate
+                else:
+                    self._last_refill = self._blocked_until
+                    wait = self._blocked_until - now
+            time.sleep(wait)
+            
+    def _on_success(self):
+        """
+        Additively increases the request rate
+        """
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._RATE_INCREASE)
+            
+    def _on_throttled(self):
+        """
+        Multiplicatively decreases the request rate
+        """
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate * self._RATE_DECREASE)
+            self._logger.debug('Throttled by Drive, reducing to {0:.2f} requests/s'.format(self._rate))
+            
+    def _get_backoff(self, retry_num, retry_after):
+        """
+        Returns the delay in seconds before the next attempt: full jitter 
+        exponential backoff, but never sooner than Retry-After
+        """
+        delay = random.uniform(0, min(self._max_backoff, self._BASE_BACKOFF * (2 ** retry_num)))
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                retry_date = parsedate_tz(retry_after)
+                if retry_date:
+                    delay = max(delay, mktime_tz(retry_date) - time.time())
+        return delay
+    
+    def _is_retryable(self, status, content):
+        """
+        Determines if a failed response is worth retrying
+        """
+        if status == 429 or status in self._SERVER_ERROR_STATUSES:
+            return True
+        return status == 403 and any(reason in (content or '') for reason in self._RATE_LIMIT_REASONS)
+
+    _DEFAULT_MAX_RATE = 10.0
+    _DEFAULT_MIN_RATE = 0.5
+    _DEFAULT_MAX_RETRIES = 6
+    _DEFAULT_MAX_BACKOFF = 64
+    _BASE_BACKOFF = 1.0
+    _BURST = 5.0
+    _RATE_INCREASE = 0.1
+    _RATE_DECREASE = 0.5
+    _THROTTLED_STATUSES = (403, 429)
+    _SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+    _RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+    _NETWORK_ERRORS = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+
+class VerificationError(Exception):
+    """
+    Exception class raised when stored files do not match the index
+    """
+    def __init__(self, problem_count):
+        self.problem_count = problem_count
+
+    def __str__(self):
+        return '{0} stored file(s) failed verification'.format(self.problem_count)
+
+
+class Verification:
+    """
+    Outcome of a verification:
+        corrupt - (IndexEntry, reason) of stored files whose size or MD5
+                  checksum does not match the index
+        missing - IndexEntry of indexed files that are not stored
+        extra - paths of stored files that are not indexed
+        verified - number of stored files that match the index
+        hashed_bytes - number of bytes read to compute checksums
+    """
+    def __init__(self):
+        self.corrupt = []
+        self.missing = []
+        self.extra = []
+        self.verified = 0
+        self.hashed_bytes = 0
+
+    def get_problem_count(self):
+        """
+        Returns the number of corrupt and missing files
+        """
+        return len(self.corrupt) + len(self.missing)
+
+    def describe(self):
+        """
+        Returns the outcome as a list of human readable lines
+        """
+        lines = []
+        for (entry, reason) in self.corrupt:
+            lines.append('corrupt {0} ({1})'.format(entry.path, reason))
+        for entry in self.missing:
+            lines.append('missing {0}'.format(entry.path))
+        for relative_path in self.extra:
+            lines.append('extra {0}'.format(relative_path))
+        lines.append('{0} verified, {1} corrupt, {2} missing, {3} extra file(s); '
+                     '{4} byte(s) hashed'.format(self.verified, len(self.corrupt),
+                                                 len(self.missing), len(self.extra),
+                                                 self.hashed_bytes))
+        return lines
+
+
+class StorageVerifier:
+    """
+    Verifies the stored files against the sizes and MD5 checksums Drive
+    reported, as recorded in the metadata index
+
+    Sizes are compared first from a stat, so only files of the right size
+    are read.  Checksums are computed by a pool of processes with large
+    sequential reads, largest files first so that the pool stays busy to
+    the end, and each inode is read once however many hardlinked copies
+    (dedupe, snapshots) it has.  Exports have no Drive checksum and are
+    only checked to exist.
+
+    Repairing removes corrupt files and forgets them and the missing files
+    in the index, then clears the changes feed token so that the next run
+    is a full scan that downloads them again.  Extra files are left to the
+    full scan, which removes what is no longer in the drive.
+    """
+    def __init__(self, config, storage, index):
+        verify_config = config[u'backup'].get(u'verify', {})
+        self._process_count = verify_config.get(u'processes') or multiprocessing.cpu_count()
+        self._storage = storage
+        self._index = index
+        self._logger = logging.getLogger('drive_backup.backup.StorageVerifier')
+
+    def verify(self):
+        """
+        Compares storage against the index
+
+        Returns the Verification
+        """
+        verification = Verification()
+        (_, local_files) = self._storage.list_tree()
+
+        # cheap checks first: existence and size
+        entries_by_inode = {}
+        for entry in self._index.iter_file_entries():
+            if entry.path not in local_files:
+                verification.missing.append(entry)
+                continue
+            local_files.discard(entry.path)
+            try:
+                file_stat = os.stat(self._storage.get_local_path(entry.path))
+            except OSError:
+                verification.missing.append(entry)
+                continue
+            if entry.size is not None and file_stat.st_size != entry.size:
+                verification.corrupt.append((entry, 'size {0} instead of {1}'.format(
+                    file_stat.st_size, entry.size)))
+            elif entry.md5_checksum is None:
+                verification.verified += 1
+            else:
+                entries_by_inode.setdefault((file_stat.st_dev, file_stat.st_ino), []).append(entry)
+        verification.extra = sorted(local_files)
+
+        # checksums, once per inode
+        tasks = sorted(((entries[0].size, self._storage.get_local_path(entries[0].path), inode)
+                        for (inode, entries) in entries_by_inode.iteritems()), reverse=True)
+        self._logger.info('Hashing {0} file(s), {1} byte(s) with {2} process(es)'.format(
+            len(tasks), sum(size for (size, _, _) in tasks), self._process_count))
+        start_time = time.time()
+        pool = multiprocessing.Pool(self._process_count)
+        try:
+            for (inode, md5_checksum, byte_count, error) in pool.imap_unordered(
+                    _hash_file, tasks, chunksize=1):
+                verification.hashed_bytes += byte_count
+                for entry in entries_by_inode[inode]:
+                    if error is not None:
+                        verification.corrupt.append((entry, error))
+                    elif md5_checksum != entry.md5_checksum:
+                        verification.corrupt.append((entry, 'checksum {0} instead of {1}'.format(
+                            md5_checksum, entry.md5_checksum)))
+                    else:
+                        verification.verified += 1
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        duration = time.time() - start_time
+        self._logger.info('Hashed {0} byte(s) in {1:.1f}s ({2:.0f} B/s)'.format(
+            verification.hashed_bytes, duration,
+            verification.hashed_bytes / duration if duration else 0.0))
+
+        verification.corrupt.sort(key=lambda corruption: corruption[0].path)
+        return verification
+
+    def repair(self, verification):
+        """
+        Queues the corrupt and missing files of a Verification to be
+        downloaded again by the next run
+        """
+        if not verification.corrupt and not verification.missing:
+            return
+        for (entry, _) in verification.corrupt:
+            self._storage.remove(entry.path)
+            self._index.remove_file_path(entry.file_id, entry.path)
+        for entry in verification.missing:
+            self._index.remove_file_path(entry.file_id, entry.path)
+        self._logger.info('Queued {0} file(s) to download again with the next (full) run'.format(
+            len(verification.corrupt) + len(verification.missing)))
+        self._index.set_change_token(None)
+
+
+def _hash_file(task):
+    """
+    Computes the MD5 checksum of a file in a pool process
+
+    Returns a (inode, checksum, bytes read, error) tuple; error is None
+    unless the file could not be read
+    """
+    (_, local_path, inode) = task
+    md5 = hashlib.md5()
+    byte_count = 0
+    try:
+        with open(local_path, 'rb') as fp:
+            for data in iter(lambda: fp.read(_READ_SIZE), ''):
+                md5.update(data)
+                byte_count += len(data)
+    except IOError as e:
+        return (inode, None, byte_count, 'unreadable: {0}'.format(e.strerror))
+    return (inode, md5.hexdigest(), byte_count, None)
+
+_READ_SIZE = 8 * 1024 * 1024
@@ -0,0 +1,252 @@
+import logging
+import Queue
+import sys
+import threading
+
+from backup.metrics import RunMetrics
+
+class DownloadFailuresError(Exception):
+    """
+    Exception class raised when some of the downloads of a run failed
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        
+    def __str__(self):
+        return '{0} download(s) failed:\n{1}'.format(
+            len(self.failures), 
+            '\n'.join('{0}: {1}'.format(path, error) for (path, error) in self.failures))
+
+
+class DownloadPool:
+    """
+    Pool of worker threads downloading files concurrently
+    
+    Queued files are downloaded in the order of the scheduler's priorities
+    (or as submitted without a scheduler).
+    httplib2 is not thread-safe so every worker owns its own authorized HTTP 
+    client, created by http_factory.  Completion callbacks are run on the 
+    thread that submits work (when it calls submit or wait) so that callers 
+    can keep single-threaded resources such as the metadata index.
+    """
+    def __init__(self, drive_download, http_factory, concurrency, metrics=None, 
+                 scheduler=None):
+        self._drive_download = drive_download
+        self._http_factory = http_factory
+        self._concurrency = max(1, concurrency)
+        self._metrics = metrics or RunMetrics()
+        self._scheduler = scheduler
+        self._logger = logging.getLogger('drive_backup.backup.DownloadPool')
+        
+        # NOTE: the task queue is bounded to apply back pressure on the 
+        # producer; queued tasks are taken by priority, then in order
+        backlog = scheduler.get_backlog() if scheduler else self._concurrency * 2
+        self._tasks = Queue.PriorityQueue(maxsize=max(1, backlog))
+        self._task_num = 0
+        self._results = Queue.Queue()
+        self._pending = 0
+        self._downloaded = 0
+        self._failures = []
+        
+        self._workers = []
+        for worker_num in xrange(self._concurrency):
+            worker = threading.Thread(target=self._work, 
+                                      name='download-{0}'.format(worker_num))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+            
+    def submit(self, file_obj, local_path, on_complete=None, on_failure=None):
+        """
+        Queues a file for download
+        
+        file_obj - DriveFile record of the file
+        local_path - Local path to store the file
+        on_complete - called (without arguments) once the file is downloaded
+        on_failure - called (without arguments) if the download fails
+        """
+        self._process_results(block=False)
+        self._pending += 1
+        priority = self._scheduler.get_priority(file_obj) if self._scheduler else 0
+        self._put_task(priority, (file_obj, local_path, (on_complete, on_failure)))
+        
+    def wait(self):
+        """
+        Waits for every queued download to finish
+        """
+        while self._pending > 0:
+            self._process_results(block=True)
+            
+    def cancel(self):
+        """
+        Drops the queued downloads that have not started, so that waiting 
+        only waits for the downloads in flight (e.g. when asked to terminate)
+        
+        Completion callbacks are not run for the dropped downloads
+        """
+        while True:
+            try:
+                self._tasks.get_nowait()
+            except Queue.Empty:
+                break
+            self._pending -= 1
+            
+    def close(self):
+        """
+        Stops the workers once the queued downloads are finished
+        """
+        self.wait()
+        for _ in self._workers:
+            self._put_task(self._STOP_PRIORITY, None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        
+    def reset(self):
+        """
+        Forgets the outcomes of earlier downloads (e.g. between runs of the 
+        watch command)
+        """
+        self.wait()
+        self._downloaded = 0
+        self._failures = []
+        
+    def get_failures(self):
+        """
+        Returns the list of (local path, error) tuples of every failed download
+        """
+        return list(self._failures)
+    
+    def log_summary(self):
+        """
+        Logs the outcome of every download submitted to the pool
+        """
+        self._logger.info('Downloaded {0} file(s), {1} failed'.format(
+            self._downloaded, len(self._failures)))
+        for (local_path, error) in self._failures:
+            self._logger.error('Failed to download {0}: {1}'.format(local_path, error))
+    
+    def _put_task(self, priority, task):
+        """
+        Queues a task (or None to stop a worker) behind the tasks of the 
+        same or a higher priority
+        """
+        self._task_num += 1
+        self._tasks.put((priority, self._task_num, task))
+        
+    def _process_results(self, block):
+        """
+        Runs the completion callbacks of finished downloads
+        """
+        while self._pending > 0:
+            try:
+                (local_path, (on_complete, on_failure), error) = self._results.get(block=block)
+            except Queue.Empty:
+                return
+            self._pending -= 1
+            if error is not None:
+                self._failures.append((local_path, error))
+                self._metrics.count_file(u'failed')
+                if on_failure:
+                    on_failure()
+            else:
+                self._downloaded += 1
+                self._metrics.count_file(u'downloaded')
+                if on_complete:
+                    on_complete()
+            block = False
+    
+    def _work(self):
+        """
+        Worker thread main loop
+        """
+        try:
+            http = self._http_factory()
+            http_error = None
+        except Exception as e:
+            http_error = e
+            
+        while True:
+            (_, _, task) = self._tasks.get()
+            if task is None:
+                return
+            (file_obj, local_path, callbacks) = task
+            try:
+                if http_error is not None:
+                    raise http_error
+                self._drive_download.download_file(file_obj, local_path, http)
+                self._results.put((local_path, callbacks, None))
+            except Exception as e:
+                self._results.put((local_path, callbacks, e))
+                
+    _STOP_PRIORITY = float('inf')
+
+
+class Prefetcher:
+    """
+    Runs an iterator (e.g. a Drive listing) on a background thread
+    
+    Items are handed over through a bounded queue, so the producer runs at 
+    most maxsize items ahead of the consumer and memory stays bounded 
+    however long the iterator is.  An exception raised by the iterator is 
+    raised again to the consumer once the items before it were consumed.
+    
+    NOTE: the consumer must not share the producer's HTTP client while it 
+    runs, as httplib2 is not thread-safe
+    """
+    def __init__(self, iterable, maxsize):
+        self._iterable = iterable
+        self._items = Queue.Queue(maxsize=max(1, maxsize))
+        self._closed = threading.Event()
+        self._producer = threading.Thread(target=self._produce, name='prefetch')
+        self._producer.daemon = True
+        self._producer.start()
+        
+    def __iter__(self):
+        while True:
+            (kind, value) = self._items.get()
+            if kind == self._ITEM:
+                yield value
+            elif kind == self._ERROR:
+                raise value[0], value[1], value[2]
+            else:
+                return
+            
+    def close(self):
+        """
+        Stops the producer, waiting for the item it is fetching
+        """
+        self._closed.set()
+        self._producer.join()
+        
+    def _produce(self):
+        """
+        Producer thread main loop
+        """
+        try:
+            for item in self._iterable:
+                if not self._put((self._ITEM, item)):
+                    return
+        except Exception:
+            self._put((self._ERROR, sys.exc_info()))
+        else:
+            self._put((self._END, None))
+            
+    def _put(self, entry):
+        """
+        Queues an entry for the consumer unless the prefetcher is closed
+        
+        Returns False if the prefetcher was closed
+        """
+        while not self._closed.is_set():
+            try:
+                self._items.put(entry, timeout=self._POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                continue
+        return False
+    
+    _ITEM = 'item'
+    _ERROR = 'error'
+    _END = 'end'
+    _POLL_INTERVAL = 0.5
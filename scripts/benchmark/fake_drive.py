@@ -0,0 +1,805 @@
+import BaseHTTPServer
+import hashlib
+import json
+import math
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+class SyntheticDrive:
+    """
+    A deterministic, generated drive of folders and files
+
+    Folders are nested at most depth levels below the root.  File sizes
+    follow a log-normal distribution around mean_file_size (capped at
+    max_file_size), a share of the files are native Google files that can
+    only be exported and a share duplicate the content of another file.
+    Content is generated on the fly from the file id so nothing is held
+    in memory.
+
+    The drive can then be changed at random (mutate).  Every change is
+    recorded in a changes feed, as Drive records them: a trashed folder
+    reports its trashed descendants as well, but a folder moved elsewhere
+    only reports itself.  That includes folders moved out of the drive
+    (e.g. into a folder shared by someone else) and back in.  Some folders
+    are named as private (e.g. 'Private Folder 20') and folders are renamed
+    in and out of being private, for exclusions to match.
+    """
+    def __init__(self, base_url, folder_count, depth, file_count, mean_file_size,
+                 max_file_size, export_ratio, duplicate_ratio, export_formats, seed):
+        self._base_url = base_url
+        self._random = random.Random(seed)
+        self._mean_file_size = mean_file_size
+        self._max_file_size = max_file_size
+        self._export_ratio = export_ratio
+        self._duplicate_ratio = duplicate_ratio
+        self._export_formats = export_formats
+        self._folders = []
+        self._folders_by_id = {}
+        self._files = []
+        self._files_by_id = {}
+        self._changes = []
+        self._mutation_num = 0
+        self._file_count = file_count
+
+        # folders hang off a random folder that is not yet at full depth
+        depth_by_id = {self._ROOT_ID: 0}
+        candidate_parents = [self._ROOT_ID]
+        for folder_num in xrange(folder_count):
+            parent_id = self._random.choice(candidate_parents)
+            folder_id = u'folder{0}'.format(folder_num)
+            depth_by_id[folder_id] = depth_by_id[parent_id] + 1
+            if depth_by_id[folder_id] < depth:
+                candidate_parents.append(folder_id)
+            title = u'Folder {0}'.format(folder_num)
+            if folder_num % self._PRIVATE_FOLDER_INTERVAL == 0:
+                title = self._PRIVATE_PREFIX + title
+            folder = self._make_resource(folder_id, title, self._MIME_TYPE_FOLDER, parent_id)
+            self._folders.append(folder)
+            self._folders_by_id[folder_id] = folder
+
+        parent_ids = [self._ROOT_ID] + [curr_folder[u'id'] for curr_folder in self._folders]
+        for file_num in xrange(file_count):
+            self._add_file(file_num, self._random.choice(parent_ids))
+
+    def get_root_id(self):
+        """
+        Returns the id of the root folder
+        """
+        return self._ROOT_ID
+
+    def get_folders(self):
+        """
+        Returns the resources of every folder
+        """
+        return self._folders
+
+    def get_files(self):
+        """
+        Returns the resources of every file (including the content fields)
+        """
+        return self._files
+
+    def get_file(self, file_id):
+        """
+        Returns the resource of a file (or None)
+        """
+        return self._files_by_id.get(file_id)
+
+    def get_change_token(self):
+        """
+        Returns the changes feed token marking the current state of the drive
+        """
+        return unicode(len(self._changes))
+
+    def get_changes(self, change_token, max_results):
+        """
+        Returns a page of the changes made since a changes feed token as a 
+        tuple of the (file id, resource or None if deleted) of each change
+        and the token of the next page (or None if it is the last one)
+        """
+        start = int(change_token)
+        end = start + max_results
+        changes = [(file_id, self._files_by_id.get(file_id) or self._folders_by_id.get(file_id))
+                   for file_id in self._changes[start:end]]
+        return (changes, unicode(end) if end < len(self._changes) else None)
+
+    def mutate(self, mutation_count):
+        """
+        Makes random changes to the drive: new, modified, renamed, moved, 
+        trashed and deleted files, renamed, moved and trashed folders, 
+        folders moved to the top, out of the drive and back in and folders
+        renamed in and out of being private
+
+        Returns the number of changes made by kind
+        """
+        mutations = [(u'new files', self._mutate_new_file),
+                     (u'modified files', self._mutate_modified_file),
+                     (u'renamed files', lambda: self._mutate_renamed(self._files)),
+                     (u'moved files', self._mutate_moved_file),
+                     (u'trashed files', lambda: self._mutate_trashed(self._files)),
+                     (u'deleted files', self._mutate_deleted_file),
+                     (u'renamed folders', lambda: self._mutate_renamed(self._folders)),
+                     (u'moved folders', self._mutate_moved_folder),
+                     (u'folders moved to the top', self._mutate_top_folder),
+                     (u'folders moved out', self._mutate_moved_out_folder),
+                     (u'folders moved in', self._mutate_moved_in_folder),
+                     (u'folders made private', lambda: self._mutate_private_folder(True)),
+                     (u'folders made public', lambda: self._mutate_private_folder(False)),
+                     (u'trashed folders', lambda: self._mutate_trashed(self._folders))]
+        counts = {}
+        for _ in xrange(mutation_count):
+            (kind, mutation) = self._random.choice(mutations)
+            self._mutation_num += 1
+            if mutation():
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def get_total_size(self):
+        """
+        Returns the number of bytes of content in the drive
+        """
+        return sum(file_obj[u'contentSize'] for file_obj in self._files)
+
+    def itercontent(self, file_obj, start, end):
+        """
+        Iterator for the content of a file from byte start up to (excluding) end
+        """
+        pattern = hashlib.md5(file_obj[u'contentId']).digest()
+        block = pattern * (self._BLOCK_SIZE // len(pattern) + 1)
+        position = start
+        while position < end:
+            offset = position % len(pattern)
+            length = min(end - position, self._BLOCK_SIZE)
+            yield block[offset:offset + length]
+            position += length
+
+    def _add_file(self, file_num, parent_id):
+        """
+        Adds a generated file to a folder
+
+        Returns the resource of the file
+        """
+        file_id = u'file{0}'.format(file_num)
+        if self._files and self._random.random() < self._duplicate_ratio:
+            source = self._random.choice(self._files)
+            (content_id, size) = (source[u'contentId'], source[u'contentSize'])
+        else:
+            (content_id, size) = (file_id, self._get_file_size())
+
+        if self._export_formats and self._random.random() < self._export_ratio:
+            mime_type = self._random.choice(sorted(self._export_formats))
+            file_obj = self._make_resource(file_id, u'Document {0}'.format(file_num),
+                                           mime_type, parent_id)
+            file_obj[u'exportLinks'] = dict(
+                (export_format[u'content_type'],
+                 u'{0}/export/{1}?mimeType={2}'.format(self._base_url, file_id, 
+                                                       export_format[u'content_type']))
+                for export_format in self._export_formats.itervalues())
+        else:
+            file_obj = self._make_resource(file_id, u'File {0}.bin'.format(file_num),
+                                           u'application/octet-stream', parent_id)
+            file_obj[u'downloadUrl'] = u'{0}/download/{1}'.format(self._base_url, file_id)
+            self._set_content(file_obj, content_id, size)
+
+        # NOTE: the content fields are stripped before being served
+        file_obj[u'contentId'] = content_id
+        file_obj[u'contentSize'] = size
+        self._files.append(file_obj)
+        self._files_by_id[file_id] = file_obj
+        return file_obj
+
+    def _set_content(self, file_obj, content_id, size):
+        """
+        Sets the content of a file
+        """
+        file_obj[u'contentId'] = content_id
+        file_obj[u'contentSize'] = size
+        if u'downloadUrl' in file_obj:
+            file_obj[u'fileSize'] = unicode(size)
+            file_obj[u'md5Checksum'] = self._compute_checksum(content_id, size)
+
+    def _mutate_new_file(self):
+        """
+        Adds a file to a random folder
+        """
+        folder_ids = [self._ROOT_ID] + [folder[u'id'] for folder in self._get_live(self._folders)]
+        file_obj = self._add_file(self._file_count, self._random.choice(folder_ids))
+        self._file_count += 1
+        self._record_change(file_obj)
+        return True
+
+    def _mutate_modified_file(self):
+        """
+        Replaces the content of a random file
+        """
+        file_obj = self._choose_live(self._files)
+        if file_obj is None:
+            return False
+        self._set_content(file_obj, u'{0}.{1}'.format(file_obj[u'id'], self._mutation_num),
+                          self._get_file_size())
+        self._record_change(file_obj)
+        return True
+
+    def _mutate_renamed(self, items):
+        """
+        Renames a random file or folder
+        """
+        item = self._choose_live(items)
+        if item is None:
+            return False
+        item[u'title'] = u'Renamed {0} {1}'.format(self._mutation_num, item[u'title'])
+        self._record_change(item)
+        return True
+
+    def _mutate_moved_file(self):
+        """
+        Moves a random file to another folder
+        """
+        file_obj = self._choose_live(self._files)
+        if file_obj is None:
+            return False
+        folder_ids = [self._ROOT_ID] + [folder[u'id'] for folder in self._get_live(self._folders)]
+        self._set_parent(file_obj, self._random.choice(folder_ids))
+        self._record_change(file_obj)
+        return True
+
+    def _mutate_moved_folder(self):
+        """
+        Moves a random folder to another folder outside of its own subtree
+        """
+        folder = self._choose_live(self._folders)
+        if folder is None:
+            return False
+        subtree_ids = set(item[u'id'] for item in self._iter_subtree(folder))
+        folder_ids = [self._ROOT_ID] + [curr_folder[u'id'] for curr_folder in self._get_live(self._folders)
+                                        if curr_folder[u'id'] not in subtree_ids]
+        self._set_parent(folder, self._random.choice(folder_ids))
+        self._record_change(folder)
+        return True
+
+    def _mutate_top_folder(self):
+        """
+        Moves a random folder to the top of the drive
+        """
+        folders = [folder for folder in self._get_live(self._folders)
+                   if folder[u'parents'][0][u'id'] != self._ROOT_ID]
+        if not folders:
+            return False
+        folder = self._random.choice(folders)
+        self._set_parent(folder, self._ROOT_ID)
+        self._record_change(folder)
+        return True
+
+    def _mutate_moved_out_folder(self):
+        """
+        Moves a random folder out of the drive
+        """
+        reachable_ids = self._get_reachable_folder_ids()
+        folders = [folder for folder in self._get_live(self._folders) if folder[u'id'] in reachable_ids]
+        if not folders:
+            return False
+        folder = self._random.choice(folders)
+        self._set_parent(folder, self._OUTSIDE_ID)
+        self._record_change(folder)
+        return True
+
+    def _mutate_moved_in_folder(self):
+        """
+        Moves a random folder from outside of the drive back in, with 
+        everything beneath it
+        """
+        folders = [folder for folder in self._get_live(self._folders)
+                   if folder[u'parents'][0][u'id'] == self._OUTSIDE_ID]
+        if not folders:
+            return False
+        folder = self._random.choice(folders)
+        self._set_parent(folder, self._random.choice(sorted(self._get_reachable_folder_ids())))
+        self._record_change(folder)
+        return True
+
+    def _mutate_private_folder(self, private):
+        """
+        Renames a random folder to be private or no longer private
+        """
+        folders = [folder for folder in self._get_live(self._folders)
+                   if folder[u'title'].startswith(self._PRIVATE_PREFIX) != private]
+        if not folders:
+            return False
+        folder = self._random.choice(folders)
+        if private:
+            folder[u'title'] = self._PRIVATE_PREFIX + folder[u'title']
+        else:
+            folder[u'title'] = folder[u'title'][len(self._PRIVATE_PREFIX):]
+        self._record_change(folder)
+        return True
+
+    def _mutate_trashed(self, items):
+        """
+        Trashes a random file or folder, with everything beneath it
+        """
+        item = self._choose_live(items)
+        if item is None:
+            return False
+        for curr_item in self._iter_subtree(item):
+            curr_item[u'labels'][u'trashed'] = True
+            curr_item[u'explicitlyTrashed'] = curr_item is item
+            self._record_change(curr_item)
+        return True
+
+    def _mutate_deleted_file(self):
+        """
+        Deletes a random file for good
+        """
+        file_obj = self._choose_live(self._files)
+        if file_obj is None:
+            return False
+        self._files.remove(file_obj)
+        del self._files_by_id[file_obj[u'id']]
+        self._changes.append(file_obj[u'id'])
+        return True
+
+    def _get_live(self, items):
+        """
+        Returns the files or folders that are not trashed
+        """
+        return [item for item in items if not item[u'labels'][u'trashed']]
+
+    def _choose_live(self, items):
+        """
+        Returns a random file or folder that is not trashed (or None)
+        """
+        live_items = self._get_live(items)
+        return self._random.choice(live_items) if live_items else None
+
+    def _iter_subtree(self, item):
+        """
+        Iterator for a file or folder and everything beneath it
+        """
+        pending = [item]
+        while pending:
+            curr_item = pending.pop()
+            yield curr_item
+            if curr_item[u'mimeType'] == self._MIME_TYPE_FOLDER:
+                pending.extend(child for child in self._folders + self._files
+                               if curr_item[u'id'] in [parent[u'id'] for parent in child[u'parents']])
+
+    def _get_reachable_folder_ids(self):
+        """
+        Returns the ids of the folders in the drive hierarchy, including the root
+        """
+        reachable_ids = set([self._ROOT_ID])
+        pending = self._get_live(self._folders)
+        while pending:
+            unresolved = []
+            for folder in pending:
+                if folder[u'parents'][0][u'id'] in reachable_ids:
+                    reachable_ids.add(folder[u'id'])
+                else:
+                    unresolved.append(folder)
+            if len(unresolved) == len(pending):
+                break
+            pending = unresolved
+        return reachable_ids
+
+    def _set_parent(self, item, parent_id):
+        """
+        Moves a file or folder to a folder
+        """
+        item[u'parents'] = self._make_parents(item[u'id'], parent_id)
+
+    def _record_change(self, item):
+        """
+        Bumps the version and modification date of a changed file or folder
+        and records the change in the changes feed
+        """
+        modified_date = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(
+            self._BASE_TIME + self._MUTATION_TIME_OFFSET + self._mutation_num))
+        item[u'modifiedDate'] = modified_date
+        item[u'modifiedByMeDate'] = modified_date
+        item[u'version'] = unicode(int(item[u'version']) + 1)
+        self._changes.append(item[u'id'])
+
+    def _make_resource(self, file_id, title, mime_type, parent_id):
+        """
+        Creates the Drive v2 resource of a file or folder
+        """
+        modified_date = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(
+            self._BASE_TIME + self._random.randint(0, 365 * 24 * 60 * 60)))
+        file_url = u'https://drive.google.com/file/d/{0}'.format(file_id)
+        return {
+            u'kind': u'drive#file',
+            u'id': file_id,
+            u'etag': u'"{0}"'.format(hashlib.md5(file_id).hexdigest()),
+            u'selfLink': u'https://www.googleapis.com/drive/v2/files/{0}'.format(file_id),
+            u'alternateLink': file_url + u'/view',
+            u'embedLink': file_url + u'/preview',
+            u'iconLink': u'https://drive-thirdparty.googleusercontent.com/16/type/' + mime_type,
+            u'thumbnailLink': file_url + u'/thumbnail?sz=s220',
+            u'title': title,
+            u'mimeType': mime_type,
+            u'labels': {u'starred': False, u'hidden': False, u'trashed': False,
+                        u'restricted': False, u'viewed': True},
+            u'createdDate': modified_date,
+            u'modifiedDate': modified_date,
+            u'modifiedByMeDate': modified_date,
+            u'lastViewedByMeDate': modified_date,
+            u'markedViewedByMeDate': u'1970-01-01T00:00:00.000Z',
+            u'version': u'1',
+            u'parents': self._make_parents(file_id, parent_id),
+            u'userPermission': self._USER_PERMISSION,
+            u'owners': [self._OWNER],
+            u'ownerNames': [self._OWNER[u'displayName']],
+            u'lastModifyingUser': self._OWNER,
+            u'lastModifyingUserName': self._OWNER[u'displayName'],
+            u'editable': True,
+            u'copyable': True,
+            u'writersCanShare': True,
+            u'shared': False,
+            u'explicitlyTrashed': False,
+            u'appDataContents': False,
+            u'quotaBytesUsed': u'0'
+        }
+
+    def _make_parents(self, file_id, parent_id):
+        """
+        Creates the parent references of a file or folder in a single folder
+        """
+        return [{u'kind': u'drive#parentReference', u'id': parent_id,
+                 u'selfLink': u'https://www.googleapis.com/drive/v2/files/{0}/parents/{1}'.format(
+                     file_id, parent_id),
+                 u'parentLink': u'https://www.googleapis.com/drive/v2/files/' + parent_id,
+                 u'isRoot': parent_id == self._ROOT_ID}]
+
+    def _get_file_size(self):
+        """
+        Draws a file size from a log-normal distribution around the mean file size
+        """
+        mu = math.log(max(self._mean_file_size, 1)) - self._SIZE_SIGMA ** 2 / 2
+        return min(int(self._random.lognormvariate(mu, self._SIZE_SIGMA)), self._max_file_size)
+
+    def _compute_checksum(self, content_id, size):
+        """
+        Returns the MD5 checksum of generated content
+        """
+        md5 = hashlib.md5()
+        for data in self.itercontent({u'contentId': content_id}, 0, size):
+            md5.update(data)
+        return unicode(md5.hexdigest())
+
+    _ROOT_ID = u'0AROOT'
+    _OWNER = {u'kind': u'drive#user', u'displayName': u'Benchmark User',
+              u'isAuthenticatedUser': True, u'permissionId': u'00000000000000000000',
+              u'emailAddress': u'benchmark@example.com',
+              u'picture': {u'url': u'https://lh3.googleusercontent.com/benchmark/photo.jpg'}}
+    _USER_PERMISSION = {u'kind': u'drive#permission', u'etag': u'"benchmark"', u'id': u'me',
+                        u'selfLink': u'https://www.googleapis.com/drive/v2/files/permissions/me',
+                        u'role': u'owner', u'type': u'user'}
+    _MIME_TYPE_FOLDER = u'application/vnd.google-apps.folder'
+    _BLOCK_SIZE = 64 * 1024
+    _SIZE_SIGMA = 1.0
+    _BASE_TIME = 1420070400
+    # NOTE: parent of folders moved out of the drive, which is never listed
+    _OUTSIDE_ID = u'outside'
+    _PRIVATE_PREFIX = u'Private '
+    _PRIVATE_FOLDER_INTERVAL = 20
+    # NOTE: changes are dated after every generated modification date
+    _MUTATION_TIME_OFFSET = 366 * 24 * 60 * 60
+
+
+class _FakeDriveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the subset of the Drive v2 API used by drive_backup
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = url.path.rstrip('/')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if path == '/discovery/v1/apis/drive/v2/rest':
+            self._send_json(self.server.get_discovery_document())
+        elif path == '/drive/v2/files':
+            self._send_json(self._list_files(params), fields=params.get('fields'))
+        elif path == '/drive/v2/changes/startPageToken':
+            self._send_json({u'kind': u'drive#startPageToken',
+                             u'startPageToken': self.server.drive.get_change_token()})
+        elif path == '/drive/v2/changes':
+            self._send_json(self._list_changes(params), fields=params.get('fields'))
+        elif path.startswith('/download/'):
+            self._send_content(path[len('/download/'):], True)
+        elif path.startswith('/export/'):
+            self._send_content(path[len('/export/'):], False)
+        else:
+            self._send_json({u'error': {u'code': 404, u'message': u'Not Found'}}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _list_files(self, params):
+        """
+        Returns a page of the files.list response for the query
+        """
+        query = params.get('q', '')
+        if "mimeType = '" in query:
+            items = self.server.drive.get_folders()
+        elif "mimeType != '" in query:
+            items = self.server.drive.get_files()
+        else:
+            items = self.server.drive.get_folders() + self.server.drive.get_files()
+        if 'trashed = false' in query:
+            items = [item for item in items if not item[u'labels'][u'trashed']]
+        parent_ids = set(re.findall(r"'([^']*)' in parents", query))
+        if parent_ids:
+            items = [item for item in items
+                     if parent_ids.intersection(parent[u'id'] for parent in item[u'parents'])]
+
+        start = int(params.get('pageToken', 0))
+        end = start + int(params.get('maxResults', self._DEFAULT_PAGE_SIZE))
+        page = {u'kind': u'drive#fileList',
+                u'items': [self._strip_content_fields(item) for item in items[start:end]]}
+        if end < len(items):
+            page[u'nextPageToken'] = unicode(end)
+        return page
+
+    def _list_changes(self, params):
+        """
+        Returns a page of the changes.list response from the page token
+        """
+        (changes, next_page_token) = self.server.drive.get_changes(
+            params['pageToken'], int(params.get('maxResults', self._DEFAULT_PAGE_SIZE)))
+        page = {u'kind': u'drive#changeList', u'items': []}
+        for (file_id, item) in changes:
+            change = {u'kind': u'drive#change', u'fileId': file_id, u'deleted': item is None}
+            if item is not None:
+                change[u'file'] = self._strip_content_fields(item)
+            page[u'items'].append(change)
+        if next_page_token:
+            page[u'nextPageToken'] = next_page_token
+        else:
+            page[u'newStartPageToken'] = self.server.drive.get_change_token()
+        return page
+
+    def _strip_content_fields(self, item):
+        """
+        Returns a resource without the fields private to the synthetic drive
+        """
+        return dict((key, value) for (key, value) in item.iteritems()
+                    if key not in (u'contentId', u'contentSize'))
+
+    def _send_json(self, body, status=200, fields=None):
+        """
+        Sends a JSON response (counted as an API request), projected on the
+        requested partial response fields
+        """
+        if fields:
+            body = self._project(body, self._parse_fields(fields))
+        data = json.dumps(body)
+        self.server.record_request(False, len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_content(self, file_id, allow_ranges):
+        """
+        Sends the content of a file, honouring range requests where allowed
+        """
+        file_obj = self.server.drive.get_file(file_id)
+        if file_obj is None:
+            self._send_json({u'error': {u'code': 404, u'message': u'Not Found'}}, 404)
+            return
+        size = file_obj[u'contentSize']
+        (start, end) = (0, size)
+        status = 200
+        range_header = self.headers.get('Range')
+        if allow_ranges and range_header and range_header.startswith('bytes='):
+            (first, last) = range_header[len('bytes='):].split('-')
+            start = int(first)
+            if start >= size:
+                self.server.record_request(True, 0)
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            end = min(size, int(last) + 1) if last else size
+            status = 206
+
+        self.server.record_request(True, end - start)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end - 1, size))
+        self.end_headers()
+        for data in self.server.drive.itercontent(file_obj, start, end):
+            self.wfile.write(data)
+
+    def _parse_fields(self, fields):
+        """
+        Parses a partial response fields selector (e.g. 
+        'nextPageToken,items(id,labels/trashed)') into nested dictionaries 
+        of the selected fields, where None selects a field whole
+        """
+        selection = {}
+        position = 0
+        while position < len(fields):
+            # find the end of the current field at the top nesting level
+            depth = 0
+            end = position
+            while end < len(fields) and (depth or fields[end] != ','):
+                depth += {'(': 1, ')': -1}.get(fields[end], 0)
+                end += 1
+            field = fields[position:end].strip()
+            position = end + 1
+            
+            if '(' in field:
+                (name, nested) = (field[:field.index('(')], field[field.index('(') + 1:-1])
+                sub_selection = self._parse_fields(nested)
+            elif '/' in field:
+                (name, nested) = field.split('/', 1)
+                sub_selection = self._parse_fields(nested)
+            else:
+                (name, sub_selection) = (field, None)
+            if selection.get(name) is not None and sub_selection is not None:
+                selection[name].update(sub_selection)
+            elif name not in selection or sub_selection is None:
+                selection[name] = sub_selection
+        return selection
+    
+    def _project(self, value, selection):
+        """
+        Returns the part of a response value selected by parsed fields
+        """
+        if selection is None:
+            return value
+        if isinstance(value, list):
+            return [self._project(item, selection) for item in value]
+        if isinstance(value, dict):
+            return dict((name, self._project(value[name], sub_selection))
+                        for (name, sub_selection) in selection.iteritems() if name in value)
+        return value
+
+    _DEFAULT_PAGE_SIZE = 100
+
+
+class FakeDriveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP endpoint emulating Google Drive v2 for a SyntheticDrive
+
+    The server binds to a free port on creation so the drive can be
+    generated with its URLs; serve() then answers requests on a background
+    thread and counts the API requests, download requests and bytes sent.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeDriveRequestHandler)
+        self.drive = None
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset_stats()
+
+    def get_base_url(self):
+        """
+        Returns the URL the server answers on
+        """
+        return u'http://{0}:{1}'.format(*self.server_address)
+
+    def get_discovery_url(self):
+        """
+        Returns the URL of the Drive v2 discovery document
+        """
+        return self.get_base_url() + u'/discovery/v1/apis/drive/v2/rest'
+
+    def get_discovery_document(self):
+        """
+        Returns the discovery document describing the emulated methods
+        """
+        query_parameter = lambda parameter_type: {u'type': parameter_type, u'location': u'query'}
+        schema = lambda name: {u'id': name, u'type': u'object'}
+        return {
+            u'kind': u'discovery#restDescription',
+            u'discoveryVersion': u'v1',
+            u'id': u'drive:v2',
+            u'name': u'drive',
+            u'version': u'v2',
+            u'protocol': u'rest',
+            u'rootUrl': self.get_base_url() + u'/',
+            u'servicePath': u'drive/v2/',
+            u'baseUrl': self.get_base_url() + u'/drive/v2/',
+            u'batchPath': u'batch/drive/v2',
+            u'parameters': {
+                u'alt': {u'type': u'string', u'default': u'json', u'location': u'query'},
+                u'fields': query_parameter(u'string')
+            },
+            u'schemas': {
+                u'FileList': schema(u'FileList'),
+                u'ChangeList': schema(u'ChangeList'),
+                u'StartPageToken': schema(u'StartPageToken')
+            },
+            u'resources': {
+                u'files': {u'methods': {
+                    u'list': {
+                        u'id': u'drive.files.list', u'path': u'files', u'httpMethod': u'GET',
+                        u'response': {u'$ref': u'FileList'},
+                        u'parameters': {
+                            u'q': query_parameter(u'string'),
+                            u'maxResults': query_parameter(u'integer'),
+                            u'pageToken': query_parameter(u'string')
+                        }
+                    }
+                }},
+                u'changes': {u'methods': {
+                    u'list': {
+                        u'id': u'drive.changes.list', u'path': u'changes', u'httpMethod': u'GET',
+                        u'response': {u'$ref': u'ChangeList'},
+                        u'parameters': {
+                            u'includeDeleted': query_parameter(u'boolean'),
+                            u'maxResults': query_parameter(u'integer'),
+                            u'pageToken': query_parameter(u'string')
+                        }
+                    },
+                    u'getStartPageToken': {
+                        u'id': u'drive.changes.getStartPageToken',
+                        u'path': u'changes/startPageToken', u'httpMethod': u'GET',
+                        u'response': {u'$ref': u'StartPageToken'}
+                    }
+                }}
+            }
+        }
+
+    def serve(self, drive):
+        """
+        Starts serving a drive on a background thread
+        """
+        self.drive = drive
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-drive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving and releases the port
+        """
+        self.shutdown()
+        self.server_close()
+
+    def record_request(self, is_download, byte_count):
+        """
+        Counts a request and the bytes of its response body
+        """
+        with self._lock:
+            if is_download:
+                self._download_requests += 1
+            else:
+                self._api_requests += 1
+            self._bytes_sent += byte_count
+
+    def reset_stats(self):
+        """
+        Resets the request and byte counters
+        """
+        with self._lock:
+            self._api_requests = 0
+            self._download_requests = 0
+            self._bytes_sent = 0
+
+    def get_stats(self):
+        """
+        Returns the counters as a dictionary of
+        api_requests, download_requests and bytes_sent
+        """
+        with self._lock:
+            return {'api_requests': self._api_requests,
+                    'download_requests': self._download_requests,
+                    'bytes_sent': self._bytes_sent}
@@ -5,20 +5,31 @@ Downloads your Google drive for backup
 """
 
 import argparse
+from datetime import datetime, timedelta
 import httplib2
 import json
 import logging
 from logging.config import dictConfig
-import os
-import re
+import multiprocessing
+import Queue
+import signal
 import sys
 import time
 
-from apiclient.discovery import build
-
-from auth.credential import CredentialManager
-from backup.google_drive import GoogleDriveDownload 
+from auth.credential import CredentialError, CredentialManager
+from backup.accounts import AccountConfiguration, AccountError, AccountFailuresError
+from backup.discovery import DiscoveryCache
+from backup.exclusions import ExclusionMatcher
+from backup.google_drive import ChangeTokenExpiredError, GoogleDriveDownload 
+from backup.index import MetadataIndex
+from backup.journal import RunJournal
+from backup.metrics import RunMetrics
+from backup.scheduling import BandwidthLimiter, DownloadScheduler, RequestRateLimit
 from backup.storage import Storage
+from backup.sync import FullScan, IncrementalSync
+from backup.throttle import RequestThrottle
+from backup.verify import StorageVerifier, VerificationError
+from backup.workers import DownloadFailuresError, DownloadPool
 
 class LevelBelowFilter(logging.Filter):
     """
@@ -41,8 +52,20 @@ class MainProgram:
     """
     _DEFAULT_CONFIG_FILE = './etc/config.json'    
     
+    """
+    Defaults of the watch command (in seconds)
+    """
+    _DEFAULT_WATCH_INTERVAL = 300
+    _DEFAULT_TOKEN_REFRESH_MARGIN = 300
+    
+    """
+    Seconds between checks that the account processes are still running
+    """
+    _ACCOUNT_POLL_INTERVAL = 5
+    
     def __init__(self):
         self._config = None
+        self._accounts = None
         self._options = None
         self._logger = None
         
@@ -52,7 +75,8 @@ class MainProgram:
         """
         # parse the command line arguments
         parser = argparse.ArgumentParser(description='Download your Google Drive')
-        parser.add_argument('command', choices=['download', 'login', 'erase'],
+        parser.add_argument('command', choices=['download', 'watch', 'plan', 'verify', 'login', 
+                                                'erase'],
                             nargs='?', default='download',
                             help="Command to execute")
         parser.add_argument('-c', '--config', dest='configuration_file', action='store', 
@@ -64,15 +88,30 @@ class MainProgram:
         parser.add_argument('--remove-creds', dest='remove_credentials', 
                             action='store_true', default=False,
                             help='Remove locally stored credentials (erase command)')
+        parser.add_argument('--repair', dest='repair', action='store_true', default=False,
+                            help='Download corrupt and missing files again with the next run '
+                                 '(verify command)')
         parser.add_argument('--dry-run', dest='dry_run', action='store_true',
                             help='Simulated output only')
         parser.add_argument('--ignore-modtime', dest='ignore_modtime', 
                             action='store_true', default=False,
                             help="Ignore the modification time and overwrite everything")
+        parser.add_argument('--compare', dest='compare', choices=['modtime', 'checksum'],
+                            default='modtime',
+                            help="Detect changed files by modification time or by checksum")
+        parser.add_argument('--full-scan', dest='full_scan',
+                            action='store_true', default=False,
+                            help="Scan the whole drive even if incremental sync is enabled")
+        parser.add_argument('--account', dest='account', action='store', metavar='NAME',
+                            help='Only use the named account of a multi-account configuration')
         self._options = parser.parse_args(args=args)
         
         # load the configuration
         self._load_configuration( self._options.configuration_file )
+        self._accounts = AccountConfiguration(self._config)
+        if self._options.account:
+            self._config = self._accounts.get_config(self._options.account)
+            self._accounts = AccountConfiguration(self._config)
 
         
         # set up logging and credential manager
@@ -93,7 +132,13 @@ class MainProgram:
     def run(self):
         """
         Runs the selected command
+        
+        With several accounts configured, download backs them all up and 
+        login logs each of them in; every other command needs --account
         """
+        if self._accounts.is_multi_account() and self._options.command not in ('download', 'login'):
+            raise AccountError('Choose one of the accounts with --account: {0}'.format(
+                ', '.join(self._accounts.get_names())))
         method_to_call = getattr(self, self._options.command)
         method_to_call()
         
@@ -111,12 +156,18 @@ class MainProgram:
         Log in the user to cache the credentials
         """
         self._logger.debug('Running interactive login to cache credentials')
+        if self._accounts.is_multi_account():
+            for name in self._accounts.get_names():
+                print 'Logging in account {0}'.format(name)
+                self._for_account(name).login()
+            return
         
         credential_config = self._config[u'credentials']
-        self._credential_manager.get_client_credentials_intractive(
+        credentials = self._credential_manager.get_client_credentials_intractive(
             client_id=credential_config[u'account'][u'client_id'], 
-            client_secret=credential_config[u'account'][u'client_secret'], 
-            persist=True)
+            client_secret=credential_config[u'account'][u'client_secret'])
+        self._credential_manager.store_client_credentials(self._get_credential_key(), 
+                                                          credentials)
         
     def erase(self):
         """
@@ -125,6 +176,8 @@ class MainProgram:
         self._logger.info('Erasing all local files')
         storage = Storage(self._config, self._options.dry_run)
         storage.erase()
+        self._open_index().remove()
+        self._open_journal().remove()
         
         if self._options.remove_credentials:
             self._logger.info('Erasing local credential store')
@@ -134,69 +187,389 @@ class MainProgram:
         """
         Downloads the files
         """
+        if self._accounts.is_multi_account():
+            self._download_accounts()
+        else:
+            self._download(self._load_credentials(), RunMetrics(self._get_account_name()))
+            
+    def _download_accounts(self):
+        """
+        Backs up every configured account, backup.account_concurrency at a 
+        time, each in its own worker process
         
-        self._logger.info('Checking Google Drive')
+        The processes share the global request rate limit and the bandwidth
+        cap.  Each account's outcome is reported once all of them are done.
+        """
+        names = self._accounts.get_names()
+        self._logger.info('Backing up {0} account(s)'.format(len(names)))
+        rate_limit = RequestRateLimit(self._config)
+        bandwidth_limiter = BandwidthLimiter(self._config)
         
-        # load the credentials
-        credentials = self._credential_manager.load_client_credentials(
-            self._config[u'credentials'][u'account'][u'client_id'])
+        # NOTE: credentials are loaded and the discovery document cached up 
+        # front so that the processes only read the shared files
+        pending = []
+        credentials = {}
+        reports = {}
+        for name in names:
+            account_program = self._for_account(name)
+            try:
+                credentials[name] = account_program._load_credentials()
+            except CredentialError as e:
+                self._logger.error('{0}: {1}'.format(name, e))
+                reports[name] = (None, str(e))
+                continue
+            pending.append((name, account_program))
+        self._build_drive_service(httplib2.Http())
         
-        # compile the exclusion list and evaluator
-        exclusions = []
-        for exclusion_str in self._config[u'backup'][u'exclusions']:
-            exclusions.append(re.compile(exclusion_str))
+        results = multiprocessing.Queue()
+        running = {}
+        while pending or running:
+            while pending and len(running) < self._accounts.get_concurrency():
+                (name, account_program) = pending.pop(0)
+                process = multiprocessing.Process(
+                    target=account_program._run_account, name='account-{0}'.format(name),
+                    args=(credentials[name], rate_limit, bandwidth_limiter, results))
+                process.start()
+                running[name] = process
+            try:
+                (name, report, error) = results.get(timeout=self._ACCOUNT_POLL_INTERVAL)
+            except Queue.Empty:
+                # NOTE: a process only exits cleanly once its results were sent,
+                # those that crashed are failures too
+                for (name, process) in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        del running[name]
+                        reports[name] = (None, 'Process exited with code {0}'.format(
+                            process.exitcode))
+                continue
+            running.pop(name).join()
+            reports[name] = (report, error)
             
-        def is_excluded_file(pathname):
-            """
-            Predicate to determine if a file should be excluded
-            """
-            for exclusion in exclusions:
-                if exclusion.search(pathname):
-                    return True
-            return False
+        failures = []
+        for name in names:
+            (report, error) = reports[name]
+            if report is not None:
+                self._logger.info('{0}: {1} in {2:.1f}s, {3}, {4} request(s), {5} byte(s)'.format(
+                    name, 'failed' if error else 'succeeded', report[u'duration'],
+                    ', '.join('{0} {1}'.format(count, state) 
+                              for (state, count) in report[u'files'].iteritems()),
+                    report[u'requests'][u'count'], report[u'bytes_downloaded']))
+            if error:
+                failures.append((name, error))
+        if failures:
+            raise AccountFailuresError(failures)
+            
+    def _run_account(self, credentials, rate_limit, bandwidth_limiter, results):
+        """
+        Backs up a single account in a worker process and sends back the 
+        (name, metrics report, error) of its run
+        """
+        metrics = RunMetrics(self._get_account_name())
+        error = None
+        try:
+            self._download(credentials, metrics, rate_limit, bandwidth_limiter)
+        except Exception as e:
+            self.report_error(e)
+            error = str(e)
+        results.put((self._get_account_name(), metrics.get_report(), error))
+        
+    def _download(self, credentials, metrics, rate_limit=None, bandwidth_limiter=None):
+        """
+        Backs up the account of the configuration with its credentials
+        """
+        self._logger.info('Checking Google Drive')
         
         # create an authorized REST client
-        http = httplib2.Http()
-        http = credentials.authorize(http)
-        drive_service = build('drive', 'v2', http=http)
+        drive_service = self._build_drive_service(credentials.authorize(httplib2.Http()))
         
-        # prepare the storage hierarchy
+        journal = self._open_journal()
         drive_download = GoogleDriveDownload(self._config, 
                                              drive_service, 
-                                             self._options.dry_run)
-        self._logger.debug('Retrieving folder hierarchy...')
-        (all_folders, folder_hierarchy) = drive_download.get_folder_hierarchy()
+                                             self._options.dry_run,
+                                             journal,
+                                             RequestThrottle(self._config, metrics, rate_limit, 
+                                                             bandwidth_limiter))
+        download_pool = self._create_download_pool(drive_download, credentials, metrics)
+        try:
+            self._backup(drive_download, download_pool, journal, metrics)
+        finally:
+            download_pool.close()
+            journal.close()
+            
+    def watch(self):
+        """
+        Stays resident and backs up the changes every backup.watch.interval 
+        seconds
+        
+        The authorized clients (and their open connections), the discovery 
+        based REST client, the throttle and the download workers are kept
+        between runs.  Access tokens are refreshed ahead of their expiry.
+        Polls without changes take no snapshot.  When asked to terminate, 
+        only the downloads in flight are finished.
+        """
+        watch_config = self._config[u'backup'].get(u'watch', {})
+        interval = watch_config.get(u'interval', self._DEFAULT_WATCH_INTERVAL)
+        refresh_margin = timedelta(seconds=watch_config.get(u'token_refresh_margin', 
+                                                            self._DEFAULT_TOKEN_REFRESH_MARGIN))
+        self._logger.info('Watching Google Drive every {0}s'.format(interval))
+        
+        # NOTE: leave through the finally clauses when asked to terminate
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        
+        credentials = self._load_credentials()
+        self._refresh_credentials(credentials, refresh_margin)
+        drive_service = self._build_drive_service(credentials.authorize(httplib2.Http()))
+        
+        metrics = RunMetrics(self._get_account_name())
+        journal = self._open_journal()
+        drive_download = GoogleDriveDownload(self._config, 
+                                             drive_service, 
+                                             self._options.dry_run,
+                                             journal,
+                                             RequestThrottle(self._config, metrics))
+        download_pool = self._create_download_pool(drive_download, credentials, metrics)
+        try:
+            while True:
+                start_time = time.time()
+                self._refresh_credentials(credentials, refresh_margin)
+                try:
+                    self._backup(drive_download, download_pool, journal, metrics)
+                except Exception as e:
+                    # the next run picks up where this one failed
+                    self.report_error(e)
+                time.sleep(max(0, start_time + interval - time.time()))
+        except (SystemExit, KeyboardInterrupt):
+            download_pool.cancel()
+            raise
+        finally:
+            download_pool.close()
+            journal.close()
+        
+    def _backup(self, drive_download, download_pool, journal, metrics):
+        """
+        Runs one backup: applies the changes feed if possible, otherwise 
+        scans the whole drive
+        
+        A snapshot is only taken when there is something to apply.  The 
+        downloads that have not started are dropped when the run is 
+        interrupted (e.g. asked to terminate), and the next run fetches them.
+        """
+        metrics.reset()
+        download_pool.reset()
+        journal.begin_run()
+        
+        # compile the exclusions into a single matcher
+        exclusions = ExclusionMatcher(self._config)
+        
+        storage = Storage(self._config, self._options.dry_run)
+        snapshot_begun = False
+        index = self._open_index()
+        success = False
+        try:
+            # apply the changes feed if possible, otherwise scan everything 
+            new_change_token = None
+            change_token = index.get_change_token()
+            if change_token and self._is_incremental_run():
+                self._logger.debug('Applying changes since the last run...')
+                incremental_sync = IncrementalSync(self._config, drive_download, storage, 
+                                                   index, download_pool, exclusions,
+                                                   self._compare_checksums(), metrics)
+                try:
+                    (changes, new_change_token) = incremental_sync.get_changes(change_token)
+                except ChangeTokenExpiredError as e:
+                    self._logger.info('{0}, running a full scan'.format(e))
+                else:
+                    if changes:
+                        with metrics.phase(u'snapshot'):
+                            storage.begin_snapshot()
+                        snapshot_begun = True
+                        incremental_sync.apply(changes)
+            if new_change_token is None:
+                with metrics.phase(u'snapshot'):
+                    storage.begin_snapshot()
+                snapshot_begun = True
+                full_scan = FullScan(self._config, drive_download, storage, index, 
+                                     download_pool, exclusions, self._compare_checksums(),
+                                     self._options.ignore_modtime, metrics)
+                new_change_token = full_scan.run()
+            
+            # only a successful run moves the changes feed forward
+            download_pool.log_summary()
+            failures = download_pool.get_failures()
+            if failures:
+                raise DownloadFailuresError(failures)
+            index.set_change_token(new_change_token)
+            journal.end_run()
+            if snapshot_begun:
+                with metrics.phase(u'snapshot'):
+                    storage.complete_snapshot()
+            success = True
+        except (SystemExit, KeyboardInterrupt):
+            download_pool.cancel()
+            raise
+        finally:
+            # NOTE: completion callbacks still use the index
+            download_pool.wait()
+            index.close()
+            metrics.finish(success)
+            metrics.log_summary()
+            self._write_metrics(metrics)
+        
+    def plan(self):
+        """
+        Prints the operations a full scan would apply, with the API requests 
+        and bytes they are expected to take, without changing anything
+        """
+        self._logger.info('Planning a full scan of Google Drive')
+        credentials = self._load_credentials()
+        drive_service = self._build_drive_service(credentials.authorize(httplib2.Http()))
+        throttle = RequestThrottle(self._config)
+        drive_download = GoogleDriveDownload(self._config, drive_service, True, 
+                                             throttle=throttle)
+        
+        # NOTE: storage and the index are only read
+        storage = Storage(self._config, True)
+        storage.begin_snapshot()
+        index = MetadataIndex(self._config[u'backup'][u'index_path'], True)
+        try:
+            full_scan = FullScan(self._config, drive_download, storage, index, None, 
+                                 ExclusionMatcher(self._config), self._compare_checksums(),
+                                 self._options.ignore_modtime)
+            plan = full_scan.plan()
+        finally:
+            index.close()
+        for line in plan.describe(throttle.get_request_count(), drive_download.get_chunk_size()):
+            print line
+        
+    def verify(self):
+        """
+        Checks the stored files against the sizes and checksums recorded 
+        in the index and prints what is corrupt, missing or extra
+        
+        With --repair, corrupt and missing files are downloaded again by 
+        the next run
+        """
+        self._logger.info('Verifying the stored files')
         storage = Storage(self._config, self._options.dry_run)
-        if not self._options.dry_run:
-            storage.prepare_storage(all_folders, folder_hierarchy) 
-        
-        # download all the files
-        local_root_folder = storage.get_root_folder()
-        for curr_folder_id in all_folders.iterkeys():
-            relative_folder_path = drive_download.get_relative_folder_path(curr_folder_id, all_folders)
-            for curr_file in drive_download.iterfolder(curr_folder_id):
-                
-                # determine if the current file should be skipped due to 
-                # configured exclusions
-                relative_pathname = os.path.sep.join(
-                    [ relative_folder_path, 
-                     drive_download.get_filename(curr_file)])
-                if is_excluded_file(relative_pathname):
-                    self._logger.debug('Excluding {0}'.format(relative_pathname))
-                    continue
-                
-                # determine if the file should be skipped due to modification time
-                if relative_pathname[0] == '/':
-                    relative_pathname = relative_pathname[1:] 
-                abs_pathname = os.path.sep.join( [local_root_folder, relative_pathname] )
-                if not (self._options.ignore_modtime or 
-                        self._drive_file_is_newer(curr_file, abs_pathname)):
-                    self._logger.debug('Skipping {0} as there has been no change'.format(relative_pathname))
-                    continue
-                
-                self._logger.info('Downloading {0}'.format(relative_pathname))
-                drive_download.download_file(curr_file, abs_pathname)
+        storage.use_latest_snapshot()
+        index = self._open_index()
+        try:
+            verifier = StorageVerifier(self._config, storage, index)
+            verification = verifier.verify()
+            for line in verification.describe():
+                print line
+            if self._options.repair:
+                verifier.repair(verification)
+        finally:
+            index.close()
+        if verification.get_problem_count():
+            raise VerificationError(verification.get_problem_count())
         
+    def _for_account(self, name):
+        """
+        Returns a copy of the program configured for one of several accounts
+        """
+        account_program = MainProgram()
+        account_program._config = self._accounts.get_config(name)
+        account_program._accounts = AccountConfiguration(account_program._config)
+        account_program._options = self._options
+        account_program._logger = self._logger
+        account_program._credential_manager = self._credential_manager
+        return account_program
+    
+    def _get_account_name(self):
+        """
+        Returns the name of the configured account (or None if the 
+        configuration only has one)
+        """
+        return self._config[u'credentials'][u'account'].get(u'name')
+    
+    def _get_credential_key(self):
+        """
+        Returns the key of the configured account's credentials in the 
+        store: its name, or its client id when it has none
+        """
+        return self._get_account_name() or self._config[u'credentials'][u'account'][u'client_id']
+    
+    def _load_credentials(self):
+        """
+        Loads the credentials of the configured account
+        """
+        return self._credential_manager.load_client_credentials(self._get_credential_key())
+    
+    def _refresh_credentials(self, credentials, refresh_margin):
+        """
+        Refreshes the access token if it expires within refresh_margin and 
+        stores the refreshed credentials
+        """
+        if credentials.token_expiry is None:
+            return
+        if credentials.token_expiry - datetime.utcnow() > refresh_margin:
+            return
+        self._logger.debug('Refreshing the access token')
+        credentials.refresh(httplib2.Http())
+        self._credential_manager.store_client_credentials(self._get_credential_key(), 
+                                                          credentials)
+    
+    def _create_download_pool(self, drive_download, credentials, metrics):
+        """
+        Creates the pool of download workers
+        """
+        # every download worker needs its own client as httplib2 is not thread-safe
+        return DownloadPool(
+            drive_download, 
+            lambda: credentials.authorize(httplib2.Http()),
+            self._config[u'backup'].get(u'download_concurrency', 1),
+            metrics,
+            DownloadScheduler(self._config, drive_download))
+    
+    def _write_metrics(self, metrics):
+        """
+        Writes the run's JSON report and Prometheus textfile, where configured
+        """
+        if self._options.dry_run:
+            return
+        metrics_config = self._config[u'backup'].get(u'metrics', {})
+        try:
+            if metrics_config.get(u'report_path'):
+                metrics.write_report(metrics_config[u'report_path'])
+            if metrics_config.get(u'textfile_path'):
+                metrics.write_textfile(metrics_config[u'textfile_path'])
+        except IOError as e:
+            self._logger.warning('Unable to write run metrics: {0}'.format(e))
+    
+    def _build_drive_service(self, http):
+        """
+        Creates the Drive v2 REST client from the cached discovery document, 
+        which is described at backup.discovery_url when one is configured 
+        (e.g. a fake Drive)
+        """
+        return DiscoveryCache(self._config, self._options.dry_run).build_service(http)
+    
+    def _is_incremental_run(self):
+        """
+        Determines if the changes feed should be used instead of a full scan
+        """
+        return (self._config[u'backup'].get(u'incremental', False) and 
+                not (self._options.full_scan or self._options.ignore_modtime))
+    
+    def _compare_checksums(self):
+        """
+        Determines if changed files are detected by checksum instead of modification time
+        """
+        return self._options.compare == 'checksum'
+    
+    def _open_index(self):
+        """
+        Opens the index of everything stored locally
+        """
+        return MetadataIndex(self._config[u'backup'][u'index_path'], self._options.dry_run)
+    
+    def _open_journal(self):
+        """
+        Opens the journal of downloads in flight
+        """
+        return RunJournal(self._config[u'backup'][u'journal_path'], self._options.dry_run)
 
     def _load_configuration(self, config_path ):
         """
@@ -204,18 +577,6 @@ class MainProgram:
         """
         with open( config_path, 'rt') as fp:
             self._config = json.load(fp)
-
-
-    def _drive_file_is_newer(self, drive_fileobj, filepath):
-        """
-        Determine if the drive file is newer than the file in storage
-        """
-        if not os.path.exists(filepath):
-            return True
-        
-        drive_mtime = time.strptime(drive_fileobj[u'modifiedDate'],"%Y-%m-%dT%H:%M:%S.%fZ")
-        finfo = os.stat(filepath)
-        return time.mktime(drive_mtime) > finfo.st_mtime
         
 
 def main():
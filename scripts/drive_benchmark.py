@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks drive_backup.py offline against a synthetic Google Drive
+"""
+
+import argparse
+from collections import OrderedDict
+import copy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from oauth2client.client import AccessTokenCredentials
+
+from auth.credential import CredentialManager
+from backup.exclusions import ExclusionMatcher
+from benchmark.fake_drive import FakeDriveServer, SyntheticDrive
+
+class BenchmarkProgram:
+    """
+    Benchmark program class
+
+    Each run executes the real drive_backup.py download command in a child
+    process against a local fake Drive endpoint.  The first run backs up
+    the whole drive, the second measures what an unchanged drive costs and
+    later ones follow random changes made to the drive before each run.
+    After every run the backup is checked against the drive.
+
+    Private folders are excluded: whole at the top of the drive, only their
+    files elsewhere.  Renaming and moving folders then changes what is 
+    excluded, including beneath them.
+    """
+
+    """
+    Default configuration file (only the backup settings are used)
+    """
+    _DEFAULT_CONFIG_FILE = './etc/config.json'
+
+    def __init__(self):
+        self._options = None
+        self._backup_args = None
+        self._config = None
+
+    def setup(self, args=None):
+        """
+        Sets up the program
+        """
+        parser = argparse.ArgumentParser(description='Benchmark the backup against a synthetic drive')
+        parser.add_argument('-c', '--config', dest='configuration_file', action='store',
+                            metavar='CONFIG', default=self._DEFAULT_CONFIG_FILE,
+                            help='Path to the configuration file to benchmark (CONFIG)')
+        parser.add_argument('--folders', dest='folder_count', type=int, default=200,
+                            help='Number of folders in the drive')
+        parser.add_argument('--depth', dest='depth', type=int, default=4,
+                            help='Maximum folder nesting depth')
+        parser.add_argument('--files', dest='file_count', type=int, default=2000,
+                            help='Number of files in the drive')
+        parser.add_argument('--mean-size', dest='mean_file_size', type=int, default=64 * 1024,
+                            help='Mean file size in bytes (log-normal distribution)')
+        parser.add_argument('--max-size', dest='max_file_size', type=int, default=64 * 1024 * 1024,
+                            help='Maximum file size in bytes')
+        parser.add_argument('--export-ratio', dest='export_ratio', type=float, default=0.1,
+                            help='Share of files that are native Google files to export')
+        parser.add_argument('--duplicate-ratio', dest='duplicate_ratio', type=float, default=0.05,
+                            help='Share of files duplicating the content of another file')
+        parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                            help='Seconds the fake drive waits before answering each request')
+        parser.add_argument('--seed', dest='seed', type=int, default=0,
+                            help='Seed of the generated drive')
+        parser.add_argument('--runs', dest='runs', type=int, default=3,
+                            help='Number of consecutive backup runs')
+        parser.add_argument('--mutations', dest='mutation_count', type=int, default=100,
+                            help='Number of random changes made to the drive before each run after the second')
+        parser.add_argument('--requests-per-second', dest='requests_per_second', type=float,
+                            help='Override the configured request throttle')
+        parser.add_argument('--json', dest='json_file', action='store', metavar='FILE',
+                            help='Also write the results as JSON to FILE')
+        parser.add_argument('--keep', dest='keep', action='store_true', default=False,
+                            help='Keep the working folder with the downloaded files')
+        
+        # any other arguments are passed on to drive_backup.py (e.g. --full-scan)
+        (self._options, self._backup_args) = parser.parse_known_args(args=args)
+
+        with open(self._options.configuration_file, 'rt') as fp:
+            self._config = json.load(fp)
+
+    def run(self):
+        """
+        Generates the drive, runs the backups and reports the results
+        """
+        work_folder = tempfile.mkdtemp(prefix='drive_benchmark.')
+        server = FakeDriveServer(self._options.latency)
+        try:
+            print 'Generating synthetic drive...'
+            drive = SyntheticDrive(server.get_base_url(),
+                                   self._options.folder_count, self._options.depth,
+                                   self._options.file_count, self._options.mean_file_size,
+                                   self._options.max_file_size, self._options.export_ratio,
+                                   self._options.duplicate_ratio,
+                                   self._config[u'backup'][u'download_formats'],
+                                   self._options.seed)
+            print '{0} folders, {1} files, {2} bytes'.format(
+                len(drive.get_folders()), len(drive.get_files()), drive.get_total_size())
+            server.serve(drive)
+            config_pathname = self._write_configuration(work_folder, server.get_discovery_url())
+
+            results = []
+            for run_num in xrange(1, self._options.runs + 1):
+                if run_num > 2 and self._options.mutation_count:
+                    mutation_counts = drive.mutate(self._options.mutation_count)
+                    print 'Changed the drive: ' + ', '.join(
+                        '{0} {1}'.format(count, kind) for (kind, count) in sorted(mutation_counts.iteritems()))
+                server.reset_stats()
+                result = self._run_backup(config_pathname)
+                result.update(server.get_stats())
+                result['run'] = run_num
+                result['differences'] = self._check_backup(drive, config_pathname)
+                results.append(result)
+                self._report(result)
+                if result['exit_code'] != 0 or result['differences']:
+                    break
+
+            if self._options.json_file:
+                with open(self._options.json_file, 'wt') as fp:
+                    json.dump(results, fp, indent=2)
+            return all(result['exit_code'] == 0 and not result['differences'] for result in results)
+        finally:
+            server.stop()
+            if self._options.keep:
+                print 'Working folder kept in {0}'.format(work_folder)
+            else:
+                shutil.rmtree(work_folder)
+
+    def _write_configuration(self, work_folder, discovery_url):
+        """
+        Writes the configuration of the benchmarked backup to the working folder
+
+        Returns the path of the configuration file
+        """
+        config = copy.deepcopy(self._config)
+        backup_config = config[u'backup']
+        backup_config[u'discovery_url'] = discovery_url
+        backup_config[u'storage_path'] = os.path.join(work_folder, 'download')
+        backup_config[u'index_path'] = os.path.join(work_folder, 'index.sqlite')
+        backup_config[u'journal_path'] = os.path.join(work_folder, 'journal.sqlite')
+        backup_config[u'exclusions'] = self._EXCLUSIONS
+        backup_config[u'discovery_cache'] = {u'path': os.path.join(work_folder, 'discovery.json')}
+        backup_config[u'metrics'] = {u'report_path': os.path.join(work_folder, 'report.json'),
+                                     u'textfile_path': os.path.join(work_folder, 'drive_backup.prom')}
+        if u'snapshots' in backup_config:
+            backup_config[u'snapshots'][u'path'] = os.path.join(work_folder, 'snapshots')
+        # NOTE: bandwidth caps would measure the time of day rather than the backup
+        backup_config.get(u'scheduling', {}).pop(u'bandwidth', None)
+        if self._options.requests_per_second:
+            throttle_config = backup_config.setdefault(u'throttle', {})
+            throttle_config[u'requests_per_second'] = self._options.requests_per_second
+            throttle_config[u'max_requests_per_second'] = self._options.requests_per_second
+
+        # the fake drive accepts any access token
+        client_id = config[u'credentials'][u'account'][u'client_id']
+        credentials_pathname = os.path.join(work_folder, 'credentials.store')
+        config[u'credentials'][u'store'][u'path'] = credentials_pathname
+        CredentialManager(credentials_pathname, False).store_client_credentials(
+            client_id, AccessTokenCredentials('benchmark', 'drive_benchmark'))
+
+        # only warnings and errors are reported, to the console
+        config[u'logging'] = {
+            u'version': 1,
+            u'handlers': {u'console_stderr': {u'level': u'WARNING',
+                                              u'class': u'logging.StreamHandler',
+                                              u'stream': u'ext://sys.stderr'}},
+            u'loggers': {u'drive_backup': {u'handlers': [u'console_stderr'],
+                                           u'level': u'WARNING'}}
+        }
+
+        config_pathname = os.path.join(work_folder, 'config.json')
+        with open(config_pathname, 'wt') as fp:
+            json.dump(config, fp, indent=2)
+        return config_pathname
+
+    def _run_backup(self, config_pathname):
+        """
+        Runs drive_backup.py download once
+
+        Returns a dictionary of the exit_code, wall_time (seconds),
+        peak_rss (kilobytes) and phases (seconds by phase, from the run's 
+        report) of the run
+        """
+        command = [sys.executable,
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drive_backup.py'),
+                   'download', '--config', config_pathname] + self._backup_args
+        start_time = time.time()
+        process = subprocess.Popen(command)
+        (_, status, usage) = os.wait4(process.pid, 0)
+        wall_time = time.time() - start_time
+        
+        report_pathname = os.path.join(os.path.dirname(config_pathname), 'report.json')
+        phases = {}
+        if os.path.exists(report_pathname):
+            with open(report_pathname, 'rt') as fp:
+                phases = json.load(fp, object_pairs_hook=OrderedDict)[u'phases']
+            os.unlink(report_pathname)
+        return {'exit_code': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+                'wall_time': wall_time,
+                'peak_rss': usage.ru_maxrss,
+                'phases': phases}
+
+    def _check_backup(self, drive, config_pathname):
+        """
+        Compares the backed up folders and files with the synthetic drive
+
+        Returns a list of the differences found
+        """
+        with open(config_pathname, 'rt') as fp:
+            backup_config = json.load(fp)[u'backup']
+        (expected_folders, expected_files) = self._get_expected_tree(drive, backup_config)
+        
+        storage_folder = backup_config[u'storage_path']
+        snapshot_config = backup_config.get(u'snapshots', {})
+        if snapshot_config.get(u'enabled', False):
+            storage_folder = os.path.join(snapshot_config[u'path'], 'current')
+        (folders, files) = (set(), {})
+        for (root, dirs, filenames) in os.walk(storage_folder):
+            relative_root = os.path.relpath(root, storage_folder)
+            if relative_root == os.curdir:
+                relative_root = ''
+            folders.update(os.path.join(relative_root, d).decode('utf-8') for d in dirs)
+            for f in filenames:
+                pathname = os.path.join(root, f)
+                files[os.path.join(relative_root, f).decode('utf-8')] = os.path.getsize(pathname)
+
+        differences = []
+        for relative_path in sorted(expected_folders | folders):
+            if relative_path not in folders:
+                differences.append(u'missing folder ' + relative_path)
+            elif relative_path not in expected_folders:
+                differences.append(u'unexpected folder ' + relative_path)
+        for relative_path in sorted(set(expected_files) | set(files)):
+            if relative_path not in files:
+                differences.append(u'missing file ' + relative_path)
+            elif relative_path not in expected_files:
+                differences.append(u'unexpected file ' + relative_path)
+            elif files[relative_path] != expected_files[relative_path]:
+                differences.append(u'wrong size of file ' + relative_path)
+        return differences
+
+    def _get_expected_tree(self, drive, backup_config):
+        """
+        Determines what the backup of the synthetic drive should hold
+
+        Returns a tuple of the set of relative folder paths and the 
+        dictionary of relative file paths to sizes
+        """
+        exclusions = ExclusionMatcher({u'backup': backup_config})
+        download_formats = backup_config[u'download_formats']
+        is_live = lambda item: not item[u'labels'][u'trashed']
+        
+        # resolve folder paths from the root down, where None marks an excluded folder
+        folder_paths = {drive.get_root_id(): u''}
+        pending = filter(is_live, drive.get_folders())
+        while pending:
+            unresolved = []
+            for folder in pending:
+                parent_path = folder_paths.get(folder[u'parents'][0][u'id'], False)
+                if parent_path is False:
+                    unresolved.append(folder)
+                elif parent_path is None or exclusions.is_excluded_folder(
+                        os.path.join(parent_path, folder[u'title'])):
+                    folder_paths[folder[u'id']] = None
+                else:
+                    folder_paths[folder[u'id']] = os.path.join(parent_path, folder[u'title'])
+            if len(unresolved) == len(pending):
+                break
+            pending = unresolved
+        
+        files = {}
+        for file_obj in filter(is_live, drive.get_files()):
+            parent_path = folder_paths.get(file_obj[u'parents'][0][u'id'])
+            if parent_path is None:
+                continue
+            filename = file_obj[u'title']
+            if file_obj[u'mimeType'] in download_formats:
+                filename = u'{0}.{1}'.format(filename, download_formats[file_obj[u'mimeType']][u'extension'])
+            if not exclusions.is_excluded_file(os.path.sep.join([parent_path, filename])):
+                files[os.path.join(parent_path, filename)] = file_obj[u'contentSize']
+        return (set(path for path in folder_paths.itervalues() if path), files)
+
+    def _report(self, result):
+        """
+        Prints the results of a run
+        """
+        print ('Run {run}: {wall_time:.2f}s wall time, {api_requests} API requests, '
+               '{download_requests} download requests, {bytes_sent} bytes transferred, '
+               '{peak_rss} KB peak RSS, exit code {exit_code}'.format(**result))
+        if result['phases']:
+            print '  ' + ', '.join('{0} {1:.2f}s'.format(name, duration) 
+                                   for (name, duration) in result['phases'].iteritems())
+        if result['differences']:
+            print '  Backup differs from the drive in {0} places, e.g.:'.format(len(result['differences']))
+            for difference in result['differences'][:self._REPORTED_DIFFERENCES]:
+                print '    ' + difference
+
+    """
+    Exclusions of the benchmarked backup, matching the private folders 
+    (e.g. 'Private Folder 20') at the top of the synthetic drive and the 
+    files beneath private folders elsewhere
+    """
+    _EXCLUSIONS = [u'^Private ', u'(^|/)Private [^/]*/.*[^/]$']
+
+    """
+    Number of differences between the backup and the drive printed per run
+    """
+    _REPORTED_DIFFERENCES = 10
+
+
+def main():
+    """
+    ... Main Program ...
+    """
+    benchmark_program = BenchmarkProgram()
+    benchmark_program.setup()
+    if not benchmark_program.run():
+        sys.exit(1)
+
+if __name__ == '__main__':
+    """
+    ... Main entry point ...
+    """
+    main()
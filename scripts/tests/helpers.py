@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from backup.exclusions import ExclusionMatcher
+from backup.folder_tree import FolderTree
+from backup.google_drive import DriveFile, GoogleDriveDownload
+from backup.index import MetadataIndex
+from backup.storage import Storage
+
+_MIME_TYPE_FOLDER = u'application/vnd.google-apps.folder'
+_MODIFIED_DATE = u'2016-01-01T00:00:00.000Z'
+
+def make_folder(folder_id, title, parent_id=u'root', trashed=False):
+    """
+    Returns the DriveFile record of a folder
+    """
+    return DriveFile(folder_id, title, _MIME_TYPE_FOLDER, (parent_id,), trashed,
+                     _MODIFIED_DATE, None, None, None, None, 1)
+
+def make_file(file_id, title, parent_ids=(u'root',), trashed=False, version=1):
+    """
+    Returns the DriveFile record of a downloadable file, with the file id as
+    its content
+    """
+    return DriveFile(file_id, title, u'application/octet-stream', tuple(parent_ids), trashed,
+                     _MODIFIED_DATE, None, len(file_id), u'http://drive/' + file_id,
+                     None, version)
+
+def make_change(file_obj):
+    """
+    Returns the changes feed entry of an added, modified or trashed item
+    """
+    return {u'fileId': file_obj.id, u'deleted': False, u'file': file_obj}
+
+
+class FakeDriveDownload(GoogleDriveDownload):
+    """
+    Drive access over an in-memory list of DriveFile records
+    """
+    def __init__(self, config, items=()):
+        GoogleDriveDownload.__init__(self, config, None, False, throttle=object())
+        self.items = list(items)
+
+    def get_start_page_token(self):
+        """
+        Returns a fixed changes feed token
+        """
+        return u'1'
+
+    def get_folder_tree(self):
+        """
+        Returns the FolderTree of the folders that are not trashed
+        """
+        folder_tree = FolderTree(self._config.get(u'multiple_parents', True))
+        for file_obj in self.items:
+            if self.is_folder(file_obj) and not file_obj.trashed:
+                folder_tree.add_folder(file_obj.id, file_obj.title, file_obj.parent_ids)
+        return folder_tree
+
+    def iterfiles(self):
+        """
+        Iterator for the files that are not trashed
+        """
+        for file_obj in self.items:
+            if not self.is_folder(file_obj) and not file_obj.trashed:
+                yield file_obj
+
+    def iterchildren(self, folder_ids):
+        """
+        Iterator for the items directly inside any of the given folders
+        """
+        for file_obj in self.items:
+            if set(file_obj.parent_ids) & set(folder_ids):
+                yield file_obj
+
+
+class FakeDownloadPool:
+    """
+    Download pool that stores the file id as the content of each file right away
+    """
+    def __init__(self):
+        self.downloaded = []
+
+    def submit(self, file_obj, local_path, on_complete=None, on_failure=None):
+        """
+        Stores a file and records its id as downloaded
+        """
+        self.downloaded.append(file_obj.id)
+        with open(local_path, 'wb') as fp:
+            fp.write(file_obj.id)
+        if on_complete:
+            on_complete()
+
+    def wait(self):
+        """
+        Returns right away as every download is complete
+        """
+        pass
+
+
+class BackupTestCase(unittest.TestCase):
+    """
+    Test case backed by a temporary storage folder and metadata index
+    """
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.config = {u'backup': {
+            u'include_trashed': u'false',
+            u'storage_path': os.path.join(self.temp_folder, u'download'),
+            u'download_formats': {},
+            u'exclusions': [],
+        }}
+        os.mkdir(self.config[u'backup'][u'storage_path'])
+        self.storage = Storage(self.config, False)
+        self.index = MetadataIndex(os.path.join(self.temp_folder, 'index.sqlite'), False)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_folder)
+
+    def get_exclusions(self):
+        """
+        Returns the ExclusionMatcher of the configured exclusions
+        """
+        return ExclusionMatcher(self.config)
+
+    def store_folder(self, folder_obj, relative_path):
+        """
+        Stores and indexes a folder
+        """
+        self.storage.make_folder(relative_path)
+        self.index.set_folder_path(folder_obj.id, relative_path)
+
+    def store_file(self, file_obj, relative_path):
+        """
+        Stores and indexes a file with the file id as its content
+        """
+        with open(self.storage.get_local_path(relative_path), 'wb') as fp:
+            fp.write(file_obj.id)
+        self.index.record_file(file_obj.id, relative_path, file_obj.modified_date,
+                               file_obj.md5_checksum, file_obj.file_size, None,
+                               file_obj.version)
+
+    def list_storage(self):
+        """
+        Returns the relative paths of every folder and file in storage
+        """
+        (folders, files) = self.storage.list_tree()
+        return folders | files
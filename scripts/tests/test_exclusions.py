@@ -0,0 +1,48 @@
+import unittest
+
+from backup.exclusions import ExclusionMatcher
+
+def make_matcher(exclusions):
+    """
+    Returns the ExclusionMatcher of a list of exclusions
+    """
+    return ExclusionMatcher({u'backup': {u'exclusions': exclusions}})
+
+
+class ExclusionMatcherTest(unittest.TestCase):
+    """
+    Paths matched by ExclusionMatcher
+    """
+    def test_no_exclusions(self):
+        matcher = make_matcher([])
+
+        self.assertFalse(matcher.has_exclusions())
+        self.assertFalse(matcher.is_excluded_file(u'a.txt'))
+        self.assertFalse(matcher.is_excluded_folder(u'readings'))
+
+    def test_any_exclusion_matches(self):
+        matcher = make_matcher([u'\\.tmp$', u'readings/*'])
+
+        self.assertTrue(matcher.has_exclusions())
+        self.assertTrue(matcher.is_excluded_file(u'notes/a.tmp'))
+        self.assertTrue(matcher.is_excluded_folder(u'readings'))
+        self.assertFalse(matcher.is_excluded_file(u'notes/a.txt'))
+        self.assertFalse(matcher.is_excluded_folder(u''))
+
+    def test_inline_flags_apply_to_their_own_exclusion(self):
+        matcher = make_matcher([u'(?i)\\.TMP$', u'^photos/.*\\.JPG$'])
+
+        self.assertTrue(matcher.is_excluded_file(u'notes/a.tmp'))
+        self.assertTrue(matcher.is_excluded_file(u'photos/a.JPG'))
+        self.assertFalse(matcher.is_excluded_file(u'photos/a.jpg'))
+
+    def test_backreferences_number_groups_of_their_own_exclusion(self):
+        matcher = make_matcher([u'^(readings|archive)/', u'/(x)y\\1$'])
+
+        self.assertTrue(matcher.is_excluded_file(u'notes/xyx'))
+        self.assertFalse(matcher.is_excluded_file(u'notes/xyy'))
+        self.assertTrue(matcher.is_excluded_folder(u'readings'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from backup.google_drive import GoogleDriveDownload, SizeMismatchError
+from tests.helpers import make_file
+
+class FakeResponse(dict):
+    """
+    HTTP response headers with a status, as httplib2 returns them
+    """
+    def __init__(self, status, headers=None):
+        dict.__init__(self, headers or {})
+        self.status = status
+
+
+class FakeThrottle:
+    """
+    Serves range requests for some content, sending at most max_chunk bytes
+    per response and reporting total_size in Content-Range
+    """
+    def __init__(self, content, max_chunk, total_size=None):
+        self.content = content
+        self.max_chunk = max_chunk
+        self.total_size = total_size if total_size is not None else str(len(content))
+        self.ranges = []
+
+    def request(self, http, url, headers):
+        """
+        Returns the (response, content) of a range request
+        """
+        (start, end) = [int(value) for value in re.match(r'bytes=(\d+)-(\d+)', headers['Range']).groups()]
+        self.ranges.append((start, end))
+        if start >= len(self.content):
+            return (FakeResponse(416), '')
+        chunk = self.content[start:min(end + 1, start + self.max_chunk)]
+        content_range = 'bytes {0}-{1}/{2}'.format(start, start + len(chunk) - 1, self.total_size)
+        return (FakeResponse(206, {'content-range': content_range}), chunk)
+
+
+class DownloadTest(unittest.TestCase):
+    """
+    Chunked downloads of GoogleDriveDownload
+    """
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_folder, 'file.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def download(self, throttle, file_obj):
+        """
+        Downloads a file with a chunk size of 10 bytes
+        """
+        config = {u'backup': {u'download_chunk_size': 10, u'download_formats': {}}}
+        drive_download = GoogleDriveDownload(config, None, False, throttle=throttle)
+        drive_download.download_file(file_obj, self.filename, http=object())
+
+    def make_file(self, content, size=None):
+        """
+        Returns the DriveFile record of a file with some content
+        """
+        return make_file(u'a', u'file.bin')._replace(
+            md5_checksum=hashlib.md5(content).hexdigest(),
+            file_size=size if size is not None else len(content))
+
+    def read_file(self):
+        """
+        Returns the content of the downloaded file
+        """
+        with open(self.filename, 'rb') as fp:
+            return fp.read()
+
+    def test_short_chunks_continue_up_to_the_total_size(self):
+        content = ''.join(chr(ord('a') + num % 26) for num in xrange(35))
+        throttle = FakeThrottle(content, 4)
+
+        self.download(throttle, self.make_file(content))
+
+        self.assertEqual(self.read_file(), content)
+
+    def test_short_chunk_ends_content_of_unknown_total_size(self):
+        content = 'x' * 25
+        throttle = FakeThrottle(content, 10, total_size='*')
+
+        self.download(throttle, self.make_file(content))
+
+        self.assertEqual(self.read_file(), content)
+        self.assertEqual(len(throttle.ranges), 3)
+
+    def test_truncated_content_is_not_put_in_place(self):
+        content = 'x' * 25
+        throttle = FakeThrottle(content, 10, total_size='40')
+
+        with self.assertRaises(SizeMismatchError):
+            self.download(throttle, self.make_file(content, size=40))
+
+        self.assertEqual(os.listdir(self.temp_folder), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from backup.journal import RunJournal
+
+class RunJournalTest(unittest.TestCase):
+    """
+    Partial downloads recorded by RunJournal
+    """
+    def setUp(self):
+        self.temp_folder = tempfile.mkdtemp()
+        self.journal_pathname = os.path.join(self.temp_folder, 'journal.sqlite')
+        self.temp_path = os.path.join(self.temp_folder, '.a.txt.download')
+        with open(self.temp_path, 'wb') as fp:
+            fp.write('partial')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_folder)
+
+    def test_partial_download_is_resumed(self):
+        journal = RunJournal(self.journal_pathname, False)
+        journal.begin_run()
+        journal.update_partial(u'a.txt', u'r1', self.temp_path, 7)
+        journal.close()
+
+        journal = RunJournal(self.journal_pathname, False)
+        journal.begin_run()
+
+        self.assertEqual(journal.get_partial(u'a.txt', u'r1'), (self.temp_path, 7))
+        self.assertIsNone(journal.get_partial(u'a.txt', u'r2'))
+        journal.close()
+
+    def test_dry_run_creates_no_journal(self):
+        journal = RunJournal(self.journal_pathname, True)
+        journal.begin_run()
+        journal.update_partial(u'a.txt', u'r1', self.temp_path, 7)
+        journal.end_run()
+        journal.remove()
+
+        self.assertFalse(os.path.exists(self.journal_pathname))
+
+    def test_dry_run_reads_the_journal_without_changing_it(self):
+        journal = RunJournal(self.journal_pathname, False)
+        journal.begin_run()
+        journal.update_partial(u'a.txt', u'r1', self.temp_path, 7)
+        journal.close()
+        with open(self.journal_pathname, 'rb') as fp:
+            content = fp.read()
+
+        journal = RunJournal(self.journal_pathname, True)
+        journal.begin_run()
+        self.assertEqual(journal.get_partial(u'a.txt', u'r1'), (self.temp_path, 7))
+        journal.remove_partial(u'a.txt')
+        journal.end_run()
+        journal.close()
+
+        with open(self.journal_pathname, 'rb') as fp:
+            self.assertEqual(fp.read(), content)
+        self.assertTrue(os.path.exists(self.temp_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
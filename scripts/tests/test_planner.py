@@ -0,0 +1,107 @@
+import os
+import unittest
+
+from backup.folder_tree import FolderTree
+from backup.planner import MirrorPlanner
+from tests.helpers import BackupTestCase, FakeDriveDownload, make_file, make_folder
+
+class MirrorPlannerDeletionTest(BackupTestCase):
+    """
+    Deletions planned by MirrorPlanner
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.drive_download = FakeDriveDownload(self.config)
+
+    def plan(self, folders, files):
+        """
+        Returns the Plan mirroring folders and files into storage
+        """
+        folder_tree = FolderTree(self.config[u'backup'].get(u'multiple_parents', True))
+        for folder in folders:
+            folder_tree.add_folder(folder.id, folder.title, folder.parent_ids)
+        planner = MirrorPlanner(self.config, self.drive_download, self.storage, self.index,
+                                self.get_exclusions(), False, False)
+        return planner.plan(folder_tree, files)
+
+    def test_removed_folder_is_deleted_once(self):
+        old = make_folder(u'f1', u'Old')
+        self.store_folder(old, u'Old')
+        self.store_folder(make_folder(u'f2', u'Nested', u'f1'), u'Old/Nested')
+        self.store_file(make_file(u'a', u'a.txt', [u'f2']), u'Old/Nested/a.txt')
+
+        plan = self.plan([], [])
+
+        self.assertEqual(plan.deletions, [u'Old'])
+
+    def test_unlisted_file_is_deleted(self):
+        kept = make_file(u'a', u'a.txt')
+        self.store_file(kept, u'a.txt')
+        self.store_file(make_file(u'b', u'b.txt'), u'b.txt')
+
+        plan = self.plan([], [kept])
+
+        self.assertEqual(plan.deletions, [u'b.txt'])
+        self.assertEqual(plan.downloads, [])
+
+    def test_renamed_file_is_moved_not_deleted(self):
+        self.store_file(make_file(u'a', u'a.txt'), u'a.txt')
+
+        plan = self.plan([], [make_file(u'a', u'renamed.txt')])
+
+        self.assertEqual(plan.deletions, [])
+        self.assertEqual([(old_path, new_path) for (_, old_path, new_path) in plan.file_renames],
+                         [(u'a.txt', u'renamed.txt')])
+        self.assertEqual(plan.downloads, [])
+
+    def test_moved_folder_is_renamed_not_deleted(self):
+        folder = make_folder(u'f1', u'Old')
+        self.store_folder(folder, u'Old')
+        stored = make_file(u'a', u'a.txt', [u'f1'])
+        self.store_file(stored, u'Old/a.txt')
+
+        plan = self.plan([make_folder(u'f1', u'New')], [stored])
+
+        self.assertEqual(plan.deletions, [])
+        self.assertEqual([(old_path, new_path) for (_, old_path, new_path) in plan.folder_renames],
+                         [(u'Old', u'New')])
+        self.assertEqual(plan.downloads, [])
+
+    def test_excluded_file_is_deleted(self):
+        self.config[u'backup'][u'exclusions'] = [u'\\.tmp$']
+        excluded = make_file(u'a', u'a.tmp')
+        self.store_file(excluded, u'a.tmp')
+
+        plan = self.plan([], [excluded])
+
+        self.assertEqual(plan.deletions, [u'a.tmp'])
+
+    def test_copies_in_every_parent_are_kept(self):
+        folders = [make_folder(u'f1', u'One'), make_folder(u'f2', u'Two')]
+        for folder in folders:
+            self.store_folder(folder, folder.title)
+        stored = make_file(u'a', u'a.txt', [u'f1', u'f2'])
+        self.store_file(stored, os.path.join(u'One', u'a.txt'))
+        self.store_file(stored, os.path.join(u'Two', u'a.txt'))
+
+        plan = self.plan(folders, [stored])
+
+        self.assertEqual(plan.deletions, [])
+        self.assertEqual(plan.downloads, [])
+
+    def test_copies_in_later_parents_are_deleted_with_multiple_parents_off(self):
+        self.config[u'backup'][u'multiple_parents'] = False
+        folders = [make_folder(u'f1', u'One'), make_folder(u'f2', u'Two')]
+        for folder in folders:
+            self.store_folder(folder, folder.title)
+        stored = make_file(u'a', u'a.txt', [u'f1', u'f2'])
+        self.store_file(stored, os.path.join(u'One', u'a.txt'))
+        self.store_file(stored, os.path.join(u'Two', u'a.txt'))
+
+        plan = self.plan(folders, [stored])
+
+        self.assertEqual(plan.deletions, [os.path.join(u'Two', u'a.txt')])
+
+
+if __name__ == '__main__':
+    unittest.main()
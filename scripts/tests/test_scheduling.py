@@ -0,0 +1,81 @@
+import copy
+import time
+import unittest
+
+from backup import scheduling
+from backup.scheduling import BandwidthLimiter
+
+class BandwidthLimiterTest(unittest.TestCase):
+    """
+    Delays imposed by BandwidthLimiter, with the clock stopped
+    """
+    def setUp(self):
+        self.delays = []
+        self.original_time = scheduling.time
+        scheduling.time = _StoppedClock(self.delays)
+
+    def tearDown(self):
+        scheduling.time = self.original_time
+
+    def make_limiter(self, bytes_per_second):
+        """
+        Returns a BandwidthLimiter capped at bytes_per_second
+        """
+        return BandwidthLimiter({u'backup': {u'scheduling': {u'bandwidth': {
+            u'bytes_per_second': bytes_per_second}}}})
+
+    def test_bytes_are_charged_against_the_cap(self):
+        limiter = self.make_limiter(1000)
+
+        limiter.consume(500)
+        limiter.consume(1500)
+
+        self.assertEqual(self.delays, [0.5, 2.0])
+
+    def test_unlimited_downloads_never_wait(self):
+        limiter = self.make_limiter(None)
+
+        limiter.consume(1000000)
+
+        self.assertEqual(self.delays, [])
+
+    def test_processes_share_the_bytes_charged(self):
+        limiter = self.make_limiter(1000)
+        # NOTE: a shallow copy holds the same shared memory, as a forked process does
+        other_process_limiter = copy.copy(limiter)
+
+        limiter.consume(1000)
+        other_process_limiter.consume(1000)
+
+        self.assertEqual(self.delays, [1.0, 2.0])
+
+
+class _StoppedClock:
+    """
+    Stand-in for the time module whose clock never moves and which records
+    the delays slept instead of sleeping
+    """
+    def __init__(self, delays):
+        self._delays = delays
+
+    def time(self):
+        """
+        Returns the same time on every call
+        """
+        return 1000000.0
+
+    def localtime(self, now=None):
+        """
+        Converts a time to local time
+        """
+        return time.localtime(now)
+
+    def sleep(self, delay):
+        """
+        Records a delay
+        """
+        self._delays.append(delay)
+
+
+if __name__ == '__main__':
+    unittest.main()
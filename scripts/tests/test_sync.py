@@ -0,0 +1,177 @@
+import os
+import unittest
+
+from backup.sync import FullScan, IncrementalSync
+from tests.helpers import (BackupTestCase, FakeDownloadPool, FakeDriveDownload,
+                           make_change, make_file, make_folder)
+
+class IncrementalSyncTest(BackupTestCase):
+    """
+    Changes applied by IncrementalSync
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.drive_download = FakeDriveDownload(self.config)
+        self.download_pool = FakeDownloadPool()
+
+    def apply(self, changes):
+        """
+        Applies changes to storage and the index
+        """
+        sync = IncrementalSync(self.config, self.drive_download, self.storage, self.index,
+                               self.download_pool, self.get_exclusions(), False)
+        sync.apply(changes)
+
+    def test_trashed_file_is_removed(self):
+        trashed = make_file(u'a', u'a.txt')
+        self.store_file(trashed, u'a.txt')
+        self.store_file(make_file(u'b', u'b.txt'), u'b.txt')
+
+        self.apply([make_change(make_file(u'a', u'a.txt', trashed=True))])
+
+        self.assertEqual(self.list_storage(), set([u'b.txt']))
+        self.assertEqual(self.index.get_file_paths(u'a'), [])
+
+    def test_deleted_file_is_removed(self):
+        self.store_file(make_file(u'a', u'a.txt'), u'a.txt')
+
+        self.apply([{u'fileId': u'a', u'deleted': True}])
+
+        self.assertEqual(self.list_storage(), set())
+        self.assertEqual(self.index.get_file_paths(u'a'), [])
+
+    def test_trashed_folder_is_removed_with_its_contents(self):
+        folder = make_folder(u'f1', u'Folder')
+        self.store_folder(folder, u'Folder')
+        self.store_file(make_file(u'a', u'a.txt', [u'f1']), os.path.join(u'Folder', u'a.txt'))
+
+        self.apply([make_change(make_folder(u'f1', u'Folder', trashed=True))])
+
+        self.assertEqual(self.list_storage(), set())
+        self.assertIsNone(self.index.get_folder_path(u'f1'))
+        self.assertEqual(self.index.get_file_paths(u'a'), [])
+
+    def test_folder_moved_out_of_the_drive_is_removed(self):
+        self.store_folder(make_folder(u'f1', u'Folder'), u'Folder')
+
+        self.apply([make_change(make_folder(u'f1', u'Folder', u'elsewhere'))])
+
+        self.assertEqual(self.list_storage(), set())
+        self.assertIsNone(self.index.get_folder_path(u'f1'))
+
+    def test_file_moved_between_folders_is_moved(self):
+        self.store_folder(make_folder(u'f1', u'One'), u'One')
+        self.store_folder(make_folder(u'f2', u'Two'), u'Two')
+        self.store_file(make_file(u'a', u'a.txt', [u'f1']), os.path.join(u'One', u'a.txt'))
+
+        self.apply([make_change(make_file(u'a', u'a.txt', [u'f2'], version=2))])
+
+        self.assertEqual(self.list_storage(), set([u'One', u'Two', os.path.join(u'Two', u'a.txt')]))
+        self.assertEqual(self.index.get_file_paths(u'a'), [os.path.join(u'Two', u'a.txt')])
+        self.assertEqual(self.download_pool.downloaded, [])
+
+    def test_copies_in_every_parent_are_kept(self):
+        self.store_folder(make_folder(u'f1', u'One'), u'One')
+        self.store_folder(make_folder(u'f2', u'Two'), u'Two')
+        stored = make_file(u'a', u'a.txt', [u'f1', u'f2'])
+        self.store_file(stored, os.path.join(u'One', u'a.txt'))
+        self.store_file(stored, os.path.join(u'Two', u'a.txt'))
+
+        self.apply([make_change(make_file(u'a', u'a.txt', [u'f1', u'f2'], version=2))])
+
+        self.assertEqual(self.index.get_file_paths(u'a'),
+                         [os.path.join(u'One', u'a.txt'), os.path.join(u'Two', u'a.txt')])
+        self.assertEqual(self.download_pool.downloaded, [])
+
+    def test_items_moved_out_of_a_trashed_folder_are_moved(self):
+        self.store_folder(make_folder(u'f1', u'Trash'), u'Trash')
+        self.store_folder(make_folder(u'f2', u'Nested', u'f1'), os.path.join(u'Trash', u'Nested'))
+        self.store_file(make_file(u'a', u'a.txt', [u'f1']), os.path.join(u'Trash', u'a.txt'))
+        self.store_file(make_file(u'b', u'b.txt', [u'f2']),
+                        os.path.join(u'Trash', u'Nested', u'b.txt'))
+        self.store_file(make_file(u'c', u'c.txt', [u'f1']), os.path.join(u'Trash', u'c.txt'))
+
+        self.apply([make_change(make_folder(u'f1', u'Trash', trashed=True)),
+                    make_change(make_file(u'c', u'c.txt', [u'f1'], trashed=True)),
+                    make_change(make_file(u'a', u'a.txt')),
+                    make_change(make_folder(u'f2', u'Nested'))])
+
+        self.assertEqual(self.list_storage(),
+                         set([u'a.txt', u'Nested', os.path.join(u'Nested', u'b.txt')]))
+        self.assertEqual(self.index.get_file_paths(u'a'), [u'a.txt'])
+        self.assertEqual(self.index.get_file_paths(u'b'), [os.path.join(u'Nested', u'b.txt')])
+        self.assertIsNone(self.index.get_folder_path(u'f1'))
+        self.assertEqual(self.download_pool.downloaded, [])
+
+    def test_renamed_file_takes_the_name_of_a_trashed_file(self):
+        self.store_file(make_file(u'a', u'a.txt'), u'a.txt')
+        self.store_file(make_file(u'b', u'b.txt'), u'b.txt')
+
+        self.apply([make_change(make_file(u'a', u'a.txt', trashed=True)),
+                    make_change(make_file(u'b', u'a.txt'))])
+
+        self.assertEqual(self.list_storage(), set([u'a.txt']))
+        with open(self.storage.get_local_path(u'a.txt'), 'rb') as fp:
+            self.assertEqual(fp.read(), 'b')
+        self.assertEqual(self.index.get_file_paths(u'a'), [])
+        self.assertEqual(self.index.get_file_paths(u'b'), [u'a.txt'])
+
+    def test_renamed_folder_takes_the_name_of_a_trashed_folder(self):
+        self.store_folder(make_folder(u'f1', u'Old'), u'Old')
+        self.store_file(make_file(u'a', u'a.txt', [u'f1']), os.path.join(u'Old', u'a.txt'))
+        self.store_folder(make_folder(u'f2', u'New'), u'New')
+        self.store_file(make_file(u'b', u'b.txt', [u'f2']), os.path.join(u'New', u'b.txt'))
+
+        self.apply([make_change(make_folder(u'f1', u'Old', trashed=True)),
+                    make_change(make_folder(u'f2', u'Old'))])
+
+        self.assertEqual(self.list_storage(), set([u'Old', os.path.join(u'Old', u'b.txt')]))
+        self.assertEqual(self.index.get_folder_path(u'f2'), u'Old')
+        self.assertEqual(self.index.get_file_paths(u'a'), [])
+        self.assertEqual(self.index.get_file_paths(u'b'), [os.path.join(u'Old', u'b.txt')])
+        self.assertEqual(self.download_pool.downloaded, [])
+
+
+class FullScanTest(BackupTestCase):
+    """
+    Deletions applied by FullScan
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.drive_download = FakeDriveDownload(self.config)
+        self.download_pool = FakeDownloadPool()
+
+    def run_scan(self, items):
+        """
+        Backs up a drive holding items
+        """
+        self.drive_download.items = items
+        scan = FullScan(self.config, self.drive_download, self.storage, self.index,
+                        self.download_pool, self.get_exclusions(), False, False)
+        scan.run()
+
+    def test_removed_items_are_deleted(self):
+        kept = make_file(u'a', u'a.txt')
+        self.store_file(kept, u'a.txt')
+        self.store_file(make_file(u'b', u'b.txt'), u'b.txt')
+        self.store_folder(make_folder(u'f1', u'Folder'), u'Folder')
+        self.store_file(make_file(u'c', u'c.txt', [u'f1']), os.path.join(u'Folder', u'c.txt'))
+
+        self.run_scan([kept])
+
+        self.assertEqual(self.list_storage(), set([u'a.txt']))
+        self.assertEqual(self.download_pool.downloaded, [])
+
+    def test_file_moved_out_of_a_removed_folder_is_moved(self):
+        self.store_folder(make_folder(u'f1', u'Folder'), u'Folder')
+        self.store_file(make_file(u'a', u'a.txt', [u'f1']), os.path.join(u'Folder', u'a.txt'))
+
+        self.run_scan([make_folder(u'f1', u'Folder', trashed=True), make_file(u'a', u'a.txt')])
+
+        self.assertEqual(self.list_storage(), set([u'a.txt']))
+        self.assertEqual(self.index.get_file_paths(u'a'), [u'a.txt'])
+        self.assertEqual(self.download_pool.downloaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()